@@ -13,6 +13,14 @@ MAIL_SERVER = 'smtp.gmail.com'
 MAIL_PORT = 587
 MAIL_USE_TLS = True
 
+# outgoing mail is queued in the database and sent by background workers,
+# turn off to send within the request instead
+MIXMIND_MAIL_OUTBOX = True
+MIXMIND_MAIL_WORKERS = 2
+MIXMIND_MAIL_BATCH = 50 # emails sent per SMTP connection
+MIXMIND_MAIL_RETRIES = 5
+MIXMIND_MAIL_RETRY_DELAY = 30 # seconds, doubled after each failed attempt
+
 # flask-security
 SECURITY_CONFIRMABLE   =  True
 SECURITY_REGISTERABLE  =  True
@@ -44,6 +52,46 @@ MIXMIND_DEFAULT_INGREDIENTS = ["ExampleBarstock.csv"]
 
 MIXMIND_DEFAULT_BAR_NAME = u"Home Bar"
 
+# keep a parsed snapshot of the recipe library next to the recipe files
+MIXMIND_RECIPE_SNAPSHOT = True
+
+# seconds before a process reloads bar settings changed by another process
+MIXMIND_BAR_CONFIG_MAX_AGE = 10
+
+# recipes are regenerated once stock edits pause for this many seconds,
+# or at most this long after the first edit, 0 to regenerate within the request
+MIXMIND_REGENERATION_DELAY = 0.5
+MIXMIND_REGENERATION_MAX_DELAY = 5.0
+
+# menu pdfs are built by this many background workers and kept in the cache dir
+MIXMIND_PDF_WORKERS = 2
+MIXMIND_PDF_CACHE_DIR = "menus/"
+MIXMIND_PDF_CACHE_MAX_FILES = 200 # least recently used menus beyond this are removed
+MIXMIND_PDF_CACHE_MAX_AGE = 7 * 24 * 3600 # seconds
+
+# rows per page of the paginated admin tables, and the most a client may ask for
+MIXMIND_PAGE_LENGTH = 50
+MIXMIND_PAGE_MAX_LENGTH = 500
+
+# the ingredient table pages, sorts and searches on the server for bars with more rows than this
+MIXMIND_INGREDIENT_SERVER_SIDE_ROWS = 1000
+
+# browse, recipe json and ingredient responses carry an ETag that browsers revalidate,
+# shared caches may also keep anonymous responses for this many seconds
+MIXMIND_PUBLIC_MAX_AGE = 0
+
+# memory budget for rendered recipe cards
+MIXMIND_CARD_CACHE_BYTES = 16 * 1024 * 1024
+
+# time the stages and SQL queries of each request, reported in a Server-Timing
+# header and per route at /api/admin/profile, adds next to no cost when off
+MIXMIND_PROFILE = False
+MIXMIND_PROFILE_SAMPLES = 500 # recent requests kept per route
+
+# development: warn about requests that run the same SQL statement this many
+# times or more, usually a lazy load in a loop, 0 for off
+MIXMIND_N_PLUS_ONE_THRESHOLD = 0
+
 # time
 TIMEZONE = 'US/Eastern'
 HUMAN_FORMAT = 'ddd, D MMM YYYY, at LT'
@@ -4,12 +4,17 @@ from mixmind.logger import get_logger
 log = get_logger('mixmind')
 
 
+import os
 from flask import Flask
 from flask_uploads import UploadSet, DATA, configure_uploads
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object('config')
-app.config.from_pyfile('config.py')
+# MIXMIND_CONFIG names a config applied over the instance config, e.g. the scratch database of the tests
+override_config = os.environ.get('MIXMIND_CONFIG')
+app.config.from_pyfile('config.py', silent=bool(override_config))
+if override_config:
+    app.config.from_pyfile(override_config)
 
 # flask-uploads
 app.config['UPLOADS_DEFAULT_DEST'] = './stockdb'
@@ -21,9 +26,19 @@ db.init_app(app)
 alembic.init_app(app)
 with app.app_context():
     init_db()
+    from mixmind.analytics import ensure_order_rollups
+    ensure_order_rollups()
 
-from mixmind.notifier import mail
+from mixmind.notifier import mail, outbox
 mail.init_app(app)
+outbox.init_app(app)
+
+from mixmind.formatted_menu import pdf_queue
+pdf_queue.init_app(app)
+
+from mixmind.profiling import profiler, query_watcher
+profiler.init_app(app)
+query_watcher.init_app(app)
 
 from mixmind.configuration_management import MixMindServer, get_bar_config
 with app.app_context():
@@ -0,0 +1,160 @@
+"""
+Order throughput and confirmation latency, from rollups kept up to date
+as orders are placed and confirmed so nothing here scans the order table
+"""
+import bisect
+import datetime
+from collections import OrderedDict
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from .database import db
+from .models import Order, OrderRollup, OrderLatencyRollup
+from .logger import get_logger
+log = get_logger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is open ended
+LATENCY_BUCKETS = [15, 30, 60, 90, 120, 180, 300, 450, 600, 900, 1200, 1800, 2700, 3600, 7200]
+PERCENTILES = [50, 95, 99]
+GROUPINGS = {
+    'bar': ['bar_id'],
+    'bartender': ['bar_id', 'bartender_id'],
+    'hour': ['bar_id', 'hour'],
+    'bartender_hour': ['bar_id', 'bartender_id', 'hour'],
+}
+
+def _hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def _rollup_key(order):
+    return {'bar_id': order.bar_id, 'bartender_id': order.bartender_id or 0, 'hour': _hour(order.timestamp)}
+
+def latency_bucket(seconds):
+    return bisect.bisect_left(LATENCY_BUCKETS, seconds)
+
+def _increment(model, key, **increments):
+    """ Add increments to the row of model at key, creating it if needed
+    Done as UPDATE col = col + n so concurrent requests don't lose counts
+    """
+    values = {getattr(model, column): getattr(model, column) + amount for column, amount in increments.items()}
+    if model.query.filter_by(**key).update(values, synchronize_session=False):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**dict(key, **increments)))
+    except IntegrityError:
+        # another request created it first
+        model.query.filter_by(**key).update(values, synchronize_session=False)
+
+def record_order(order):
+    """ Count a newly placed order, call before committing it """
+    _increment(OrderRollup, _rollup_key(order), orders=1)
+
+def record_confirmation(order):
+    """ Count the confirmation of an order, call once when setting order.confirmed
+    and before committing it
+    """
+    key = _rollup_key(order)
+    seconds = max((order.confirmed - order.timestamp).total_seconds(), 0.0)
+    _increment(OrderRollup, key, confirmed=1, latency_total=seconds)
+    _increment(OrderLatencyRollup, dict(key, bucket=latency_bucket(seconds)), count=1)
+
+def rebuild_order_rollups(batch_size=1000):
+    """ Recompute all rollups from the order table, for existing databases """
+    OrderLatencyRollup.query.delete()
+    OrderRollup.query.delete()
+    rollups = {}
+    histograms = {}
+    query = db.session.query(Order.bar_id, Order.bartender_id, Order.timestamp, Order.confirmed)\
+            .filter(Order.bar_id.isnot(None), Order.timestamp.isnot(None))
+    for order in query.yield_per(batch_size):
+        key = tuple(_rollup_key(order).values())
+        rollup = rollups.setdefault(key, {'orders': 0, 'confirmed': 0, 'latency_total': 0.0})
+        rollup['orders'] += 1
+        if order.confirmed:
+            seconds = max((order.confirmed - order.timestamp).total_seconds(), 0.0)
+            rollup['confirmed'] += 1
+            rollup['latency_total'] += seconds
+            bucket = key + (latency_bucket(seconds),)
+            histograms[bucket] = histograms.get(bucket, 0) + 1
+    db.session.bulk_insert_mappings(OrderRollup, [dict(bar_id=bar_id, bartender_id=bartender_id, hour=hour, **rollup)
+        for (bar_id, bartender_id, hour), rollup in rollups.items()])
+    db.session.bulk_insert_mappings(OrderLatencyRollup, [dict(bar_id=bar_id, bartender_id=bartender_id, hour=hour, bucket=bucket, count=count)
+        for (bar_id, bartender_id, hour, bucket), count in histograms.items()])
+    db.session.commit()
+    log.info("Rebuilt {} order rollups".format(len(rollups)))
+
+def ensure_order_rollups():
+    """ Build the rollups if there are orders from before they existed """
+    if OrderRollup.query.first() is None and Order.query.first() is not None:
+        rebuild_order_rollups()
+
+def percentile(histogram, p):
+    """ Approximate p-th percentile in seconds of a {bucket: count} histogram,
+    interpolated within the bucket. The open ended bucket reports its lower bound
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+    target = total * p / 100.0
+    seen = 0
+    for bucket in sorted(histogram):
+        count = histogram[bucket]
+        if seen + count >= target:
+            if bucket >= len(LATENCY_BUCKETS):
+                return float(LATENCY_BUCKETS[-1])
+            low = LATENCY_BUCKETS[bucket-1] if bucket else 0.0
+            return low + (LATENCY_BUCKETS[bucket] - low) * (target - seen) / count
+        seen += count
+    return float(LATENCY_BUCKETS[-1])
+
+def _filtered(query, model, bar_id, bartender_id, since, until):
+    if bar_id is not None:
+        query = query.filter(model.bar_id == bar_id)
+    if bartender_id is not None:
+        query = query.filter(model.bartender_id == bartender_id)
+    if since is not None:
+        query = query.filter(model.hour >= _hour(since))
+    if until is not None:
+        query = query.filter(model.hour < until)
+    return query
+
+def order_stats(group_by='bartender', bar_id=None, bartender_id=None, since=None, until=None):
+    """ Order counts and confirmation latency from the rollups
+    :param str group_by: one of GROUPINGS
+    :param since, until: utc datetimes bounding the hour the orders were placed
+    :returns: list of dicts with the group columns, orders, confirmed,
+        mean_latency and p50/p95/p99 latency in seconds
+    """
+    columns = GROUPINGS[group_by]
+    keys = [getattr(OrderRollup, column) for column in columns]
+    query = db.session.query(*keys, func.sum(OrderRollup.orders), func.sum(OrderRollup.confirmed),
+            func.sum(OrderRollup.latency_total)).group_by(*keys).order_by(*keys)
+    rows = OrderedDict()
+    for row in _filtered(query, OrderRollup, bar_id, bartender_id, since, until):
+        group = tuple(row[:len(columns)])
+        orders, confirmed, latency_total = row[len(columns):]
+        stats = dict(zip(columns, group))
+        stats.update(orders=int(orders or 0), confirmed=int(confirmed or 0),
+                mean_latency=(latency_total / confirmed) if confirmed else None)
+        rows[group] = stats
+
+    keys = [getattr(OrderLatencyRollup, column) for column in columns]
+    query = db.session.query(*keys, OrderLatencyRollup.bucket, func.sum(OrderLatencyRollup.count))\
+            .group_by(*(keys + [OrderLatencyRollup.bucket]))
+    histograms = {}
+    for row in _filtered(query, OrderLatencyRollup, bar_id, bartender_id, since, until):
+        group = tuple(row[:len(columns)])
+        histograms.setdefault(group, {})[row[-2]] = int(row[-1])
+
+    for group, stats in rows.items():
+        histogram = histograms.get(group, {})
+        for p in PERCENTILES:
+            stats['p{}'.format(p)] = percentile(histogram, p)
+    return list(rows.values())
+
+def recent_order_stats(hours=24, now=None, **kwargs):
+    """ order_stats for orders placed in the last hours """
+    now = now or datetime.datetime.utcnow()
+    return order_stats(since=now - datetime.timedelta(hours=hours), **kwargs)
@@ -2,6 +2,11 @@ import csv
 import string
 import itertools
 import codecs
+import threading
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+from flask import g, has_app_context
 
 try:
     import pandas as pd
@@ -9,12 +14,13 @@ try:
 except ImportError:
     has_pandas = False
 
-from sqlalchemy import and_
 from sqlalchemy.exc import SQLAlchemyError
 
 from . import util
 from .database import db
 from .ingredient import Categories, Ingredient, display_name_mappings
+from .models import Bar
+from .profiling import profiler
 from .logger import get_logger
 log = get_logger(__name__)
 
@@ -26,7 +32,7 @@ def get_barstock_instance(csv_list, use_sql=False, bar_id=None, include_all=Fals
     if use_sql or not has_pandas:
         if bar_id is None:
             raise ValueError("Valid bar object required for sql barstock")
-        barstock = Barstock_SQL()
+        barstock = Barstock_SQL(bar_id)
         barstock.load_from_csv(csv_list, bar_id)
         return barstock
     elif has_pandas:
@@ -43,55 +49,293 @@ def _calculated_columns(thing):
     thing['$/cL'] = thing['Price Paid']*10 / thing['Size (mL)']
     thing['$/oz'] = thing['Price Paid'] / thing['Size (oz)']
 
+def _computed_fields(fields):
+    """ Uses clean names, fields may be a model or a dict
+    returns a dict of the computed fields
+    """
+    computed = {'type_': fields['Type'].lower()}
+    try:
+        computed['Size_oz'] = util.convert_units(fields['Size_mL'], 'mL', 'oz')
+        computed['Cost_per_mL'] = fields['Price_Paid']  / fields['Size_mL']
+        computed['Cost_per_cL'] = fields['Price_Paid']*10  / fields['Size_mL']
+        computed['Cost_per_oz'] = fields['Price_Paid']  / computed['Size_oz']
+    except ZeroDivisionError:
+        log.warning("Ingredient missing size field: {}".format(fields))
+    return computed
+
 def _update_computed_fields(row):
     """ Uses clean names
     """
-    row.type_ = row.Type.lower()
+    for field, value in _computed_fields(row).items():
+        row[field] = value
+
+def _clean_csv_row(row):
+    """ Normalize a dict of fields from the csv to the model field names
+    returns None if the row can't be used
+    """
+    if not row.get('Ingredient', row.get('Type')) or not row.get('Kind', row.get('Bottle')):
+        log.debug("Primary key (Ingredient, Kind) missing, skipping ingredient: {}".format(row))
+        return None
     try:
-        row.Size_oz = util.convert_units(row.Size_mL, 'mL', 'oz')
-        row.Cost_per_mL = row.Price_Paid  / row.Size_mL
-        row.Cost_per_cL = row.Price_Paid*10  / row.Size_mL
-        row.Cost_per_oz = row.Price_Paid  / row.Size_oz
-    except ZeroDivisionError:
-        log.warning("Ingredient missing size field: {}".format(row))
+        clean_row = {display_name_mappings[k]['k'] : display_name_mappings[k]['v'](v)
+                for k,v in row.items()
+                if k in display_name_mappings}
+    except ValueError as err:
+        log.warning("{}: skipping ingredient: {}".format(err, row))
+        return None
+    if clean_row.get('Category') is not None and clean_row['Category'] not in Categories:
+        log.warning("Unknown category '{}', skipping ingredient: {}".format(clean_row['Category'], row))
+        return None
+    return clean_row
+
+ImportReport = namedtuple('ImportReport', 'inserted,updated,skipped')
+IMPORT_BATCH_SIZE = 500
 
 class DataError(Exception):
     pass
 
+KindArrays = namedtuple('KindArrays', 'kinds,abv,category,cost_per_unit')
+
 class Barstock(object):
-    pass
+    """ Subclasses provide get_kind_arrays(specifier, unit='oz'), the vectorized
+    lookup of every in-stock kind matching a specifier: a KindArrays of kinds and
+    category names with aligned ABV and cost per unit arrays, in the same order
+    as slice_on_type
+    """
+
+# specifier types that match more than one ingredient type in the stock
+GENERIC_TYPES = ['rum', 'whiskey', 'whisky', 'tequila', 'vermouth']
+ANY_SPIRIT_TYPES = ['dry gin', 'rye whiskey', 'bourbon whiskey', 'amber rum', 'dark rum', 'white rum', 'genever', 'cognac', 'brandy', 'aquavit']
+SPECIAL_TYPES = GENERIC_TYPES + ['any spirit', 'bitters']
+COST_UNITS = ['oz', 'mL', 'cL']
+
+class StockRow(namedtuple('StockRow', list(Ingredient.__table__.columns.keys()))):
+    """ Detached, read-only copy of an Ingredient row
+    supports row[field] access like the model does
+    """
+    __slots__ = ()
+    def __getitem__(self, field):
+        if isinstance(field, str):
+            return getattr(self, field)
+        return super(StockRow, self).__getitem__(field)
+
+    @classmethod
+    def from_model(cls, ingredient):
+        return cls(*(ingredient[field] for field in cls._fields))
+
+def _category_code(category):
+    try:
+        return Categories.index(category)
+    except ValueError:
+        return -1
+
+class StockIndex(object):
+    """ In-memory copy of the in-stock ingredients at a bar, loaded with one query
+    Rows are kept in (Type, Kind) order, which is the order the per-lookup
+    queries used to return them in, and are keyed by lowercased type and
+    by (type, kind). ABV, category and cost per unit are also kept as arrays
+    aligned with the rows for vectorized use.
+    """
+    def __init__(self, bar_id, rows, version=0):
+        self.bar_id = bar_id
+        self.version = version
+        self.rows = rows
+        self.kinds = [row.Kind for row in rows]
+        self.abv = np.array([row.ABV or 0.0 for row in rows], dtype=np.float64)
+        self.category = np.array([_category_code(row.Category) for row in rows], dtype=np.int8)
+        self.cost_per = {unit: np.array([row['Cost_per_{}'.format(unit)] or 0.0 for row in rows], dtype=np.float64)
+                for unit in COST_UNITS}
+        self.by_type = {}
+        self.by_type_kind = {}
+        for i, row in enumerate(rows):
+            self.by_type.setdefault(row.type_, []).append(i)
+            self.by_type_kind.setdefault((row.type_, row.Kind), []).append(i)
+        self._selections = {}
+
+    @classmethod
+    def load(cls, bar_id, version=0):
+        query = Ingredient.query.filter_by(bar_id=bar_id, In_Stock=True).order_by(Ingredient.Type, Ingredient.Kind)
+        rows = [StockRow.from_model(ingredient) for ingredient in query.all()]
+        log.debug("Loaded stock index for bar {} with {} rows".format(bar_id, len(rows)))
+        return cls(bar_id, rows, version)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def select(self, type_):
+        """ Return the positions of rows matching a lowercased specifier type
+        Handles several special cases
+        """
+        positions = self._selections.get(type_)
+        if positions is not None:
+            return positions
+        if type_ in GENERIC_TYPES:
+            pattern = 'whisk' if type_ == 'whisky' else type_
+            positions = [i for i, row in enumerate(self.rows) if pattern in (row.type_ or '')]
+        elif type_ == 'any spirit':
+            positions = [i for i, row in enumerate(self.rows) if row.type_ in ANY_SPIRIT_TYPES]
+        elif type_ == 'bitters':
+            positions = [i for i, row in enumerate(self.rows) if row.Category == 'Bitters']
+        else:
+            positions = self.by_type.get(type_, [])
+        self._selections[type_] = positions
+        return positions
+
+    def lookup(self, type_, kind=None):
+        """ Return the positions of rows matching a lowercased type and optional kind
+        """
+        if kind is None:
+            return self.select(type_)
+        if type_ in SPECIAL_TYPES:
+            return [i for i in self.select(type_) if self.kinds[i] == kind]
+        return self.by_type_kind.get((type_, kind), [])
+
+# per-process registry of stock indexes, keyed by bar id, each labeled
+# with the stored stock version it was loaded at
+_stock_indexes = {}
+_stock_lock = threading.Lock()
+
+def get_stock_index(bar_id):
+    """ Return the StockIndex for the bar, loading it if needed or if the
+    stock version in the database has moved on, which also catches changes
+    made by other processes
+    """
+    version = stored_stock_version(bar_id)
+    index = _stock_indexes.get(bar_id)
+    if index is None or index.version != version:
+        with _stock_lock:
+            index = _stock_indexes.get(bar_id)
+            if index is None or index.version != version:
+                # rows are read after the version, so they are never older than it
+                index = StockIndex.load(bar_id, version)
+                _stock_indexes[bar_id] = index
+    return index
+
+def invalidate_stock_index(bar_id):
+    """ Drop the bar's index, it is rebuilt on the next access
+    Changes to the stock don't need this, they bump the stored version
+    """
+    with _stock_lock:
+        _stock_indexes.pop(bar_id, None)
+
+def bump_stored_stock_version(bar_id):
+    """ Call before committing any change to the ingredients of a bar,
+    so the change and the new version land in the same transaction
+    """
+    db.session.query(Bar).filter_by(id=bar_id).update({Bar.stock_version: Bar.stock_version + 1},
+            synchronize_session=False)
+    if has_app_context():
+        g.pop('stock_versions', None)
+
+def stored_stock_version(bar_id):
+    """ Counter bumped in the database by every change to the stock of the bar
+    Read once per app context, so a request sees one version throughout
+    """
+    versions = g.setdefault('stock_versions', {}) if has_app_context() else {}
+    version = versions.get(bar_id)
+    if version is None:
+        version = versions[bar_id] = db.session.query(Bar.stock_version).filter_by(id=bar_id).scalar() or 0
+    return version
 
 class Barstock_SQL(Barstock):
+    """ Barstock backed by the database, lookups are served from the bar's StockIndex
+    """
     def __init__(self, bar_id):
         self.bar_id = bar_id
-    def load_from_csv(self, csv_list, bar_id, replace_existing=True):
-        """Load the given CSVs
+        self._index = None
+
+    @property
+    def index(self):
+        """ The stock index is pinned on first use so a single recipe
+        generation pass sees a consistent view of the stock
+        """
+        if self._index is None:
+            self._index = get_stock_index(self.bar_id)
+        return self._index
+
+    @profiler.timed('barstock')
+    def load_from_csv(self, csv_list, bar_id, replace_existing=True, batch_size=IMPORT_BATCH_SIZE):
+        """Load the given CSVs in a single transaction
         if replace_existing is True, will replace the whole db for this bar
         bar_id is the active bar
+        Rows are read in batches of batch_size and upserted on (bar_id, Type, Kind)
+        with one bulk insert and one bulk update per batch
+        returns an ImportReport with counts of rows inserted, updated, and skipped
         """
-        if replace_existing:
-            rows_deleted = Ingredient.query.filter_by(bar_id=bar_id).delete()
+        inserted, updated, skipped = 0, 0, 0
+        try:
+            if replace_existing:
+                rows_deleted = Ingredient.query.filter_by(bar_id=bar_id).delete()
+                log.info("Dropped {} rows for {} table".format(rows_deleted, Ingredient.__tablename__))
+            for csv_file in csv_list:
+                # utf-8-sig handles the BOM, /uffef
+                with open(csv_file, encoding='utf-8-sig') as fp:
+                    reader = csv.DictReader(fp)
+                    while True:
+                        batch = list(itertools.islice(reader, batch_size))
+                        if not batch:
+                            break
+                        report = self._upsert_batch(batch, bar_id)
+                        inserted += report.inserted
+                        updated += report.updated
+                        skipped += report.skipped
+            bump_stored_stock_version(bar_id)
             db.session.commit()
-            log.info("Dropped {} rows for {} table".format(rows_deleted, Ingredient.__tablename__))
-        for csv_file in csv_list:
-            # utf-8-sig handles the BOM, /uffef
-            with open(csv_file, encoding='utf-8-sig') as fp:
-                reader = csv.DictReader(fp)
-                for row in reader:
-                    try:
-                        self.add_row(row, bar_id)
-                    except DataError as e:
-                        log.warning(e)
-
+        except SQLAlchemyError as err:
+            db.session.rollback()
+            raise DataError("{}: loading {}".format(err, csv_list))
+        finally:
+            self._stock_changed(bar_id)
+        report = ImportReport(inserted, updated, skipped)
+        log.info("Loaded {} for bar {}: {}".format(csv_list, bar_id, report))
+        return report
+
+    def _upsert_batch(self, batch, bar_id):
+        """ Upsert a list of csv rows without committing
+        """
+        rows = OrderedDict()
+        skipped = 0
+        for row in batch:
+            clean_row = _clean_csv_row(row)
+            if clean_row is None:
+                skipped += 1
+                continue
+            key = (clean_row['Type'], clean_row['Kind'])
+            if key in rows:
+                # repeats are merged into the first, which is the one counted
+                skipped += 1
+            rows.setdefault(key, {}).update(clean_row)
+        if not rows:
+            return ImportReport(0, 0, skipped)
+
+        existing = db.session.query(Ingredient.Type, Ingredient.Kind, Ingredient.Size_mL, Ingredient.Price_Paid)\
+                .filter(Ingredient.bar_id == bar_id, Ingredient.Type.in_(set(type_ for type_, _ in rows)))
+        existing = {(row.Type, row.Kind): row for row in existing}
+        inserts, updates = [], []
+        for key, clean_row in rows.items():
+            fields = {'Size_mL': 0.0, 'Price_Paid': 0.0}
+            if key in existing:
+                fields.update(existing[key]._asdict())
+            fields.update(clean_row)
+            clean_row.update(_computed_fields(fields))
+            clean_row['bar_id'] = bar_id
+            if key in existing:
+                updates.append(clean_row)
+            else:
+                inserts.append(clean_row)
+        if inserts:
+            db.session.bulk_insert_mappings(Ingredient, inserts)
+        if updates:
+            db.session.bulk_update_mappings(Ingredient, updates)
+        return ImportReport(len(inserts), len(updates), skipped)
+
+    @profiler.timed('barstock')
     def add_row(self, row, bar_id):
         """ where row is a dict of fields from the csv
         returns the Model object for the updated/inserted row"""
-        if not row.get('Ingredient', row.get('Type')) or not row.get('Kind', row.get('Bottle')):
-            log.debug("Primary key (Ingredient, Kind) missing, skipping ingredient: {}".format(row))
+        clean_row = _clean_csv_row(row)
+        if clean_row is None:
             return
-        clean_row = {display_name_mappings[k]['k'] : display_name_mappings[k]['v'](v)
-                for k,v in row.items()
-                if k in display_name_mappings}
         try:
             ingredient = Ingredient(bar_id=bar_id, **clean_row)
             row = Ingredient.query.filter_by(bar_id=ingredient.bar_id,
@@ -100,17 +344,27 @@ class Barstock_SQL(Barstock):
                 for k, v in clean_row.items():
                     row[k] = v
                 _update_computed_fields(row)
+                bump_stored_stock_version(bar_id)
                 db.session.commit()
+                self._stock_changed(bar_id)
                 return row
             else: # insert
                 _update_computed_fields(ingredient)
                 db.session.add(ingredient)
+                bump_stored_stock_version(bar_id)
                 db.session.commit()
+                self._stock_changed(bar_id)
                 return ingredient
         except SQLAlchemyError as err:
             msg = "{}: on row: {}".format(err, clean_row)
             raise DataError(msg)
 
+    def _stock_changed(self, bar_id):
+        # the shared index reloads by itself, this one was pinned
+        if bar_id == self.bar_id:
+            self._index = None
+
+    @profiler.timed('barstock')
     def get_all_kind_combinations(self, specifiers):
         """ For a given list of ingredient specifiers, return a list of lists
         where each list is a specific way to make the drink
@@ -130,8 +384,19 @@ class Barstock_SQL(Barstock):
         per_unit = self.get_kind_field(ingredient, 'Cost_per_{}'.format(unit))
         return per_unit * amount
 
+    @profiler.timed('barstock')
+    def get_kind_arrays(self, specifier, unit='oz'):
+        if unit not in COST_UNITS:
+            raise AttributeError("get-kind-field '{}' not a valid field in the data".format('Cost_per_{}'.format(unit)))
+        index = self.index
+        positions = np.array(index.lookup(specifier.ingredient.lower(), specifier.kind), dtype=np.intp)
+        return KindArrays([index.kinds[i] for i in positions], index.abv[positions],
+                [Categories[code] if code >= 0 else None for code in index.category[positions]],
+                index.cost_per[unit][positions])
+
+    @profiler.timed('barstock')
     def get_kind_field(self, ingredient, field):
-        if field not in list(Ingredient.__table__.columns.keys()):
+        if field not in StockRow._fields:
             raise AttributeError("get-kind-field '{}' not a valid field in the data".format(field))
         return self.get_ingredient_row(ingredient)[field]
 
@@ -145,28 +410,12 @@ class Barstock_SQL(Barstock):
             raise ValueError('{} has no entry in the input data!'.format(ingredient.__repr__()))
         return row[0]
 
-    # TODO sqlqlchemy exception decorator?
+    @profiler.timed('barstock')
     def slice_on_type(self, specifier):
-        """ Return query results for rows matching an ingredient specifier
-        Handles several special cases
+        """ Return the in-stock rows matching an ingredient specifier
         """
-        type_ = specifier.ingredient.lower()
-        if type_ in ['rum', 'whiskey', 'whisky', 'tequila', 'vermouth']:
-            type_ = 'whisk' if type_ == 'whisky' else type_
-            filter_ = Ingredient.type_.like('%{}%'.format(type_))
-        elif type_ == 'any spirit':
-            spirits = ['dry gin', 'rye whiskey', 'bourbon whiskey', 'amber rum', 'dark rum', 'white rum', 'genever', 'cognac', 'brandy', 'aquavit']
-            filter_ = Ingredient.type_.in_(spirits)
-        elif type_ == 'bitters':
-            filter_ = Ingredient.Category == 'Bitters'
-        else:
-            filter_ = Ingredient.type_ == type_
-
-        if specifier.kind:
-            filter_ = and_(filter_, Ingredient.Kind == specifier.kind)
-
-        filter_ = and_(filter_, Ingredient.bar_id == self.bar_id, Ingredient.In_Stock == True)
-        return Ingredient.query.filter(filter_).all()
+        index = self.index
+        return [index.rows[i] for i in index.lookup(specifier.ingredient.lower(), specifier.kind)]
 
     def to_csv(self):
         cols = list(Ingredient.__table__.columns.keys())
@@ -203,6 +452,13 @@ class Barstock_DF(Barstock):
         per_unit = self.get_kind_field(ingredient, '$/{}'.format(unit))
         return per_unit * amount
 
+    def get_kind_arrays(self, specifier, unit='oz'):
+        if unit not in COST_UNITS:
+            raise AttributeError("get-kind-field '{}' not a valid field in the data".format('$/{}'.format(unit)))
+        matching = self.slice_on_type(specifier)
+        return KindArrays(matching['Kind'].tolist(), matching['ABV'].to_numpy(dtype=np.float64),
+                matching['Category'].tolist(), matching['$/{}'.format(unit)].to_numpy(dtype=np.float64))
+
     def get_kind_field(self, ingredient, field):
         if field not in self.df.columns:
             raise AttributeError("get-kind-field '{}' not a valid field in the data".format(field))
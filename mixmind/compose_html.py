@@ -47,7 +47,7 @@ def recipe_as_html(recipe, display_opts, order_link=None, condense_ingredients=F
     }
 
     if convert_to:
-        recipe.convert(convert_to)
+        recipe = recipe.converted(convert_to)
 
     main_tag = 'div'
     extra_kwargs = {"klass": "card card-body h-100"}
@@ -96,8 +96,8 @@ def recipe_as_html(recipe, display_opts, order_link=None, condense_ingredients=F
             doc.asis(ingredients+'<br>')
         else:
             with tag('ul', id='ingredients'):
-                for item in recipe.ingredients:
-                    line('li', item.str(), type="none")
+                for ingredient_line in recipe.ingredient_lines():
+                    line('li', ingredient_line, type="none")
 
         if display_opts.variants:
             if condense_ingredients:
@@ -2,20 +2,31 @@
 - uses backing database to get all "global" config required in a request
 - makes available to request in the flask.g via a local proxy
 - ensures changes to global config don't cause races in the middle of a request
-TODO:
-    - recipe library still technically needs synchronization
+- bar configs are cached for the whole process, see BarConfigCache
+- recipe libraries are published per bar as read only snapshots, rebuilt
+  off to the side and swapped in, so a request sees one consistent library
 """
 import os.path
-from collections import namedtuple
+import io
+import pickle
+import copy
+import hashlib
+import threading
+import time
+import uuid
+from collections import namedtuple, OrderedDict
 
 from flask import g, flash
-from flask_login import current_user
+from flask_login import current_user, UserMixin
+from sqlalchemy.orm import joinedload
+from werkzeug.local import LocalProxy
 
 from .recipe import DrinkRecipe
-from .barstock import Barstock_SQL, Ingredient
+from .barstock import Barstock_SQL, Ingredient, StockRow, GENERIC_TYPES, ANY_SPIRIT_TYPES, stored_stock_version
 from .database import db
 from .models import Bar, User
-from .util import load_recipe_json, to_human_diff, get_ts_formatter
+from .util import load_recipe_json, to_human_diff, get_ts_formatter, normalize_name, LRUCache, RecipeSearchIndex
+from .profiling import profiler
 from .logger import get_logger
 log = get_logger(__name__)
 
@@ -37,7 +48,204 @@ def get_checked_files(app, partial_path, files):
         if not os.path.isfile(f):
             missing.add(f)
             log.warning("{} not found, will be omitted".format(f))
-    return list(set(files) - missing)
+    # keep the configured order, earlier recipe files take precedence
+    return [f for f in files if f not in missing]
+
+# bump when the classes pickled in a library snapshot change
+SNAPSHOT_FORMAT = 2
+
+def snapshot_filename(recipe_files):
+    """ Snapshot of a set of recipe files is kept next to the first one
+    """
+    key = hashlib.sha1('\n'.join(os.path.abspath(f) for f in recipe_files).encode('utf-8')).hexdigest()
+    return os.path.join(os.path.dirname(recipe_files[0]), '.library-{}.mmlib'.format(key[:12]))
+
+def _file_sha1(filename):
+    with open(filename, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def _snapshot_sources(recipe_files):
+    sources = []
+    for f in recipe_files:
+        stat = os.stat(f)
+        sources.append((os.path.abspath(f), stat.st_mtime_ns, stat.st_size, _file_sha1(f)))
+    return sources
+
+def _current_sources(header, recipe_files):
+    """ The snapshot's sources as the files are now, or None if it is out of date
+    Sources match on mtime and size, only files where those changed are read
+    to compare their content hash
+    """
+    if header.get('format') != SNAPSHOT_FORMAT:
+        return None
+    sources = header.get('sources', [])
+    if [source[0] for source in sources] != [os.path.abspath(f) for f in recipe_files]:
+        return None
+    current = []
+    for (path, mtime_ns, size, sha1) in sources:
+        stat = os.stat(path)
+        if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size) and _file_sha1(path) != sha1:
+            return None
+        current.append((path, stat.st_mtime_ns, stat.st_size, sha1))
+    return current
+
+def library_hash(sources):
+    """ Content hash of a set of recipe files, from their (path, mtime_ns, size, sha1) sources """
+    digest = hashlib.sha1()
+    for source in sources:
+        digest.update(source[3].encode('ascii'))
+    return digest.hexdigest()
+
+def _write_snapshot(snapshot, sources, base_recipes, library):
+    try:
+        tmp_snapshot = '{}.{}.tmp'.format(snapshot, os.getpid())
+        with open(tmp_snapshot, 'wb') as fp:
+            pickle.dump({'format': SNAPSHOT_FORMAT, 'sources': sources}, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((base_recipes, library), fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_snapshot, snapshot)
+        log.info("Recipe snapshot written to {}".format(snapshot))
+    except OSError as err:
+        log.warning("{} writing recipe snapshot {}: {}".format(err.__class__.__name__, snapshot, err))
+
+def compile_recipes(base_recipes):
+    return [DrinkRecipe(name, recipe) for name, recipe in base_recipes.items()]
+
+def load_recipe_library(recipe_files, use_snapshot=True):
+    """ Load the recipe json files, along with the parsed DrinkRecipes,
+    through a snapshot file that is rebuilt whenever the json files change
+    The snapshot is a header pickle followed by the library pickle, read in one go
+    returns (base_recipes, library, content_hash) where library is a pickled list of DrinkRecipe
+    and content_hash is the library_hash of the json files
+    """
+    if not recipe_files:
+        return OrderedDict(), pickle.dumps([]), library_hash([])
+    snapshot = snapshot_filename(recipe_files)
+    if use_snapshot and os.path.isfile(snapshot):
+        try:
+            with open(snapshot, 'rb') as fp:
+                buf = io.BytesIO(fp.read())
+            header = pickle.load(buf)
+            sources = _current_sources(header, recipe_files)
+            if sources is not None:
+                base_recipes, library = pickle.load(buf)
+                log.info("Recipes loaded from snapshot {}".format(snapshot))
+                if sources != header['sources']:
+                    # same content with a new mtime, record it so it isn't hashed again next time
+                    _write_snapshot(snapshot, sources, base_recipes, library)
+                return base_recipes, library, library_hash(sources)
+            log.info("Recipe snapshot {} is out of date".format(snapshot))
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError, ValueError) as err:
+            log.warning("{} reading recipe snapshot {}: {}".format(err.__class__.__name__, snapshot, err))
+
+    sources = _snapshot_sources(recipe_files)
+    base_recipes = load_recipe_json(recipe_files)
+    library = pickle.dumps(compile_recipes(base_recipes), pickle.HIGHEST_PROTOCOL)
+    if use_snapshot:
+        _write_snapshot(snapshot, sources, base_recipes, library)
+    return base_recipes, library, library_hash(sources)
+
+class RecipeDependencies(object):
+    """ Reverse index from ingredient stock to the recipes that use it
+    A recipe depends on an ingredient when one of its quantized ingredients
+    would pick it up from the stock, using the same rules as StockIndex.select:
+    generic types match by substring, "any spirit" by a list of types,
+    "bitters" by category, and a specifier kind must match the ingredient kind
+    """
+    def __init__(self, recipes):
+        self.names = [recipe.name for recipe in recipes]
+        self.by_type = {}
+        self.by_generic = {}
+        self.any_spirit = []
+        self.bitters = []
+        for recipe in recipes:
+            name = recipe.name
+            for ingredient in recipe._get_quantized_ingredients():
+                type_ = ingredient.specifier.ingredient.lower()
+                entry = (name, ingredient.specifier.kind)
+                if type_ in GENERIC_TYPES:
+                    pattern = 'whisk' if type_ == 'whisky' else type_
+                    self.by_generic.setdefault(pattern, []).append(entry)
+                elif type_ == 'any spirit':
+                    self.any_spirit.append(entry)
+                elif type_ == 'bitters':
+                    self.bitters.append(entry)
+                else:
+                    self.by_type.setdefault(type_, []).append(entry)
+
+    def affected(self, type_, kind=None, category=None):
+        """ Return the set of recipe names that use an ingredient
+        :param string type_: lowercased ingredient type
+        :param string kind: ingredient kind, if None matches any kind
+        :param string category: ingredient category
+        """
+        entries = list(self.by_type.get(type_, []))
+        for pattern, generic_entries in self.by_generic.items():
+            if pattern in type_:
+                entries.extend(generic_entries)
+        if type_ in ANY_SPIRIT_TYPES:
+            entries.extend(self.any_spirit)
+        if category == 'Bitters':
+            entries.extend(self.bitters)
+        return set(name for name, specifier_kind in entries
+                if kind is None or specifier_kind is None or specifier_kind == kind)
+
+    def affected_by_rows(self, rows):
+        """ Return recipe names, in library order, using any of the given Ingredient rows
+        """
+        names = set()
+        for row in rows:
+            names |= self.affected(row.type_ or row.Type.lower(), row.Kind, row.Category)
+        return [name for name in self.names if name in names]
+
+class RecipeLibrary(object):
+    """ Processed recipes for a bar, iterates in library order
+    Lookup by exact name, or by case and accent insensitive name,
+    and search through filter_recipes using the library's search index
+    Not modified once published, see MixMindServer.processed_recipes
+    """
+    def __init__(self, recipes, version=0):
+        self.version = version
+        self.stock_version = 0 # of the bar's stock the recipes were generated from
+        self._by_name = OrderedDict((recipe.name, recipe) for recipe in recipes)
+        self._by_normalized_name = {}
+        for name in self._by_name:
+            self._by_normalized_name.setdefault(normalize_name(name), name)
+        self._search_index = None
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name, default=None):
+        recipe = self._by_name.get(name)
+        if recipe is None:
+            recipe = self._by_name.get(self._by_normalized_name.get(normalize_name(name)), default)
+        return recipe
+
+    def replace(self, recipes):
+        """ New library with the given recipes in place of those with the same names
+        """
+        library = copy.copy(self)
+        library._by_name = OrderedDict(self._by_name)
+        for recipe in recipes:
+            library._by_name[recipe.name] = recipe
+        if self._search_index is not None:
+            library._search_index = self._search_index.with_recipes(library)
+        return library
+
+    @property
+    def search_index(self):
+        """ Built on first use, the library is never modified so it stays valid,
+        replace() carries it over to the new library for the replaced recipes
+        """
+        if self._search_index is None:
+            self._search_index = RecipeSearchIndex(self)
+        return self._search_index
 
 class MixMindServer():
     """ Contains the global recipe library and handle to the barstock"""
@@ -65,71 +273,341 @@ class MixMindServer():
         # initialize recipe library
         recipe_files = get_recipe_files(app)
         log.info("STARTUP: Loading recipes from files: {}".format(recipe_files))
-        self.base_recipes = load_recipe_json(recipe_files)
+        # published RecipeLibrary per bar, replaced whole and never modified
         self._processed_recipes = {}
+        self.load_library(recipe_files, use_snapshot=app.config.get('MIXMIND_RECIPE_SNAPSHOT', True))
+        # versions of libraries and stock count up from 0 in each process, so tags built from them include this
+        self.instance_id = uuid.uuid4().hex[:12]
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._bar_locks = {}
+        # rendered recipe html, keyed with the library version so changes are never served stale
+        self.card_cache = LRUCache(app.config.get('MIXMIND_CARD_CACHE_BYTES', 16*1024*1024))
+        bar_config_cache.max_age = app.config.get('MIXMIND_BAR_CONFIG_MAX_AGE', 10)
+        self.regeneration_queue = RegenerationQueue(app, self,
+                delay=app.config.get('MIXMIND_REGENERATION_DELAY', 0.5),
+                max_delay=app.config.get('MIXMIND_REGENERATION_MAX_DELAY', 5.0))
+
+    def load_library(self, recipe_files, use_snapshot=True):
+        """Use the recipes of the given json files, each bar's library is
+        generated from them when next asked for
+        """
+        self.base_recipes, self._library, self.library_hash = load_recipe_library(recipe_files, use_snapshot=use_snapshot)
+        self.recipe_dependencies = RecipeDependencies(self.new_recipes())
+        self._processed_recipes = {}
+
+    def new_recipes(self):
+        """Fresh, unprocessed DrinkRecipe objects for the whole library"""
+        return pickle.loads(self._library)
+
+    def version(self, bar_id):
+        """Counter bumped whenever a new recipe library is published for a bar"""
+        return self._versions.get(bar_id, 0)
+
+    def bump_version(self, bar_id):
+        with self._lock:
+            self._versions[bar_id] = self._versions.get(bar_id, 0) + 1
+            return self._versions[bar_id]
+
+    def _bar_lock(self, bar_id):
+        """Serializes the writers of a bar's library, readers never take it"""
+        with self._lock:
+            return self._bar_locks.setdefault(bar_id, threading.Lock())
+
+    def _publish(self, bar_id, library, barstock):
+        """Swap in a new library for the bar, requests that already have the old one keep it"""
+        library.version = self.bump_version(bar_id)
+        library.stock_version = barstock.index.version
+        self._processed_recipes[bar_id] = library
+
+    def live_stock_version(self, bar):
+        """Stock version the bar's served recipes reflect, see barstock.stored_stock_version
+        Asking also starts catching up with changes made by other processes
+        """
+        return self.processed_recipes(bar).stock_version
 
     def processed_recipes(self, bar):
-        """Allow lazy loading of the recipes for a given bar"""
-        if bar.id not in self._processed_recipes:
-            self.generate_recipes(bar)
-        return self._processed_recipes[bar.id]
+        """Allow lazy loading of the recipes for a given bar
+        The returned library is a snapshot, treat it and its recipes as read only
+        A library behind the stored stock version, e.g. after a change made by
+        another process, is regenerated whole through the regeneration queue
+        """
+        library = self._processed_recipes.get(bar.id)
+        if library is None:
+            with self._bar_lock(bar.id):
+                if bar.id not in self._processed_recipes:
+                    self._generate_recipes(bar)
+            library = self._processed_recipes[bar.id]
+        elif library.stock_version < stored_stock_version(bar.id) and not self.regeneration_queue.is_pending(bar.id):
+            self.regeneration_queue.add(bar)
+            library = self._processed_recipes[bar.id]
+        return library
 
     def find_recipe(self, bar, name):
         """Find specific recipe at bar"""
-        for recipe in self.processed_recipes(bar):
-            if recipe.name == name:
-                return recipe
-        return None
+        return self.processed_recipes(bar).get(name)
 
     def generate_recipes(self, bar):
+        with self._bar_lock(bar.id):
+            self._generate_recipes(bar)
+
+    def _generate_recipes(self, bar):
         log.info("Generating recipe library for {}".format(bar.cname))
         barstock = Barstock_SQL(bar.id)
-        self._processed_recipes[bar.id] = [DrinkRecipe(name, recipe).generate_examples(barstock, stats=True)
-                for name, recipe in list(self.base_recipes.items())]
+        self._publish(bar.id, RecipeLibrary(recipe.generate_examples(barstock, stats=True)
+                for recipe in self.new_recipes()), barstock)
 
-    def regenerate_recipes(self, bar, ingredient=None, recipe_name=None):
+    def schedule_regeneration(self, bar, ingredients=None):
+        """Regenerate the recipes in the background after a stock change,
+        same as regenerate_recipes(bar, ingredients), or the whole library if not given
+        :returns: stock version that will be live once done, see live_stock_version
+        """
+        self.regeneration_queue.add(bar, ingredients)
+        return stored_stock_version(bar.id)
+
+    def regenerate_recipes(self, bar, ingredients=None, recipe_name=None):
         """Regenerate the examples and statistics data for the recipes at the given bar
-        :param string ingredient: only updates recipes with the given ingredient
+        Updated recipes are copies, published in a new library along with the unchanged ones
+        :param list ingredients: only updates recipes using these Ingredient rows,
+            include the state of a row both before and after a change
         :param string reipce_name: only updates the given recipe
         """
-        if ingredient:
-            log.info("Updating recipes containing {} for {}".format(ingredient, bar.cname))
-            [recipe.generate_examples(Barstock_SQL(bar.id), stats=True) for recipe in self.processed_recipes(bar)
-                            if recipe.contains_ingredient(ingredient)]
-        elif recipe_name:
-            recipe = find_recipe(bar, recipe_name)
-            if recipe is None:
-                log.info("Error: no recipe found matching name \"{}\"".format(recipe_name))
-            log.info("Updating recipe {} at {}".format(recipe, bar.cname))
-            recipe.generate_examples(Barstock_SQL(bar.id), stats=True)
-        else:
+        if not ingredients and not recipe_name:
             log.info("Regenerating recipe library for {}".format(bar.cname))
-            [recipe.generate_examples(Barstock_SQL(bar.id), stats=True) for recipe in self.processed_recipes(bar)]
+            self.generate_recipes(bar)
+            return
+        with self._bar_lock(bar.id):
+            library = self._processed_recipes.get(bar.id)
+            if library is None:
+                self._generate_recipes(bar)
+                return
+            if ingredients:
+                names = self.recipe_dependencies.affected_by_rows(ingredients)
+                log.info("Updating {} recipes containing {} for {}".format(len(names),
+                    ', '.join(set(row.Type for row in ingredients)), bar.cname))
+                recipes = [library.get(name) for name in names if name in library]
+            else:
+                recipe = library.get(recipe_name)
+                if recipe is None:
+                    log.info("Error: no recipe found matching name \"{}\"".format(recipe_name))
+                    return
+                log.info("Updating recipe {} at {}".format(recipe, bar.cname))
+                recipes = [recipe]
+            barstock = Barstock_SQL(bar.id)
+            self._publish(bar.id, library.replace([copy.copy(recipe).generate_examples(barstock, stats=True)
+                for recipe in recipes]), barstock)
+
+class PendingRegeneration(object):
+    def __init__(self, bar, now):
+        self.bar = bar
+        self.rows = []
+        self.everything = False
+        self.first = now
+        self.last = now
+
+class RegenerationQueue(object):
+    """ Regenerates recipes on a background thread after stock changes
+    Changes to a bar are collected until none arrive for delay seconds, or
+    max_delay seconds after the first, then one regeneration covers all the
+    recipes affected by any of them. With delay <= 0 regeneration is done
+    immediately in the calling thread.
+    """
+    def __init__(self, app, server, delay=0.5, max_delay=5.0):
+        self.app = app
+        self.server = server
+        self.delay = delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        self.running = 0
+        self.active = set() # ids of the bars being regenerated
+        self.thread = None
+
+    def add(self, bar, ingredients=None):
+        """ Queue a regeneration for the bar
+        :param BarConfig bar: bar to update, anything with id and cname
+        :param list ingredients: changed Ingredient rows, before and after the change,
+            None to regenerate everything
+        """
+        if isinstance(bar, LocalProxy):
+            # the request's current_bar, the queue outlives it
+            bar = bar._get_current_object()
+        if self.delay <= 0:
+            self.server.regenerate_recipes(bar, ingredients=ingredients)
+            return
+        with self.condition:
+            now = time.monotonic()
+            pending = self.pending.get(bar.id)
+            if pending is None:
+                pending = self.pending[bar.id] = PendingRegeneration(bar, now)
+            if ingredients is None:
+                pending.everything = True
+            else:
+                # db rows don't outlive the request's session
+                pending.rows.extend(StockRow.from_model(row) if isinstance(row, Ingredient) else row
+                        for row in ingredients)
+            pending.last = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="mixmind-regeneration", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def is_pending(self, bar_id):
+        """ Whether a regeneration of the bar is queued or running """
+        with self.condition:
+            return bar_id in self.pending or bar_id in self.active
+
+    def wait(self, timeout=None):
+        """ Block until nothing is queued or running, returns False on timeout """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending or self.running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _due(self, now):
+        """ Pending regenerations ready to run, and seconds until the next one is """
+        due = []
+        next_due = None
+        for bar_id, pending in list(self.pending.items()):
+            ready_at = min(pending.last + self.delay, pending.first + self.max_delay)
+            if ready_at <= now:
+                due.append(self.pending.pop(bar_id))
+            elif next_due is None or ready_at - now < next_due:
+                next_due = ready_at - now
+        return due, next_due
+
+    def _run(self):
+        while True:
+            with self.condition:
+                due, next_due = self._due(time.monotonic())
+                while not due:
+                    self.condition.wait(next_due)
+                    due, next_due = self._due(time.monotonic())
+                self.running += 1
+                self.active.update(pending.bar.id for pending in due)
+            try:
+                with self.app.app_context():
+                    for pending in due:
+                        try:
+                            self.server.regenerate_recipes(pending.bar,
+                                    ingredients=None if pending.everything else pending.rows)
+                        except Exception:
+                            log.exception("Regenerating recipes for {} failed".format(pending.bar.cname))
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.active.difference_update(pending.bar.id for pending in due)
+                    self.condition.notify_all()
 
 BarConfig = namedtuple("BarConfig", "id,cname,name,tagline,owner,bartender,markup,prices,stats,examples,convert,prep_line,origin,info,variants,summarize,is_closed,is_public")
 
+class UserSnapshot(UserMixin):
+    """ Copy of the User fields a BarConfig needs, outlives the db session
+    Compares equal to the User it was taken from, like current_user == bar.owner
+    """
+    def __init__(self, user):
+        self.id = user.id
+        self.email = user.email
+        self.first_name = user.first_name
+        self.last_name = user.last_name
+        self.nickname = user.nickname
+
+    get_name = User.get_name
+    get_name_with_email = User.get_name_with_email
+
+    def __repr__(self):
+        return "<UserSnapshot {}>".format(self.id)
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user) if user else None
+
+class BarConfigCache(object):
+    """ Process wide BarConfig of every bar, so requests don't query for them
+    - invalidate() after committing any change to a Bar, or to a user that is a bar's owner
+      or bartender; the next request in this process reloads everything with two queries
+    - other processes pick up the change once max_age seconds have passed
+    - one request reloads a stale snapshot, concurrent ones wait for it rather than
+      all querying at once
+    - a request takes its current bar and bar list from one snapshot and keeps them in g,
+      so they are consistent with each other and don't change under it, even if
+      the request itself commits changes
+    """
+    def __init__(self, max_age=10):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # serializes reloads, separate from lock so invalidate() never waits on the queries
+        self.load_lock = threading.Lock()
+        self.version = 0
+        self.snapshot = None
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.snapshot = None
+
+    def is_stale(self, snapshot):
+        return snapshot is None or time.monotonic() - snapshot.loaded > self.max_age
+
+    def get(self):
+        snapshot = self.snapshot
+        if self.is_stale(snapshot):
+            with self.load_lock:
+                # reloaded by another request while this one waited
+                snapshot = self.snapshot
+                if self.is_stale(snapshot):
+                    snapshot = self.load()
+        return snapshot
+
+    def load(self):
+        version = self.version
+        bars = Bar.query.options(joinedload(Bar.owner)).all()
+        bartender_ids = set(bar.bartender_on_duty for bar in bars if bar.bartender_on_duty)
+        bartenders = {user.id: UserSnapshot(user) for user in
+                User.query.filter(User.id.in_(bartender_ids)).all()} if bartender_ids else {}
+        configs = OrderedDict()
+        for bar in bars:
+            bartender = bartenders.get(bar.bartender_on_duty)
+            configs[bar.id] = BarConfig(id=bar.id, cname=bar.cname, name=bar.name,
+                    tagline=bar.tagline, owner=UserSnapshot.from_user(bar.owner), bartender=bartender, markup=bar.markup,
+                    prices=bar.prices, stats=bar.stats, examples=bar.examples, convert=bar.convert,
+                    prep_line=bar.prep_line, origin=bar.origin, info=bar.info, variants=bar.variants,
+                    summarize=bar.summarize, is_closed=not bartender, is_public=bar.is_public)
+        snapshot = BarConfigSnapshot(configs=configs, bar_list=list(configs.values()),
+                default_ids=[bar.id for bar in bars if bar.is_default], loaded=time.monotonic())
+        with self.lock:
+            # an invalidate while loading means this may already be stale
+            if self.version == version:
+                self.snapshot = snapshot
+        return snapshot
+
+BarConfigSnapshot = namedtuple("BarConfigSnapshot", "configs,bar_list,default_ids,loaded")
+
+bar_config_cache = BarConfigCache()
+
+def invalidate_bar_config():
+    bar_config_cache.invalidate()
+
 def get_bar_config():
     """ For now, only one bar bay me "active" at a time
     """
-    if 'bar_list' not in g:
-        # HAX just putting it here for now to get initialized
-        g.bar_list = Bar.query.all()
-    if 'current_bar' not in g:
-        bar = None
-        if current_user.is_authenticated and current_user.current_bar_id:
-            bar = Bar.query.filter_by(id=current_user.current_bar_id).one_or_none()
-        if not bar:
-            default_list = Bar.query.filter_by(is_default=True).all()
-            if len(default_list) == 0:
-                flash("No bars currently set to default!", 'danger')
-                raise RuntimeError("No bar set to default in the database - must be at least one.")
-            elif len(default_list) > 1:
-                flash("More than one bar is set to default, using first one", 'danger')
-            bar = default_list[0]
-        bartender = User.query.filter_by(id=bar.bartender_on_duty).one_or_none()
-        g.current_bar = BarConfig(id=bar.id, cname=bar.cname, name=bar.name,
-                tagline=bar.tagline, owner=bar.owner, bartender=bartender, markup=bar.markup,
-                prices=bar.prices, stats=bar.stats, examples=bar.examples, convert=bar.convert,
-                prep_line=bar.prep_line, origin=bar.origin, info=bar.info, variants=bar.variants,
-                summarize=bar.summarize, is_closed=not bartender, is_public=bar.is_public)
+    if 'bar_list' not in g or 'current_bar' not in g:
+        with profiler.stage('bar_config'):
+            snapshot = bar_config_cache.get()
+            bar = None
+            if current_user.is_authenticated and current_user.current_bar_id:
+                bar = snapshot.configs.get(current_user.current_bar_id)
+            if not bar:
+                if len(snapshot.default_ids) == 0:
+                    flash("No bars currently set to default!", 'danger')
+                    raise RuntimeError("No bar set to default in the database - must be at least one.")
+                elif len(snapshot.default_ids) > 1:
+                    flash("More than one bar is set to default, using first one", 'danger')
+                bar = snapshot.configs[snapshot.default_ids[0]]
+            g.bar_list = snapshot.bar_list
+            g.current_bar = bar
     return g.current_bar
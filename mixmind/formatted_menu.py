@@ -1,5 +1,5 @@
 import pylatex.config
-from pylatex.base_classes import Environment, CommandBase, Arguments, Options
+from pylatex.base_classes import Environment, CommandBase, Arguments, Options, LatexObject, Container
 from pylatex.package import Package
 from pylatex import Document, Command, Section, Subsection, Subsubsection, MiniPage, \
         LineBreak, VerticalSpace, HorizontalSpace, Head, Foot, PageStyle, Center, Itemize, HFill, \
@@ -7,6 +7,15 @@ from pylatex import Document, Command, Section, Subsection, Subsubsection, MiniP
         FootnoteText, SmallText, MediumText, LargeText, HugeText
 from pylatex.utils import italic, bold, NoEscape
 import time
+import os
+import re
+import glob
+import shutil
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from . import util
 from .logger import get_logger
@@ -48,12 +57,22 @@ def superscript(item):
     return Superscript(arguments=item)
 
 
-def append_liquor_list(doc, df, own_page):
-    # TODO no interaction with dataframe?
-    kinds = df[df.Category.isin(['Spirit', 'Vermouth', 'Liqueur'])][['Kind', 'Type']]
-    if own_page:
-        log.info("Appending list as new page")
-        doc.append(NewPage())
+LIQUOR_LIST_CATEGORIES = ['Spirit', 'Vermouth', 'Liqueur']
+
+def liquor_list_rows(ingredients):
+    """ (Kind, Type) of the ingredients to show in the liquor list
+    ingredients is a barstock dataframe or a list of stock rows
+    """
+    if ingredients is None:
+        return []
+    if hasattr(ingredients, 'Category'): # dataframe
+        kinds = ingredients[ingredients.Category.isin(LIQUOR_LIST_CATEGORIES)]
+        return list(zip(kinds.Kind, kinds.Type))
+    return [(row.Kind, row.Type) for row in ingredients if row.Category in LIQUOR_LIST_CATEGORIES]
+
+def format_liquor_list(kinds, own_page):
+    """ Return the list of (Kind, Type) in a samepage
+    """
     listing = SamepageEnvironment()
     block = Center()
     if not own_page:
@@ -67,17 +86,55 @@ def append_liquor_list(doc, df, own_page):
 
     cols = add_paracols_environment(listing, 2, '8pt', sloppy=False)
     with cols.create(FlushRight()):
-        for item in kinds.Kind:
+        for item, _ in kinds:
             cols.append(LargeText(item))
             cols.append(Command('\\'))
     cols.append(Command('switchcolumn'))
     with cols.create(FlushLeft()):
-        for item in kinds.Type:
+        for _, item in kinds:
             cols.append(LargeText(italic(item)))
             cols.append(Command('\\'))
+    return listing
+
+def append_liquor_list(doc, kinds, own_page):
+    if own_page:
+        log.info("Appending list as new page")
+        doc.append(NewPage())
+    key = ('liquor list', tuple(kinds), own_page)
+    doc.append(cached_fragment(key, lambda: format_liquor_list(kinds, own_page)))
+
 
-    doc.append(listing)
+class TexFragment(LatexObject):
+    """ LaTeX rendered earlier, with the packages its content needs
+    """
+    def __init__(self, tex, packages=()):
+        super().__init__()
+        self.tex = tex
+        for package in packages:
+            self.packages.add(package)
+
+    def dumps(self):
+        return self.tex
+
+# rendered (LaTeX, packages) of recipes and liquor lists
+fragment_cache = util.LRUCache(8 * 1024 * 1024, sizeof=lambda value: len(value[0]))
 
+def cached_fragment(key, build):
+    """ TexFragment of the pylatex object build() returns, cached under key
+    """
+    def render():
+        latex_object = build()
+        tex = latex_object.dumps()
+        if isinstance(latex_object, Container):
+            latex_object._propagate_packages()
+        return tex, tuple(latex_object.packages)
+    return TexFragment(*fragment_cache.get_or_create(key, render))
+
+def recipe_fragment(recipe, display_opts, digest=None):
+    """ format_recipe as a TexFragment, cached by the recipe's content and the display options
+    """
+    key = (digest or recipe_digest(recipe), display_opts)
+    return cached_fragment(key, lambda: format_recipe(recipe, display_opts))
 
 def format_recipe(recipe, display_opts):
     """ Return the recipe in a paragraph in a samepage
@@ -102,8 +159,8 @@ def format_recipe(recipe, display_opts):
 
     if display_opts.info and recipe.info:
         recipe_page.append(SmallText(italic(recipe.info +'\n')))
-    for item in recipe.ingredients:
-        recipe_page.append(item.str() +'\n')
+    for ingredient_line in recipe.ingredient_lines():
+        recipe_page.append(ingredient_line +'\n')
 
     if display_opts.variants:
         for variant in recipe.variants:
@@ -149,12 +206,12 @@ def setup_header_footer(doc, pdf_opts, display_opts):
     doc.change_document_style("schubarheaderfooter")
 
 
-def generate_recipes_pdf(recipes, pdf_opts, display_opts, ingredient_df):
-    """ Generate a .tex and .pef from the recipes given
+def menu_document(recipes, pdf_opts, display_opts, ingredient_df, digests=None):
+    """ Assemble the pylatex Document of the menu from cached fragments
     recipes is an ordered list of RecipeTuple namedtuples
+    ingredient_df is a barstock dataframe or a list of stock rows for the liquor list
+    digests are the recipe_digest of each recipe, if already known
     """
-
-    log.info("Generating {}.tex".format(pdf_opts.pdf_filename))
     pylatex.config.active = pylatex.config.Version1(indent=False)
 
     # Determine some settings based on the number of cols
@@ -196,8 +253,9 @@ def generate_recipes_pdf(recipes, pdf_opts, display_opts, ingredient_df):
 
     # Columns setup and fill
     paracols = add_paracols_environment(doc, pdf_opts.ncols, colsep, sloppy=False)
-    for i, recipe in enumerate(recipes, 1):
-        paracols.append(format_recipe(recipe, display_opts))
+    digests = digests or [None] * len(recipes)
+    for i, (recipe, digest) in enumerate(zip(recipes, digests), 1):
+        paracols.append(recipe_fragment(recipe, display_opts, digest))
         switch = 'switchcolumn'
         if pdf_opts.align:
             switch += '*' if (i % pdf_opts.ncols) == 0 else ''
@@ -205,14 +263,38 @@ def generate_recipes_pdf(recipes, pdf_opts, display_opts, ingredient_df):
 
     # append a page on the ingredients
     if pdf_opts.liquor_list or pdf_opts.liquor_list_own_page:
-        append_liquor_list(doc, ingredient_df, own_page=pdf_opts.liquor_list_own_page)
-
-    log.info("Compiling {}.pdf".format(pdf_opts.pdf_filename))
-    doc.generate_pdf(pdf_opts.pdf_filename, clean_tex=False)
+        append_liquor_list(doc, liquor_list_rows(ingredient_df), own_page=pdf_opts.liquor_list_own_page)
+    return doc
+
+def compile_menu(doc, filename, previous=None):
+    """ Write filename.tex and compile it to filename.pdf
+    pdflatex is skipped when the .tex is the same as the one the pdf at previous
+    (default filename) was built from, that pdf is used instead
+    :returns: True if pdflatex was run
+    """
+    previous = previous or filename
+    tex = doc.dumps()
+    try:
+        with open('{}.tex'.format(previous), encoding='utf-8') as fp:
+            unchanged = fp.read() == tex and os.path.exists('{}.pdf'.format(previous))
+    except OSError:
+        unchanged = False
+    if unchanged:
+        log.info("{}.tex is unchanged, using {}.pdf".format(filename, previous))
+        try:
+            if previous != filename:
+                for ext in ('tex', 'pdf'):
+                    shutil.copyfile('{}.{}'.format(previous, ext), '{}.{}'.format(filename, ext))
+            return False
+        except OSError as e:
+            # removed from the cache in the meantime
+            log.info("{}, compiling instead".format(e))
+    log.info("Compiling {}.pdf".format(filename))
+    doc.generate_pdf(filename, clean_tex=False)
     log.info("Done")
     return True
 
-def filename_from_options(pdf_opts, display_opts, base_name='drinks'):
+def filename_from_options(pdf_opts, display_opts, base_name='drinks', content_hash=None):
     opts_tag = "{}c".format(pdf_opts.ncols)
     opts_tag += 'l' if pdf_opts.liquor_list else ''
     opts_tag += 'L' if pdf_opts.liquor_list_own_page else ''
@@ -225,5 +307,223 @@ def filename_from_options(pdf_opts, display_opts, base_name='drinks'):
     opts_tag += 'p' if display_opts.prep_line else ''
     opts_tag += 'v' if display_opts.variants else ''
     opts_tag += 'o' if display_opts.origin else ''
-    return '_'.join([base_name, opts_tag])
+    parts = [base_name, opts_tag]
+    if content_hash:
+        parts.append(content_hash[:16])
+    return '_'.join(parts)
+
+def recipe_digest(recipe):
+    """ Hash of everything format_recipe may show for the recipe """
+    content = (recipe.name, recipe.unit, recipe.origin, recipe.info, recipe.max_cost,
+            recipe.prep_line(extended=True, caps=False), tuple(recipe.ingredient_lines()),
+            tuple(recipe.variants), tuple(tuple(example) for example in recipe.examples))
+    return hashlib.sha1(repr(content).encode('utf-8')).hexdigest()
+
+def menu_cache_key(recipes, pdf_opts, display_opts, liquor_list=(), digests=None):
+    """ Content hash of a menu pdf, the same recipes, options and liquor list
+    give the same pdf. The header shows the date, so the key changes daily too
+    """
+    key = hashlib.sha1()
+    # pdf_filename is only where it's written
+    key.update(repr((tuple(pdf_opts._replace(pdf_filename=None)), tuple(display_opts),
+        tuple(liquor_list), time.strftime("%Y-%m-%d"))).encode('utf-8'))
+    for digest in (digests or map(recipe_digest, recipes)):
+        key.update(digest.encode('ascii'))
+    return key.hexdigest()
+
+
+class PdfJob(object):
+    """ A menu pdf being built by the MenuPdfQueue, its id is the content key
+    status goes queued -> running -> done or failed
+    """
+    def __init__(self, key, filename, status='queued'):
+        self.id = key
+        self.key = key
+        self.filename = filename # without .pdf
+        self.status = status
+        self.error = None
+        self.compiled = False
+        self.created = time.time()
+        self.finished = self.created if status == 'done' else None
+        self._done = threading.Event()
+        if status == 'done':
+            self._done.set()
+
+    @property
+    def pdf_file(self):
+        return '{}.pdf'.format(self.filename)
+
+    def wait(self, timeout=None):
+        """ Block until the job finishes, returns True if the pdf is ready """
+        self._done.wait(timeout)
+        return self.status == 'done'
+
+    def _finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def as_dict(self):
+        return {'job_id': self.id, 'status': self.status, 'error': self.error, 'compiled': self.compiled,
+                'filename': os.path.basename(self.pdf_file),
+                'seconds': (self.finished or time.time()) - self.created}
+
+
+# a job id is the menu_cache_key, a sha1
+JOB_ID = re.compile(r'^[0-9a-f]{40}$')
+
+class MenuPdfQueue(object):
+    """ Builds menu pdfs on a bounded pool of worker threads
+    Finished pdfs are kept in cache_dir under the menu_cache_key of their
+    content, so asking for the same menu again is served from disk, and
+    jobs asked for while the same menu is being built share that build.
+    A build whose .tex matches the last build of the same options reuses its pdf
+    Jobs are known only to the process building them, others find them in
+    cache_dir by their id. After each build the least recently used pdfs
+    beyond max_files, and any older than max_age seconds, are removed
+    """
+    def __init__(self, cache_dir='menus', workers=2, max_jobs=256, max_files=200, max_age=7*24*3600):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_files = max_files
+        self.max_age = max_age
+        self.jobs = OrderedDict()
+        self.building = {}
+        self.last_builds = {} # filename_from_options -> last built filename
+        self.lock = threading.Lock()
+        self._executor = None
+
+    def init_app(self, app):
+        self.cache_dir = app.config.get('MIXMIND_PDF_CACHE_DIR', self.cache_dir)
+        self.workers = app.config.get('MIXMIND_PDF_WORKERS', self.workers)
+        self.max_files = app.config.get('MIXMIND_PDF_CACHE_MAX_FILES', self.max_files)
+        self.max_age = app.config.get('MIXMIND_PDF_CACHE_MAX_AGE', self.max_age)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def submit(self, recipes, pdf_opts, display_opts, ingredient_df=None):
+        """ Queue a pdf of the menu, returns the PdfJob
+        The job is already done if the pdf is cached, pdf_opts.pdf_filename
+        is used as the base name in the cache dir
+        """
+        liquor_list = liquor_list_rows(ingredient_df) if (pdf_opts.liquor_list or pdf_opts.liquor_list_own_page) else []
+        digests = [recipe_digest(recipe) for recipe in recipes]
+        key = menu_cache_key(recipes, pdf_opts, display_opts, liquor_list, digests)
+        base_name = os.path.basename(pdf_opts.pdf_filename or 'drinks')
+        options_name = filename_from_options(pdf_opts, display_opts, base_name)
+        filename = os.path.join(self.cache_dir, filename_from_options(pdf_opts, display_opts, base_name, content_hash=key))
+        with self.lock:
+            job = self.building.get(key)
+            if job is None:
+                if os.path.exists('{}.pdf'.format(filename)):
+                    job = PdfJob(key, filename, status='done')
+                    self._touch(job)
+                else:
+                    job = PdfJob(key, filename)
+                    self.building[key] = job
+                    self.executor.submit(self._build, job, options_name, list(recipes), digests, pdf_opts, display_opts, ingredient_df)
+            self._remember(job)
+        return job
+
+    def get(self, job_id):
+        """ The PdfJob, or for a job of another process one made from what is
+        in cache_dir, None if not found
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None or not JOB_ID.match(job_id):
+            return job
+        pattern = os.path.join(glob.escape(self.cache_dir), '*_{}'.format(job_id[:16]))
+        finished = glob.glob('{}.pdf'.format(pattern))
+        if finished:
+            return PdfJob(job_id, finished[0][:-len('.pdf')], status='done')
+        building = glob.glob('{}-tmp-*.tex'.format(pattern))
+        if building:
+            return PdfJob(job_id, building[0].split('-tmp-')[0], status='running')
+        return None
+
+    def _remember(self, job):
+        self.jobs[job.id] = job
+        self.jobs.move_to_end(job.id)
+        while len(self.jobs) > self.max_jobs:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.status not in ('done', 'failed'):
+                break
+            self.jobs.popitem(last=False)
+
+    def _build(self, job, options_name, recipes, digests, pdf_opts, display_opts, ingredient_df):
+        job.status = 'running'
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # build under a name of its own, readers only ever see a finished pdf
+        tmp_filename = '{}-tmp-{}'.format(job.filename, uuid.uuid4().hex[:12])
+        try:
+            doc = menu_document(recipes, pdf_opts, display_opts, ingredient_df, digests)
+            job.compiled = compile_menu(doc, tmp_filename, previous=self.last_builds.get(options_name))
+            os.replace('{}.tex'.format(tmp_filename), '{}.tex'.format(job.filename))
+            os.replace('{}.pdf'.format(tmp_filename), job.pdf_file)
+        except Exception as e:
+            log.exception("Failed to build {}".format(job.pdf_file))
+            for ext in ('tex', 'pdf'):
+                try:
+                    os.remove('{}.{}'.format(tmp_filename, ext))
+                except OSError:
+                    pass
+            job._finish('failed', "{}: {}".format(e.__class__.__name__, e))
+        else:
+            self.last_builds[options_name] = job.filename
+            job._finish('done')
+        finally:
+            with self.lock:
+                self.building.pop(job.key, None)
+        try:
+            self._evict()
+        except OSError as e:
+            log.warning("Failed to clean up {}: {}".format(self.cache_dir, e))
+
+    def _touch(self, job):
+        """ Mark a cached pdf as used, for eviction """
+        try:
+            os.utime(job.pdf_file)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """ Remove the least recently used menus beyond max_files and those older
+        than max_age, along with leftovers of builds that died
+        """
+        now = time.time()
+        used = {} # file name without extension -> last modified
+        for name in os.listdir(self.cache_dir):
+            base, ext = os.path.splitext(name)
+            if ext not in ('.pdf', '.tex'):
+                continue
+            try:
+                modified = os.path.getmtime(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            used[base] = max(modified, used.get(base, 0))
+        finished = sorted((base for base in used if '-tmp-' not in base), key=used.get, reverse=True)
+        evict = set(base for i, base in enumerate(finished) if i >= self.max_files or now - used[base] > self.max_age)
+        evict.update(base for base in used if '-tmp-' in base and now - used[base] > self.max_age)
+        with self.lock:
+            evict.difference_update(os.path.basename(job.filename) for job in self.building.values())
+            for options_name, filename in list(self.last_builds.items()):
+                if os.path.basename(filename) in evict:
+                    del self.last_builds[options_name]
+        for base in evict:
+            for ext in ('pdf', 'tex'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, '{}.{}'.format(base, ext)))
+                except OSError:
+                    pass
+        if evict:
+            log.info("Removed {} menus from {}".format(len(evict), self.cache_dir))
+
+pdf_queue = MenuPdfQueue()
 
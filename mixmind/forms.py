@@ -5,6 +5,7 @@ from wtforms import validators, widgets, Form, Field, FormField, FieldList, Text
 from flask import g
 
 from .models import User
+from .configuration_management import UserSnapshot
 from .util import VALID_UNITS
 
 # TODO refactor with flask_wtf which presets form csrfs (or roll my own I guess)
@@ -113,6 +114,13 @@ class EmailField(TextField):
 def pairs(l):
     return [(x,x) for x in l]
 
+def user_email_choices():
+    """ (email, User.get_name_with_email()) of every user, after a blank choice
+    Loads only the columns the name needs rather than a User per row
+    """
+    users = User.query.with_entities(User.id, User.email, User.first_name, User.last_name, User.nickname)
+    return [('', '')]+[(user.email, UserSnapshot(user).get_name_with_email()) for user in users]
+
 class DrinksForm(BaseForm):
     # display options
     prices = BooleanField("Prices", description="Display prices for drinks based on stock")
@@ -232,8 +240,7 @@ class CreateBarForm(BaseForm):
 class EditBarForm(BaseForm):
     def __init__(self, *args, **kwargs):
         super(EditBarForm, self).__init__(*args, **kwargs)
-        choices = [('', '')]+[(user.email, user.get_name_with_email()) for user in User.query.all()]
-        self.bartender.choices = choices
+        self.bartender.choices = user_email_choices()
     name = TextField("Bar Name", description="Display name for the bar")
     tagline = TextField("Tagline", description="Tag line or slogan for the bar")
 
@@ -272,7 +279,6 @@ class EditBarForm(BaseForm):
 class SetBarOwnerForm(BaseForm):
     def __init__(self, *args, **kwargs):
         super(SetBarOwnerForm, self).__init__(*args, **kwargs)
-        choices = [('', '')]+[(user.email, user.get_name_with_email()) for user in User.query.all()]
-        self.owner.choices = choices
+        self.owner.choices = user_email_choices()
     owner = SelectField("Assign Bar Owner", description="Assign an owner who can manage the bar's stock and settings", choices=[])
     submit = SubmitField("Commit Changes", render_kw={"class": "btn btn-primary"})
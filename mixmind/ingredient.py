@@ -4,7 +4,7 @@ import urllib.request, urllib.parse, urllib.error
 import copy
 import uuid
 
-from sqlalchemy import Boolean, DateTime, Column, Integer, ForeignKey, Enum, Float, Unicode
+from sqlalchemy import Boolean, DateTime, Column, Integer, ForeignKey, Enum, Float, Unicode, Index
 from sqlalchemy_utils import UUIDType
 
 from . import util
@@ -34,7 +34,13 @@ display_name_mappings = {
 
 # TODO value constraints (e.g. 100% max abv, no negative price, etc.)
 class Ingredient(db.Model):
-    uuid       = Column(UUIDType(), default=uuid.uuid4)
+    __table_args__ = (
+        # StockIndex.load: the bar's in stock rows in (Type, Kind) order
+        Index('ix_ingredient_bar_id_in_stock', 'bar_id', 'In_Stock', 'Type', 'Kind'),
+        # the ingredient table and api, sorted by category
+        Index('ix_ingredient_bar_id_category', 'bar_id', 'Category', 'Type'),
+    )
+    uuid       = Column(UUIDType(), default=uuid.uuid4, unique=True, index=True)
     bar_id     = Column(Integer(), ForeignKey('bar.id'), primary_key=True)
     Category   = Column(Enum(*Categories))
     Type       = Column(Unicode(length=100), primary_key=True)
@@ -0,0 +1,53 @@
+"""Indexes for hot queries
+
+Revision ID: 3b8f2c1d9a4e
+Revises:
+Create Date: 2026-10-18 18:00:00
+
+Databases created by db.create_all() after the models declared these
+already have them, so only missing indexes are created.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8f2c1d9a4e'
+down_revision = None
+branch_labels = ('default',)
+depends_on = None
+
+# (table, name, columns, unique)
+INDEXES = [
+    ('ingredient', 'ix_ingredient_uuid', ['uuid'], True),
+    ('ingredient', 'ix_ingredient_bar_id_in_stock', ['bar_id', 'In_Stock', 'Type', 'Kind'], False),
+    ('ingredient', 'ix_ingredient_bar_id_category', ['bar_id', 'Category', 'Type'], False),
+    ('order', 'ix_order_bar_id', ['bar_id'], False),
+    ('order', 'ix_order_user_id', ['user_id'], False),
+    ('order', 'ix_order_user_email', ['user_email'], False),
+    ('order_rollup', 'ix_order_rollup_hour', ['hour'], False),
+    ('order_latency_rollup', 'ix_order_latency_rollup_hour', ['hour'], False),
+]
+
+
+def _existing_indexes(inspector, table):
+    if table not in inspector.get_table_names():
+        return None
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table, name, columns, unique in INDEXES:
+        existing = _existing_indexes(inspector, table)
+        if existing is None or name in existing:
+            continue
+        op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table, name, columns, unique in reversed(INDEXES):
+        existing = _existing_indexes(inspector, table)
+        if existing and name in existing:
+            op.drop_index(name, table_name=table)
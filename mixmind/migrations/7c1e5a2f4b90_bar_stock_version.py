@@ -0,0 +1,38 @@
+"""Stock version of each bar
+
+Revision ID: 7c1e5a2f4b90
+Revises: 3b8f2c1d9a4e
+Create Date: 2026-10-18 19:00:00
+
+Databases created by db.create_all() after the model declared it
+already have the column, so it is only added when missing.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5a2f4b90'
+down_revision = '3b8f2c1d9a4e'
+branch_labels = None
+depends_on = None
+
+
+def _existing_columns(inspector, table):
+    if table not in inspector.get_table_names():
+        return None
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    existing = _existing_columns(sa.inspect(op.get_bind()), 'bar')
+    if existing is None or 'stock_version' in existing:
+        return
+    op.add_column('bar', sa.Column('stock_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    existing = _existing_columns(sa.inspect(op.get_bind()), 'bar')
+    if existing and 'stock_version' in existing:
+        with op.batch_alter_table('bar') as batch_op:
+            batch_op.drop_column('stock_version')
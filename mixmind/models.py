@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy import Boolean, DateTime, Column, Integer, String, ForeignKey, Enum, Float, Text, Unicode
+from sqlalchemy import Boolean, DateTime, Column, Integer, String, ForeignKey, Enum, Float, Text, Unicode, UniqueConstraint
 
 import pendulum
 
@@ -62,14 +62,14 @@ class User(db.Model, UserMixin):
 
 class Order(db.Model):
     id = Column(Integer, primary_key=True)
-    bar_id = Column(Integer, ForeignKey('bar.id'))
-    user_id = Column(Integer, ForeignKey('user.id'))
+    bar_id = Column(Integer, ForeignKey('bar.id'), index=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     bartender_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', back_populates="orders", foreign_keys=[user_id])
     bartender = relationship('User', back_populates="orders_served", foreign_keys=[bartender_id])
     timestamp = Column(DateTime())
     confirmed = Column(DateTime())
-    user_email = Column(Unicode(length=127))
+    user_email = Column(Unicode(length=127), index=True)
     recipe_name = Column(Unicode(length=127))
     recipe_html = Column(Text())
 
@@ -85,6 +85,24 @@ class Order(db.Model):
         return "{} minutes, {} seconds".format(diff.minutes, diff.remaining_seconds)
 
 
+class OutgoingMail(db.Model):
+    """ Outbox of emails waiting to be delivered by notifier.MailOutbox """
+    id = Column(Integer, primary_key=True)
+    sender = Column(Unicode(length=127))
+    recipient = Column(Unicode(length=127))
+    subject = Column(Unicode(length=255))
+    html = Column(Text())
+    template = Column(String(63)) # for logging
+    status = Column(Enum('pending', 'sending', 'sent', 'failed'), default='pending', index=True)
+    created = Column(DateTime())
+    send_after = Column(DateTime()) # not before this time, for retry backoff
+    attempts = Column(Integer(), default=0)
+    claim = Column(String(36)) # id of the worker pass sending it
+    claimed_at = Column(DateTime())
+    sent_at = Column(DateTime())
+    last_error = Column(Unicode(length=255))
+
+
 class Bar(db.Model):
     id = Column(Integer(), primary_key=True)
     cname = Column(Unicode(length=63), unique=True) # unique name for finding the bar
@@ -97,6 +115,7 @@ class Bar(db.Model):
     owner = relationship('User', back_populates="owns", foreign_keys=[owner_id])
     ingredients = relationship('Ingredient') # one to many
     orders = relationship('Order') # one to many
+    stock_version = Column(Integer(), nullable=False, default=0, server_default='0') # bumped with each change to the ingredients
     # browse display settings
     markup     =  Column(Float(),    default=1.10)
     prices     =  Column(Boolean(),  default=True)
@@ -120,3 +139,26 @@ class Bartenders(db.Model):
     user_id = Column(Integer(), ForeignKey('user.id'))
     bar_id = Column(Integer(), ForeignKey('bar.id'))
 
+
+class OrderRollup(db.Model):
+    """ Orders placed per bar, bartender and hour, kept up to date by analytics.py
+    confirmations count in the hour the order was placed
+    """
+    __table_args__ = (UniqueConstraint('bar_id', 'bartender_id', 'hour'),)
+    id = Column(Integer(), primary_key=True)
+    bar_id = Column(Integer(), nullable=False)
+    bartender_id = Column(Integer(), nullable=False) # 0 when unknown
+    hour = Column(DateTime(), nullable=False, index=True) # utc, truncated to the hour
+    orders = Column(Integer(), default=0, nullable=False)
+    confirmed = Column(Integer(), default=0, nullable=False)
+    latency_total = Column(Float(), default=0.0, nullable=False) # seconds, sum over confirmed orders
+
+class OrderLatencyRollup(db.Model):
+    """ Histogram of seconds to confirm per OrderRollup key, see analytics.LATENCY_BUCKETS """
+    __table_args__ = (UniqueConstraint('bar_id', 'bartender_id', 'hour', 'bucket'),)
+    id = Column(Integer(), primary_key=True)
+    bar_id = Column(Integer(), nullable=False)
+    bartender_id = Column(Integer(), nullable=False)
+    hour = Column(DateTime(), nullable=False, index=True)
+    bucket = Column(Integer(), nullable=False)
+    count = Column(Integer(), default=0, nullable=False)
@@ -3,19 +3,29 @@
 This implements a notification system via email
 """
 import json
+import re
+import time
 import smtplib
+import threading
+import datetime
+import uuid
 from email.mime.text import MIMEText
 
-from flask import render_template
+from flask import render_template, g, has_request_context, after_this_request
 from flask_mail import Mail, Message
+from sqlalchemy import or_, and_
 mail = Mail()
 
 from . import app
+from .database import db
+from .models import OutgoingMail
 from .logger import get_logger
 log = get_logger(__name__)
 
 def send_mail(subject, recipient, template, **context):
     """Send an email via the Flask-Mail extension.
+    Unless MIXMIND_MAIL_OUTBOX is off, the email is only queued in the outbox here,
+    and goes out once the request succeeds, see MailOutbox
 
     :param subject: Email subject
     :param recipient: Email recipient
@@ -26,6 +36,9 @@ def send_mail(subject, recipient, template, **context):
 
     ctx = ('email', template)
     msg.html = render_template('%s/%s.html' % ctx, **context)
+    if app.config.get('MIXMIND_MAIL_OUTBOX', True):
+        outbox.enqueue(msg, template)
+        return True
     try:
         mail.send(msg)
     except Exception as e:
@@ -34,11 +47,180 @@ def send_mail(subject, recipient, template, **context):
     else:
         return True
 
+def _commit_outbox(response):
+    """ Save the emails the request queued, then wake the workers
+    Flask also runs this on the error response of a view that raised, those emails are dropped
+    """
+    queued = g.pop('mail_queued', [])
+    if response.status_code >= 400:
+        return response
+    try:
+        outbox.save(queued)
+    except Exception as e:
+        log.error("{} saving queued emails: {}".format(e.__class__.__name__, e))
+    outbox.wake()
+    return response
+
+class MailOutbox(object):
+    """ Emails are stored as OutgoingMail rows and delivered by a pool of worker threads
+    - mail queued in a request is saved after the view returns, and only if it
+      succeeded, in a session of its own so the request's pending changes aren't
+      committed along with it
+    - each worker claims a batch of due rows and sends them over one SMTP connection
+    - failures are retried with exponential backoff, and marked failed after MIXMIND_MAIL_RETRIES
+    - delivery is at least once: rows claimed by a worker that died are sent again
+      after MIXMIND_MAIL_STALE seconds
+    """
+    def __init__(self):
+        self.app = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('MIXMIND_MAIL_WORKERS', 2)
+        self.batch_size = app.config.get('MIXMIND_MAIL_BATCH', 50)
+        self.retries = app.config.get('MIXMIND_MAIL_RETRIES', 5)
+        self.retry_delay = app.config.get('MIXMIND_MAIL_RETRY_DELAY', 30)
+        self.poll_interval = app.config.get('MIXMIND_MAIL_POLL', 10)
+        self.stale_after = app.config.get('MIXMIND_MAIL_STALE', 600)
+        if app.config.get('MIXMIND_MAIL_OUTBOX', True):
+            # pick up anything left from a previous run
+            app.before_first_request(self.start)
+
+    def enqueue(self, msg, template=None):
+        """ Add a flask_mail Message to the outbox
+        In a request it's saved once the request succeeds, otherwise right away
+        """
+        outgoing = OutgoingMail(sender=msg.sender, recipient=msg.recipients[0], subject=msg.subject,
+                html=msg.html, template=template, status='pending', attempts=0,
+                created=datetime.datetime.utcnow(), send_after=datetime.datetime.utcnow())
+        if has_request_context():
+            if 'mail_queued' not in g:
+                g.mail_queued = []
+                after_this_request(_commit_outbox)
+            g.mail_queued.append(outgoing)
+        else:
+            self.save([outgoing])
+            self.wake()
+        return outgoing
+
+    def save(self, rows):
+        """ Commit OutgoingMail rows in their own session, leaving db.session alone """
+        if not rows:
+            return
+        session = db.create_session({'expire_on_commit': False})()
+        try:
+            session.add_all(rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="mixmind-mail-{}".format(len(self.threads)), daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+    def wake(self):
+        self.start()
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            sent = 0
+            with self.app.app_context():
+                try:
+                    sent = self.deliver_batch()
+                except Exception:
+                    log.exception("Mail outbox worker error")
+                finally:
+                    db.session.remove()
+            if not sent:
+                self.wakeup.wait(self.poll_interval)
+
+    def _claim(self, now):
+        """ Mark a batch of due rows as being sent by this pass, returns them """
+        due = or_(and_(OutgoingMail.status == 'pending', OutgoingMail.send_after <= now),
+                  and_(OutgoingMail.status == 'sending', OutgoingMail.claimed_at < now - datetime.timedelta(seconds=self.stale_after)))
+        ids = [row.id for row in db.session.query(OutgoingMail.id).filter(due).order_by(OutgoingMail.id).limit(self.batch_size)]
+        if not ids:
+            db.session.rollback()
+            return []
+        claim = str(uuid.uuid4())
+        # rows another worker claimed in the meantime no longer match
+        OutgoingMail.query.filter(OutgoingMail.id.in_(ids), due).update(
+                {'status': 'sending', 'claim': claim, 'claimed_at': now}, synchronize_session=False)
+        db.session.commit()
+        return OutgoingMail.query.filter_by(claim=claim, status='sending').order_by(OutgoingMail.id).all()
+
+    def deliver_batch(self):
+        """ Send one batch of due mail over a single connection
+        :returns: number of rows attempted
+        """
+        now = datetime.datetime.utcnow()
+        batch = self._claim(now)
+        if not batch:
+            return 0
+        remaining = list(batch)
+        try:
+            with mail.connect() as connection:
+                while remaining:
+                    outgoing = remaining[0]
+                    try:
+                        connection.send(Message(outgoing.subject, sender=outgoing.sender,
+                            recipients=[outgoing.recipient], html=outgoing.html))
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                        # this message only, the connection is still good
+                        self._retry(outgoing, e, now)
+                    except OSError: # includes the other SMTPExceptions
+                        raise
+                    except Exception as e:
+                        self._retry(outgoing, e, now)
+                    else:
+                        outgoing.status = 'sent'
+                        outgoing.sent_at = datetime.datetime.utcnow()
+                    remaining.pop(0)
+        except Exception as e:
+            # lost the connection, the rest wait for the next attempt
+            for outgoing in remaining:
+                self._retry(outgoing, e, now)
+        db.session.commit()
+        log.info("Sent {} of {} queued emails".format(sum(1 for outgoing in batch if outgoing.status == 'sent'), len(batch)))
+        return len(batch)
+
+    def _retry(self, outgoing, error, now):
+        outgoing.attempts = (outgoing.attempts or 0) + 1
+        outgoing.last_error = "{}: {}".format(error.__class__.__name__, error)[:255]
+        outgoing.claim = None
+        if outgoing.attempts >= self.retries:
+            outgoing.status = 'failed'
+            log.error("Giving up on {} email to {}: {}".format(outgoing.template, outgoing.recipient, outgoing.last_error))
+        else:
+            outgoing.status = 'pending'
+            outgoing.send_after = now + datetime.timedelta(seconds=self.retry_delay * 2**(outgoing.attempts-1))
+            log.warning("{} email to {} will be retried: {}".format(outgoing.template, outgoing.recipient, outgoing.last_error))
+
+outbox = MailOutbox()
+
 # note this requires a secrets file to work
 required = ['sender_email', 'sender_pass', 'sender_name', 'target_email']
 
 class Notifier():
-    def __init__(self, secrets_json, message_template):
+    """ Sends the html message_template filled in with message_fill
+    persistent=True keeps the authenticated SMTP connection open between sends,
+    a timer quits it after idle_timeout seconds unused, and it's reopened if the server hung up.
+    Otherwise each send() connects and quits like before, send_many() always shares one connection
+    The secrets file can override the server with smtp_server and smtp_port.
+    STARTTLS is required, "smtp_starttls": false allows a server without it, e.g. a local sink
+    """
+    def __init__(self, secrets_json, message_template, persistent=False, idle_timeout=60):
         with open(secrets_json) as fp:
             self.secrets = json.load(fp)
         for req in required:
@@ -49,36 +231,167 @@ class Notifier():
         self.sender_pass = self.secrets['sender_pass']
         self.sender_name = self.secrets['sender_name']
         self.target_email = self.secrets['target_email']
+        self.smtp_server = self.secrets.get('smtp_server', 'smtp.gmail.com')
+        self.smtp_port = int(self.secrets.get('smtp_port', 587))
+        self.smtp_starttls = self.secrets.get('smtp_starttls', True)
 
         with open(message_template) as fp:
             self.message_template = fp.read()
+        self._fill_parts = {}
 
-    def send(self, subject_line, message_fill, alt_target=None):
-        """ message_fill should be a dict with keys
-        matching fill fields in the base html template
+        self.persistent = persistent
+        self.idle_timeout = idle_timeout
+        self._server = None
+        self._last_used = 0
+        self._idle_timer = None
+        self._lock = threading.RLock()
+
+    def fill_template(self, message_fill):
+        """ Replace every key of message_fill in one pass over the template
+        The template is split around the keys once per set of keys, filling is then a join
         """
+        if not message_fill:
+            return self.message_template
+        keys = tuple(sorted(message_fill))
+        parts = self._fill_parts.get(keys)
+        if parts is None:
+            # longest first so a key that contains another one wins
+            pattern = re.compile('({})'.format('|'.join(re.escape(key) for key in sorted(keys, key=len, reverse=True))))
+            # [text, key, text, key, ..., text]
+            parts = pattern.split(self.message_template)
+            self._fill_parts[keys] = parts
+        filled = parts[:]
+        filled[1::2] = [message_fill[key] for key in parts[1::2]]
+        return ''.join(filled)
+
+    def build_message(self, subject_line, message_fill, alt_target=None):
         target_email = alt_target if alt_target else self.target_email
-        # assemble from template
-        msg = MIMEText(self.message_template, 'html')
+        msg = MIMEText(self.fill_template(message_fill), 'html')
         msg['Subject'] = subject_line
         msg['From'] = self.sender_name
         msg['To'] = target_email
+        return msg
+
+    def _connect(self):
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        try:
+            server.ehlo()
+            if self.smtp_starttls:
+                # raises if the server doesn't offer it, the password is never sent in the clear
+                server.starttls()
+                server.ehlo()
+                server.login(self.sender_email, self.sender_pass)
+            elif server.has_extn('auth'):
+                server.login(self.sender_email, self.sender_pass)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _connection(self):
+        """ The open connection if it's still fresh, else a new one """
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+        if self._server is None:
+            self._server = self._connect()
+            self._last_used = time.monotonic()
+            if self.persistent:
+                self._close_when_idle(self.idle_timeout)
+        return self._server
+
+    def _close_when_idle(self, delay):
+        """ One timer per connection, it checks back in delay seconds and
+        re-arms itself for the rest of idle_timeout if the connection was used since
+        """
+        self._idle_timer = threading.Timer(delay, self._close_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _close_if_idle(self):
+        with self._lock:
+            if threading.current_thread() is not self._idle_timer or self._server is None:
+                # the connection it was armed for is already gone
+                return
+            idle = time.monotonic() - self._last_used
+            if idle >= self.idle_timeout:
+                log.info("Closing SMTP connection idle for {:.0f}s".format(idle))
+                self.close()
+            else:
+                self._close_when_idle(self.idle_timeout - idle)
+
+    def _sendmail(self, msg):
+        """ Send on the current connection, reconnecting once if the server dropped it """
+        for attempt in (1, 2):
+            server = self._connection()
+            try:
+                server.sendmail(self.sender_email, [msg['To']], msg.as_string())
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._discard()
+                if attempt == 2:
+                    raise
+                log.info("SMTP connection lost ({}), reconnecting".format(e))
+            else:
+                self._last_used = time.monotonic()
+                return
 
-        body = msg.get_payload()
-        for key, value in message_fill.items():
-            body = body.replace(key, value)
-        msg.set_payload(body)
-
-        # send via gmail
-        server = smtplib.SMTP('smtp.gmail.com',587)
-        server.ehlo()
-        server.starttls()
-        server.ehlo()
-        server.login(self.sender_email, self.sender_pass)
-        server.sendmail(self.sender_email, [target_email], msg.as_string())
-        server.close()
+    def _discard(self):
+        try:
+            self._server.close()
+        except Exception:
+            pass
+        self._server = None
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def close(self):
+        """ Quit the open connection, if any """
+        with self._lock:
+            if self._server is None:
+                return
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                pass
+            self._discard()
+
+    def send(self, subject_line, message_fill, alt_target=None):
+        """ message_fill should be a dict with keys
+        matching fill fields in the base html template
+        """
+        msg = self.build_message(subject_line, message_fill, alt_target)
+        with self._lock:
+            try:
+                self._sendmail(msg)
+            finally:
+                if not self.persistent:
+                    self.close()
         return msg
 
+    def send_many(self, messages):
+        """ Send several messages over one connection
+        messages is an iterable of (subject_line, message_fill) or
+        (subject_line, message_fill, alt_target) tuples
+        :returns: the sent messages
+        """
+        sent = []
+        with self._lock:
+            try:
+                for args in messages:
+                    msg = self.build_message(*args)
+                    self._sendmail(msg)
+                    sent.append(msg)
+            finally:
+                if not self.persistent:
+                    self.close()
+        return sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def test_main():
     n = Notifier('secrets.json', 'simpler_email_template.html')
     n.send("A customer has ordered - Martini",
@@ -0,0 +1,344 @@
+"""
+Per-request timing of the stages of a request and its SQL queries
+- views and hot functions mark stages with profiler.stage(name) or @profiler.timed(name)
+- SQL statements and Jinja rendering are timed through SQLAlchemy and Flask signals
+- each response gets a Server-Timing header, and recent requests are kept per
+  route for the percentiles at /api/admin/profile
+When disabled, stage() and timed() return right away and nothing is hooked up
+
+Also query accounting for development and tests
+- query_watcher logs requests that repeat a statement, the mark of an N+1 lazy load
+- query_budget() fails a block that runs more statements than allowed
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .logger import get_logger
+log = get_logger(__name__)
+
+PERCENTILES = [50, 95, 99]
+
+class RequestProfile(object):
+    """ Stage timings and query counts of one request """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict() # name -> [seconds, calls]
+        self.active = set()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.render_start = None
+
+    def add(self, name, seconds):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [seconds, 1]
+        else:
+            stage[0] += seconds
+            stage[1] += 1
+
+    def server_timing(self, total):
+        """ Value of the Server-Timing header, durations in ms """
+        metrics = ['{};dur={:.2f}'.format(name, seconds * 1000) for name, (seconds, _) in self.stages.items()]
+        metrics.append('sql;desc="{} queries";dur={:.2f}'.format(self.queries, self.query_seconds * 1000))
+        metrics.append('total;dur={:.2f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+class _Stage(object):
+    """ Times a block into a stage of the profile, nested blocks of the same stage
+    are counted once
+    """
+    __slots__ = ('profile', 'name', 'start')
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.name not in self.profile.active:
+            self.profile.active.add(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.profile.add(self.name, time.perf_counter() - self.start)
+            self.profile.active.discard(self.name)
+
+class _NullStage(object):
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
+
+NULL_STAGE = _NullStage()
+
+def _percentile(ordered, p):
+    """ Nearest rank percentile of a sorted list """
+    if not ordered:
+        return None
+    rank = max(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def _summary(values):
+    ordered = sorted(round(value, 3) for value in values)
+    summary = {'p{}'.format(p): _percentile(ordered, p) for p in PERCENTILES}
+    summary['mean'] = round(sum(ordered) / len(ordered), 3) if ordered else None
+    summary['max'] = ordered[-1] if ordered else None
+    return summary
+
+class RequestProfiler(object):
+    """ Collects a RequestProfile for every request while enabled, and keeps
+    the last max_samples of them per route
+    """
+    def __init__(self, max_samples=500):
+        self.enabled = False
+        self.max_samples = max_samples
+        self.samples = {} # "METHOD rule" -> deque of (total, {stage: seconds}, queries, query_seconds)
+        self.lock = threading.Lock()
+        # profile of the request the thread is handling, cheaper to get at than g
+        self._local = threading.local()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('MIXMIND_PROFILE', False)
+        self.max_samples = app.config.get('MIXMIND_PROFILE_SAMPLES', self.max_samples)
+        if not self.enabled:
+            return
+        app.before_request(self._begin)
+        app.after_request(self._finish)
+        app.teardown_request(self._end)
+        event.listen(Engine, 'before_cursor_execute', self._before_query)
+        event.listen(Engine, 'after_cursor_execute', self._after_query)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        log.info("Request profiling enabled, keeping {} requests per route".format(self.max_samples))
+
+    def current(self):
+        """ The RequestProfile of the request on this thread, if any """
+        return getattr(self._local, 'profile', None)
+
+    def stage(self, name):
+        """ Context manager timing a block as a stage of the current request """
+        if not self.enabled:
+            return NULL_STAGE
+        profile = self.current()
+        if profile is None:
+            return NULL_STAGE
+        return _Stage(profile, name)
+
+    def timed(self, name):
+        """ Decorator timing every call as a stage of the current request """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                profile = self.current() if self.enabled else None
+                if profile is None or name in profile.active:
+                    return func(*args, **kwargs)
+                with _Stage(profile, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _begin(self):
+        self._local.profile = RequestProfile()
+
+    def _end(self, exc):
+        self._local.profile = None
+
+    def _finish(self, response):
+        profile = self.current()
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.start
+        response.headers['Server-Timing'] = profile.server_timing(total)
+        if request.endpoint != 'static':
+            route = '{} {}'.format(request.method, request.url_rule.rule if request.url_rule else '<unmatched>')
+            sample = (total, {name: seconds for name, (seconds, _) in profile.stages.items()},
+                    profile.queries, profile.query_seconds)
+            with self.lock:
+                samples = self.samples.get(route)
+                if samples is None:
+                    samples = self.samples[route] = deque(maxlen=self.max_samples)
+                samples.append(sample)
+        return response
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self.current()
+        if profile is not None:
+            conn.info.setdefault('_profile_query_start', []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('_profile_query_start')
+        if not starts:
+            return
+        profile = self.current()
+        start = starts.pop()
+        if profile is not None:
+            profile.queries += 1
+            profile.query_seconds += time.perf_counter() - start
+
+    def _before_render(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is not None:
+            profile.render_start = time.perf_counter()
+
+    def _after_render(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is not None and profile.render_start is not None:
+            profile.add('render', time.perf_counter() - profile.render_start)
+            profile.render_start = None
+
+    def route_stats(self, route=None):
+        """ Percentiles in ms of the total and of each stage over the recent
+        requests of every route, or of the given "METHOD rule" route
+        """
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items() if route is None or name == route}
+        stats = OrderedDict()
+        for name in sorted(samples):
+            requests = samples[name]
+            stage_names = OrderedDict((stage, None) for _, stages, _, _ in requests for stage in stages)
+            stats[name] = {
+                'requests': len(requests),
+                'total': _summary([total * 1000 for total, _, _, _ in requests]),
+                'stages': {stage: _summary([stages.get(stage, 0.0) * 1000 for _, stages, _, _ in requests])
+                    for stage in stage_names},
+                'sql': _summary([query_seconds * 1000 for _, _, _, query_seconds in requests]),
+                'queries': _summary([queries for _, _, queries, _ in requests]),
+            }
+        return stats
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+profiler = RequestProfiler()
+
+# placeholder lists of IN clauses vary in length between otherwise identical statements
+_PLACEHOLDER_LIST = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))+\s*\)')
+
+def statement_shape(statement):
+    """ SQL statement with whitespace and IN lists normalized, so the statements
+    of a lazy load in a loop share a shape
+    """
+    return ' '.join(_PLACEHOLDER_LIST.sub('(?)', statement).split())
+
+class QueryCollector(object):
+    """ Statements run on one thread while collecting, counted by shape """
+    def __init__(self):
+        self.count = 0
+        self.shapes = Counter()
+
+    def add(self, statement):
+        self.count += 1
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=2):
+        """ (shape, count) of shapes run at least threshold times, most first """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+    def report(self, limit=5, width=200):
+        lines = ["{} queries, {} distinct".format(self.count, len(self.shapes))]
+        lines.extend("{:>5} x {}".format(count, shape[:width]) for shape, count in self.shapes.most_common(limit))
+        return '\n'.join(lines)
+
+_collecting = threading.local()
+_listen_lock = threading.Lock()
+_listening = False
+
+def _on_statement(conn, cursor, statement, parameters, context, executemany):
+    collectors = getattr(_collecting, 'collectors', None)
+    if collectors:
+        for collector in collectors:
+            collector.add(statement)
+
+def _listen():
+    global _listening
+    with _listen_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', _on_statement)
+            _listening = True
+
+def start_collecting():
+    """ Collect the statements run on this thread until stop_collecting """
+    _listen()
+    collector = QueryCollector()
+    if getattr(_collecting, 'collectors', None) is None:
+        _collecting.collectors = []
+    _collecting.collectors.append(collector)
+    return collector
+
+def stop_collecting(collector):
+    collectors = getattr(_collecting, 'collectors', None)
+    if collectors and collector in collectors:
+        collectors.remove(collector)
+
+@contextmanager
+def collect_queries():
+    """ QueryCollector of the statements run on this thread within the block """
+    collector = start_collecting()
+    try:
+        yield collector
+    finally:
+        stop_collecting(collector)
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+@contextmanager
+def query_budget(max_queries, label=None):
+    """ Fail with QueryBudgetExceeded if the block runs more than max_queries statements
+    on this thread, e.g. in a test:
+        with query_budget(3, 'GET /'):
+            client.get('/')
+    """
+    with collect_queries() as queries:
+        yield queries
+    if queries.count > max_queries:
+        raise QueryBudgetExceeded("{}over budget of {}: {}".format('{} '.format(label) if label else '',
+            max_queries, queries.report()))
+
+class QueryWatcher(object):
+    """ Development aid, logs a warning for every request that runs one statement
+    shape threshold times or more, along with the view that did it
+    """
+    def __init__(self, threshold=0):
+        self.threshold = threshold
+        self._local = threading.local()
+
+    def init_app(self, app):
+        self.threshold = app.config.get('MIXMIND_N_PLUS_ONE_THRESHOLD', self.threshold)
+        if not self.threshold:
+            return
+        app.before_request(self._begin)
+        app.after_request(self._check)
+        app.teardown_request(self._end)
+        log.info("Watching for statements repeated {} times in a request".format(self.threshold))
+
+    def _begin(self):
+        self._local.collector = start_collecting()
+
+    def _check(self, response):
+        collector = getattr(self._local, 'collector', None)
+        if collector is None or request.endpoint == 'static':
+            return response
+        for shape, count in collector.repeated(self.threshold):
+            log.warning("Possible N+1 in view {} ({} {}): {} of {} queries were: {}".format(request.endpoint,
+                request.method, request.path, count, collector.count, shape[:300]))
+        return response
+
+    def _end(self, exc):
+        collector = getattr(self._local, 'collector', None)
+        if collector is not None:
+            stop_collecting(collector)
+            self._local.collector = None
+
+query_watcher = QueryWatcher()
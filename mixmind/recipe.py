@@ -5,10 +5,14 @@ Just generally make it better OOP
 """
 import re
 from fractions import Fraction
+from collections import namedtuple
 from recordtype import recordtype
 import itertools
+import copy
 import string
 
+import numpy as np
+
 from . import util
 
 # water volume added by preperation method for ABV estimate
@@ -16,6 +20,10 @@ WATER_BY_PREP = {'shake': 1.6, 'stir': 1.3, 'build': 1.0, 'pour': 1.0}
 WATER_BY_ICE = {'cubed': 1.1, 'crushed': 1.4, 'neat': 1.0}
 
 EXAMPLE_LIMIT = 3
+# above this many combinations, recipe stats are computed from per-slot aggregates
+ENUMERATION_LIMIT = 10000
+# kinds in these categories are listed in the examples, juice and such are not
+EXAMPLE_CATEGORIES = ['Vermouth', 'Liqueur', 'Bitters', 'Spirit', 'Wine']
 
 class RecipeError(Exception):
     pass
@@ -43,6 +51,7 @@ class DrinkRecipe(object):
         self.examples     =  []
         self.ingredients  =  []
         self.stats = None
+        self.example_count = 0 # number of ways to make this from the stock
         for type_str, quantity in recipe_dict.get('ingredients', {}).items():
             self.ingredients.append(QuantizedIngredient(type_str, quantity, self.unit))
         for type_str, quantity in recipe_dict.get('optional', {}).items():
@@ -53,6 +62,7 @@ class DrinkRecipe(object):
             self.ingredients.append(Garnish(recipe_dict.get('garnish')))
 
         self.show_examples = False
+        self._build_unit_views()
 
     def __str__(self):
         """ Drink recipe basic plain text output format
@@ -73,9 +83,33 @@ class DrinkRecipe(object):
         return "{}:{}".format(self.__class__.__name__, self.name)
 
     def prep_line(self, extended=True, caps=True):
-        case_fn = str.upper if caps else str.lower
-        layout = "{{}} glass | {{}}{} | {{}}".format("" if self.ice == 'neat' else " ice") if extended else "{} | {} | {}"
-        return case_fn(layout.format(self.glass, self.ice, self.prep))
+        return self._prep_lines[(extended, caps)]
+
+    def _build_unit_views(self):
+        """ Ingredients and their display lines in every unit, computed once so
+        that converted() is a lookup, and the prep lines
+        """
+        self._unit_views = {}
+        for unit in util.VALID_UNITS:
+            ingredients = [copy.copy(ingredient) for ingredient in self.ingredients]
+            if unit != self.unit:
+                _convert_ingredients(ingredients, unit)
+            self._unit_views[unit] = UnitView(ingredients, [ingredient.str() for ingredient in ingredients])
+        if self.unit in self._unit_views:
+            self.ingredients = self._unit_views[self.unit].ingredients
+        self._prep_lines = {}
+        for extended in (True, False):
+            layout = "{{}} glass | {{}}{} | {{}}".format("" if self.ice == 'neat' else " ice") if extended else "{} | {} | {}"
+            for caps in (True, False):
+                case_fn = str.upper if caps else str.lower
+                self._prep_lines[(extended, caps)] = case_fn(layout.format(self.glass, self.ice, self.prep))
+
+    def ingredient_lines(self):
+        """ Display text of each ingredient """
+        view = self._unit_views.get(self.unit)
+        if view is not None and view.ingredients is self.ingredients:
+            return view.lines
+        return [ingredient.str() for ingredient in self.ingredients]
 
     @property
     def can_make(self):
@@ -86,53 +120,42 @@ class DrinkRecipe(object):
         """
         if self.unit == to_unit:
             return
-        for ingredient in self.ingredients:
-            ingredient.recipe_unit = to_unit
-            if ingredient.unit in ['ds', 'drop'] and not convert_nonstandard:
-                continue
-            try:
-                ingredient.convert(to_unit, rounded=rounded)
-            except NotImplementedError:
-                pass
+        view = self._unit_views.get(to_unit)
+        if view is not None and rounded and not convert_nonstandard:
+            self.ingredients = view.ingredients
+        else:
+            # the precomputed views share ingredients, so convert copies
+            self.ingredients = [copy.copy(ingredient) for ingredient in self.ingredients]
+            _convert_ingredients(self.ingredients, to_unit, rounded=rounded, convert_nonstandard=convert_nonstandard)
         self.unit = to_unit
 
+    def converted(self, to_unit, rounded=True, convert_nonstandard=False):
+        """ Copy of this recipe in another unit, this one is left unchanged
+        The copy shares the examples, stats and precomputed ingredients
+        """
+        if self.unit == to_unit:
+            return self
+        recipe = copy.copy(self)
+        recipe.convert(to_unit, rounded=rounded, convert_nonstandard=convert_nonstandard)
+        return recipe
+
     def generate_examples(self, barstock, stats=False):
         """ Given a Barstock, calculate examples drinks from the data
         e.g. For every dry gin and vermouth in Barstock, generate every Martini
         that can be made, along with the cost,abv,std_drinks from the ingredients
         """
         ingredients = self._get_quantized_ingredients()
-        example_kinds = barstock.get_all_kind_combinations((i.specifier for i in ingredients))
-        del self.examples # need to make possible to run again
-        self.examples = []
-        for kinds in example_kinds:
-            # TODO refactor to generate IngredientSpecifiers for the kind lists
-            example = DrinkRecipe.RecipeExample(); example.kinds = []
-            for kind, ingredient in zip(kinds, ingredients):
-                if ingredient.unit == 'literal':
-                    continue
-                example.cost       += ingredient.get_cost(kind, barstock)
-                example.std_drinks += ingredient.get_std_drinks(kind, barstock)
-                example.volume     += ingredient.get_amount_as(self.unit, rounded=False, single_value=True)
-                # remove juice and such from the kinds listed
-                if barstock.get_kind_category(util.IngredientSpecifier(ingredient.specifier.ingredient, kind)) in ['Vermouth', 'Liqueur', 'Bitters', 'Spirit', 'Wine']:
-                    example.kinds.append(kind)
-            example.kinds = ', '.join(example.kinds);
-            example.volume *= WATER_BY_PREP.get(self.prep, 1.0)
-            example.volume *= WATER_BY_ICE.get(self.ice, 1.0)
-            example.abv = util.calculate_abv(example.std_drinks, example.volume, self.unit)
-            self.max_cost = max(self.max_cost, example.cost)
-            self.examples.append(example)
+        self.stats = None # need to make possible to run again
+        self.max_cost = 0
+        example_set = ExampleSet.from_barstock(self, ingredients, barstock)
+        self.example_count = example_set.count
+        self.examples = [example_set.example(i) for i in _example_indices(example_set.count)]
+        if example_set.count:
+            self.max_cost = max(self.max_cost, example_set.max_cost())
         if stats and self.examples:
-            self.calculate_stats()
+            self.stats = example_set.stats()
             # attempting to use an average here instead of max_cost
             self.max_cost = self.stats.avg_cost
-        # Apply a limit on the number of examples used
-        if len(self.examples) > EXAMPLE_LIMIT:
-            # TODO grabbing spaced indicies
-            self.examples = [self.examples[0],
-                    self.examples[(len(self.examples)-1)//2],
-                    self.examples[len(self.examples)-1]]
         return self # so it can be used when chained
 
     def calculate_stats(self):
@@ -179,6 +202,171 @@ class DrinkRecipe(object):
     def _get_quantized_ingredients(self, include_optional=False):
         return [i for i in self.ingredients if type(i) == QuantizedIngredient]
 
+UnitView = namedtuple('UnitView', 'ingredients,lines')
+
+def _convert_ingredients(ingredients, to_unit, rounded=True, convert_nonstandard=False):
+    for ingredient in ingredients:
+        ingredient.recipe_unit = to_unit
+        if ingredient.unit in ['ds', 'drop'] and not convert_nonstandard:
+            continue
+        try:
+            ingredient.convert(to_unit, rounded=rounded)
+        except NotImplementedError:
+            pass
+
+def _example_indices(n_examples):
+    """ Apply a limit on the number of examples used
+    """
+    if n_examples > EXAMPLE_LIMIT:
+        # TODO grabbing spaced indicies
+        return [0, (n_examples-1)//2, n_examples-1]
+    return list(range(n_examples))
+
+ExampleSlot = namedtuple('ExampleSlot', 'kinds,listed,cost,std_drinks')
+
+class ExampleSet(object):
+    """ Every example of a recipe, without building them one at a time
+    Each quantized ingredient is a slot holding arrays over the kinds in stock for it,
+    examples are the cartesian product of the slots in itertools.product order.
+    Any single example is computed directly from its slot positions, adding up the
+    slots in the same order as building the examples one by one would.
+    Stats come from the fully broadcast product while it has at most
+    ENUMERATION_LIMIT examples, and from per-slot aggregates beyond that.
+    """
+    def __init__(self, recipe, slots, volume):
+        self.recipe = recipe
+        self.slots = slots
+        self.volume = volume
+        self.shape = tuple(len(slot.kinds) for slot in slots)
+        self.count = 1
+        for size in self.shape:
+            self.count *= size
+
+    @classmethod
+    def from_barstock(cls, recipe, ingredients, barstock):
+        slots = []
+        volume = 0
+        for ingredient in ingredients:
+            if ingredient.unit == 'literal':
+                # still needs to be in stock, but adds nothing to the drink
+                kind_arrays = barstock.get_kind_arrays(ingredient.specifier)
+                slots.append(ExampleSlot(kind_arrays.kinds, None, None, None))
+                continue
+            kind_arrays = barstock.get_kind_arrays(ingredient.specifier, ingredient.recipe_unit)
+            amount = ingredient.get_amount_as(ingredient.recipe_unit, rounded=False, single_value=True)
+            slots.append(ExampleSlot(kind_arrays.kinds,
+                [category in EXAMPLE_CATEGORIES for category in kind_arrays.category],
+                kind_arrays.cost_per_unit * amount,
+                util.calculate_std_drinks(kind_arrays.abv, amount, ingredient.recipe_unit)))
+            volume += ingredient.get_amount_as(recipe.unit, rounded=False, single_value=True)
+        volume *= WATER_BY_PREP.get(recipe.prep, 1.0)
+        volume *= WATER_BY_ICE.get(recipe.ice, 1.0)
+        return cls(recipe, slots, volume)
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, i):
+        """ Slot positions of the i-th example, python ints so huge products don't overflow
+        """
+        positions = []
+        for size in reversed(self.shape):
+            i, position = divmod(i, size)
+            positions.append(position)
+        return positions[::-1]
+
+    def _example_at(self, positions):
+        example = DrinkRecipe.RecipeExample(kinds=[], cost=0.0, std_drinks=0.0, volume=self.volume)
+        for slot, position in zip(self.slots, positions):
+            if slot.cost is None:
+                continue
+            example.cost += float(slot.cost[position])
+            example.std_drinks += float(slot.std_drinks[position])
+            if slot.listed[position]:
+                example.kinds.append(slot.kinds[position])
+        example.kinds = ', '.join(example.kinds)
+        example.abv = util.calculate_abv(example.std_drinks, example.volume, self.recipe.unit)
+        return example
+
+    def example(self, i):
+        """ Materialize the i-th example as a RecipeExample
+        """
+        return self._example_at(self._positions(i))
+
+    def _broadcast(self):
+        """ Flat arrays of cost and std drinks for every example
+        """
+        cost = np.zeros((1,)*len(self.shape))
+        std_drinks = np.zeros((1,)*len(self.shape))
+        for axis, slot in enumerate(self.slots):
+            if slot.cost is None:
+                continue
+            axis_shape = [1]*len(self.shape)
+            axis_shape[axis] = self.shape[axis]
+            cost = cost + slot.cost.reshape(axis_shape)
+            std_drinks = std_drinks + slot.std_drinks.reshape(axis_shape)
+        return np.broadcast_to(cost, self.shape).ravel(), np.broadcast_to(std_drinks, self.shape).ravel()
+
+    def _extreme(self, attr, max_=False):
+        """ Example with the lowest (or highest) per-slot values
+        the values add up over slots, so this is the extreme of the sum,
+        taking the first position on ties like a stable sort of every example would
+        """
+        positions = []
+        for slot in self.slots:
+            values = getattr(slot, attr)
+            if values is None:
+                positions.append(0)
+            else:
+                positions.append(int(np.argmax(values) if max_ else np.argmin(values)))
+        return self._example_at(positions)
+
+    def max_cost(self):
+        if self.count <= ENUMERATION_LIMIT:
+            cost, _ = self._broadcast()
+            return float(cost.max())
+        return self._extreme('cost', max_=True).cost
+
+    def stats(self):
+        """ Same result as DrinkRecipe.calculate_stats over every example
+        Dilution volume does not depend on the kinds, so ABV is proportional to std drinks
+        and its extremes and average follow from those of the std drinks
+        """
+        if self.count <= ENUMERATION_LIMIT:
+            return self._enumerated_stats()
+        stats = DrinkRecipe.RecipeStats()
+        stats.min_cost = self._extreme('cost')
+        stats.max_cost = self._extreme('cost', max_=True)
+        stats.min_std_drinks = self._extreme('std_drinks')
+        stats.max_std_drinks = self._extreme('std_drinks', max_=True)
+        stats.min_abv = stats.min_std_drinks
+        stats.max_abv = stats.max_std_drinks
+        stats.volume = self.volume
+        stats.avg_cost = sum(float(slot.cost.mean()) for slot in self.slots if slot.cost is not None)
+        stats.avg_std_drinks = sum(float(slot.std_drinks.mean()) for slot in self.slots if slot.std_drinks is not None)
+        stats.avg_abv = util.calculate_abv(stats.avg_std_drinks, self.volume, self.recipe.unit)
+        return stats
+
+    def _enumerated_stats(self):
+        """ ties go to the first example, sums are accumulated in order
+        """
+        def _mean(values):
+            return float(np.add.accumulate(values)[-1]) / float(len(values))
+        cost, std_drinks = self._broadcast()
+        abv = util.calculate_abv(std_drinks, self.volume, self.recipe.unit)
+        stats = DrinkRecipe.RecipeStats()
+        stats.min_cost = self.example(int(np.argmin(cost)))
+        stats.max_cost = self.example(int(np.argmax(cost)))
+        stats.min_abv = self.example(int(np.argmin(abv)))
+        stats.max_abv = self.example(int(np.argmax(abv)))
+        stats.min_std_drinks = self.example(int(np.argmin(std_drinks)))
+        stats.max_std_drinks = self.example(int(np.argmax(std_drinks)))
+        stats.volume = self.volume
+        stats.avg_cost = _mean(cost)
+        stats.avg_abv = _mean(abv)
+        stats.avg_std_drinks = _mean(std_drinks)
+        return stats
+
 class Ingredient(object):
     """ An "ingredient" is every item that should be represented in standard text
     """
@@ -199,6 +387,10 @@ class Ingredient(object):
     def __contains__(self, item):
         return item in self.description.lower()
 
+    def search_terms(self):
+        """ Lowercase strings that __contains__ matches against """
+        return [self.description.lower()]
+
     def convert(self, *args, **kwargs):
         pass
 
@@ -276,6 +468,11 @@ class QuantizedIngredient(Ingredient):
         return item in self.specifier.ingredient.lower() or \
              (self.specifier.kind and item in self.specifier.kind.lower())
 
+    def search_terms(self):
+        if self.specifier.kind:
+            return [self.specifier.ingredient.lower(), self.specifier.kind.lower()]
+        return [self.specifier.ingredient.lower()]
+
     def __repr__(self):
         return super(QuantizedIngredient, self)._repr_fmt().format("{},{},{}".format(self.amount, self.unit, self.specifier))
 
@@ -0,0 +1,59 @@
+// admin dashboard tables, each page is fetched from the server as needed
+function escapeHtml(text) {
+    return $("<div>").text(text == null ? "" : text).html();
+}
+
+var bar_columns = [
+    {data: "is_default", searchable: false, render: function(data, type, row, meta){
+        if (type != "display") {
+            return data;
+        }
+        var form = '<form action="" method="post" role="form">';
+        form += '<input type="hidden" name="bar_id" value="' + row.id + '"></input>';
+        form += '<button class="btn btn-small ' + (data ? 'btn-success' : 'btn-danger') + ' p-1" type="submit" name="set-default-bar">';
+        form += '<i class="fas ' + (data ? 'fa-check' : 'fa-times') + ' icon-btn-tweak"></i></button></form>';
+        return form;
+    }},
+    {data: "is_public", searchable: false, render: function(data, type, row, meta){
+        return data ? "Visible" : "Hidden";
+    }},
+    {data: "id"},
+    {data: "name", render: $.fn.dataTable.render.text()},
+    {data: "cname", render: $.fn.dataTable.render.text()},
+    // taglines are shown as html, like the server rendered table did
+    {data: "tagline", orderable: false, className: "subtitle"},
+    {data: "orders", orderable: false, searchable: false},
+    {data: "bartender", orderable: false, searchable: false, render: function(data, type, row, meta){
+        return escapeHtml(data);
+    }}
+];
+
+var user_columns = ["id", "email", "first_name", "last_name", "nickname", "login_count", "last_login_at", "confirmed_at"].map(
+    function(name) { return {data: name, render: $.fn.dataTable.render.text()}; }
+).concat([
+    {data: "roles", orderable: false, render: $.fn.dataTable.render.text()},
+    {data: "orders", orderable: false, searchable: false}
+]);
+
+var order_columns = ["id", "timestamp", "confirmed", "user_id", "bar_id", "recipe_name"].map(
+    function(name) { return {data: name, render: $.fn.dataTable.render.text()}; }
+);
+
+function serverTable(selector, columns, order) {
+    return $(selector).DataTable({
+        "serverSide": true,
+        "processing": true,
+        "ajax": $(selector).data("ajax"),
+        "searchDelay": 400,
+        "lengthMenu": [10, 25, 50, 100],
+        "pageLength": 25,
+        "columns": columns,
+        "order": order
+    });
+}
+
+$(document).ready(function () {
+    serverTable("#bar_table", bar_columns, [[2, "asc"]]);
+    serverTable("#user_table", user_columns, [[0, "asc"]]);
+    serverTable("#order_table", order_columns, [[0, "desc"]]);
+});
@@ -52,8 +52,14 @@ var column_settings = [
 
 var barstock_table;
 $(document).ready( function () {
+    // bars with many ingredients are paged, sorted and searched by the server
+    var server_side = $("#barstock-table").data("server-side") === true;
     barstock_table = $("#barstock-table").DataTable( {
-        "ajax": "/api/ingredients",
+        // no cache busting parameter, the browser revalidates with the ETag
+        "ajax": {"url": $("#barstock-table").data("ajax"), "cache": true},
+        "serverSide": server_side,
+        "processing": server_side,
+        "searchDelay": server_side ? 400 : null,
         "paging": true,
         "lengthMenu":  [10, 20, 50, 100],
         "pageLength": 20,
@@ -8,7 +8,11 @@ import json
 import csv
 import inspect
 import uuid
+import unicodedata
+import threading
+import copy
 import pendulum
+import numpy as np
 from .logger import get_logger
 log = get_logger(__name__)
 
@@ -19,74 +23,233 @@ PdfOptions = namedtuple('PdfOptions', 'pdf_filename,ncols,liquor_list,liquor_lis
 
 VALID_UNITS = ['oz', 'mL', 'cL']
 
-class ResultRecipes(object):
-    def add_items(self, recipes):
-        pass
-    def get_items(self):
-        pass
-
-class UnionResultRecipes(ResultRecipes):
-    def __init__(self):
-        self.container = OrderedDict()
-    def add_items(self, recipes):
-        for recipe in recipes:
-            self.container[recipe.name] = recipe
-    def get_items(self):
-        return list(self.container.values())
-
-class IntersectionResultRecipes(ResultRecipes):
+SEARCH_ATTRIBUTES = 'style glass prep ice tag'.split()
+SEARCH_CACHE_TERMS = 1024 # remembered lookups per postings
+
+def _bits_from_indices(indices, n):
+    """ Bitset as an int, bit i set for each index i """
+    buf = bytearray((n + 7) // 8)
+    for i in indices:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bytes(buf), 'little')
+
+def _indices_from_bits(bits, n):
+    """ Indices of the set bits, in increasing order """
+    if not bits:
+        return []
+    flags = np.unpackbits(np.frombuffer(bits.to_bytes((n + 7) // 8, 'little'), dtype=np.uint8))
+    # unpackbits is msb first within each byte
+    return np.flatnonzero(flags.reshape(-1, 8)[:, ::-1].ravel()).tolist()
+
+class SearchPostings(object):
+    """ Maps substrings to the bitset of recipes having a matching string
+    Distinct strings are indexed by their trigrams, a term is only checked
+    against the strings having all of its trigrams
+    """
     def __init__(self):
-        self.container = None
-    def add_items(self, recipes):
-        if self.container is None:
-            self.container = recipes
+        self.texts = OrderedDict()
+
+    def add(self, text, recipe_index):
+        self.texts.setdefault(text, []).append(recipe_index)
+
+    def finalize(self, n):
+        self.strings = list(self.texts.keys())
+        self.bits = [_bits_from_indices(indices, n) for indices in self.texts.values()]
+        self.trigrams = {}
+        for i, text in enumerate(self.strings):
+            for j in range(len(text) - 2):
+                self.trigrams.setdefault(text[j:j+3], set()).add(i)
+        self.cache = {}
+        del self.texts
+
+    def lookup(self, term):
+        """ Bitset of recipes with any string containing term """
+        bits = self.cache.get(term)
+        if bits is not None:
+            return bits
+        if len(term) >= 3:
+            postings = sorted((self.trigrams.get(term[j:j+3], set()) for j in range(len(term) - 2)), key=len)
+            candidates = sorted(set.intersection(*postings)) if postings[0] else []
+        else:
+            candidates = range(len(self.strings))
+        bits = 0
+        for i in candidates:
+            if term in self.strings[i]:
+                bits |= self.bits[i]
+        if len(self.cache) >= SEARCH_CACHE_TERMS:
+            self.cache.clear()
+        self.cache[term] = bits
+        return bits
+
+class RecipeSearchIndex(object):
+    """ Inverted index over a list of recipes, answers filter_recipes with bitset algebra
+    Ingredient and attribute strings are fixed once a recipe is parsed,
+    whether a recipe can be made is checked at query time
+    """
+    def __init__(self, recipes):
+        self.recipes = list(recipes)
+        n = len(self.recipes)
+        self.all_bits = (1 << n) - 1
+        self.sorted_names = sorted(set(recipe.name for recipe in self.recipes))
+        self.include = SearchPostings() # every ingredient line
+        self.exclude = SearchPostings() # quantized ingredients only
+        self.attributes = {attr: SearchPostings() for attr in SEARCH_ATTRIBUTES}
+        for i, recipe in enumerate(self.recipes):
+            for ingredient in recipe.ingredients:
+                for text in ingredient.search_terms():
+                    self.include.add(text, i)
+            for ingredient in recipe._get_quantized_ingredients():
+                for text in ingredient.search_terms():
+                    self.exclude.add(text, i)
+            for attr in SEARCH_ATTRIBUTES:
+                value = getattr(recipe, attr)
+                if value: # null in some recipe files, never matches
+                    self.attributes[attr].add(value.lower(), i)
+        for postings in [self.include, self.exclude] + list(self.attributes.values()):
+            postings.finalize(n)
+
+    def with_recipes(self, recipes):
+        """ Same index over updated copies of the same recipes, in the same order """
+        index = copy.copy(self)
+        index.recipes = list(recipes)
+        return index
+
+    def _combine(self, postings, terms, use_or):
+        bits = 0 if use_or else self.all_bits
+        for term in terms:
+            if use_or:
+                bits |= postings.lookup(term)
+            else:
+                bits &= postings.lookup(term)
+        return bits
+
+    def search(self, filter_options, union_results=False):
+        """ Same results, in the same order, as filtering the recipe list
+        directly with the FilterOptions
+        """
+        n = len(self.recipes)
+        # each group is the set of recipes passing one of the filters,
+        # recipes that can't be made are dropped from the final matches
+        groups = []
+        if filter_options.search:
+            include_list = [filter_options.search.lower()]
         else:
-            self.container = [x for x in self.container if x in recipes]
-    def get_items(self):
-        return self.container
+            include_list = [i.lower() for i in filter_options.include]
+        if include_list:
+            groups.append(self._combine(self.include, include_list, filter_options.include_use_or))
+        if filter_options.exclude:
+            # recipe passes when it lacks all (or, with use_or, any) of the terms
+            matched = self._combine(self.exclude, filter_options.exclude, not filter_options.exclude_use_or)
+            groups.append(self.all_bits & ~matched)
+        for attr in SEARCH_ATTRIBUTES:
+            attr_value = getattr(filter_options, attr).lower()
+            if filter_options.search and not attr_value:
+                attr_value = filter_options.search.lower()
+            if attr_value:
+                groups.append(self.attributes[attr].lookup(attr_value))
+            else:
+                groups.append(self.all_bits)
+
+        if union_results:
+            # recipes in the order each filter first matched them
+            order = []
+            seen = 0
+            for bits in groups:
+                order.extend(_indices_from_bits(bits & ~seen, n))
+                seen |= bits
+        else:
+            bits = self.all_bits
+            for group in groups:
+                bits &= group
+            order = _indices_from_bits(bits, n)
+        if filter_options.all_:
+            return [self.recipes[i] for i in order]
+        return [self.recipes[i] for i in order if self.recipes[i].can_make]
 
 def filter_recipes(all_recipes, filter_options, union_results=False):
     """Filters the recipe list based on a FilterOptions bundle of parameters
-    :param list[Recipe] all_recipes: list of recipe object to filter
+    :param list[Recipe] all_recipes: list of recipe object to filter, uses its
+        search_index if it has one
     :param FilterOptions filter_options: bundle of filtering parameters
         search str: search an arbitrary string against the ingredients and attributes
     :param bool union_results: for each attributes searched against, combine results
         with set intersection by default, or union if True
     """
-    result_recipes = UnionResultRecipes() if union_results else IntersectionResultRecipes()
-    recipes = [recipe for recipe in all_recipes if filter_options.all_ or recipe.can_make]
-    if filter_options.search:
-        include_list = [filter_options.search.lower()]
-    else:
-        include_list = [i.lower() for i in filter_options.include]
-    if include_list:
-        reduce_fn = any if filter_options.include_use_or else all
-        result_recipes.add_items([recipe for recipe in recipes if
-                reduce_fn((recipe.contains_ingredient(ingredient, include_optional=True)
-                for ingredient in include_list))])
-    if filter_options.exclude:
-        reduce_fn = any if filter_options.exclude_use_or else all
-        result_recipes.add_items([recipe for recipe in recipes if
-                reduce_fn((not recipe.contains_ingredient(ingredient, include_optional=False)
-                for ingredient in filter_options.exclude))])
-    for attr in 'style glass prep ice tag'.split():
-        result_recipes.add_items(filter_on_attribute(recipes, filter_options, attr))
-
-    result_recipes = result_recipes.get_items()
-
-    def get_names(items):
-        return set([i.name for i in items])
-    excluded = sorted(list(get_names(all_recipes) - get_names(result_recipes)))
+    index = getattr(all_recipes, 'search_index', None)
+    if index is None:
+        index = RecipeSearchIndex(all_recipes)
+    result_recipes = index.search(filter_options, union_results=union_results)
+
+    result_names = set(recipe.name for recipe in result_recipes)
+    excluded = [name for name in index.sorted_names if name not in result_names]
     log.debug("Excluded: {}\n".format(', '.join(excluded)))
     return result_recipes, excluded
 
-def filter_on_attribute(recipes, filter_options, attribute):
-    attr_value = getattr(filter_options, attribute).lower()
-    if filter_options.search and not attr_value:
-        attr_value = filter_options.search.lower()
-    if attr_value:
-        recipes = [recipe for recipe in recipes if attr_value in getattr(recipe, attribute).lower()]
-    return recipes
+def normalize_name(name):
+    """ Case and accent insensitive form of a name, for lookups
+    e.g. "Añejo Highball" -> "anejo highball"
+    """
+    decomposed = unicodedata.normalize('NFKD', name.strip())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+class LRUCache(object):
+    """ Thread safe least recently used cache, bounded by the total size of its values
+    :param int max_bytes: budget for the sum of sizeof(value) over all entries
+    :param callable sizeof: gives the size of a value, defaults to utf-8 length of a string
+    """
+    def __init__(self, max_bytes, sizeof=lambda value: len(value.encode('utf-8'))):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.container = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, _ = self.container[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.container.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.container:
+                self.size -= self.container.pop(key)[1]
+            self.container[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted_bytes) = self.container.popitem(last=False)
+                self.size -= evicted_bytes
+                self.evictions += 1
+
+    def get_or_create(self, key, create):
+        """ Return the cached value for key, or cache and return create()
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.container.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.container), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
 def get_uuid():
     return str(uuid.uuid4())
@@ -154,7 +317,7 @@ def load_recipe_json(recipe_files):
             log.info("Recipes loaded from {}".format(recipe_json))
             for item in other_recipes.values():
                 item.update({'source_file': recipe_json})
-            for name in [name for name in list(other_recipes.keys()) if name in list(base_recipes.keys())]:
+            for name in [name for name in other_recipes if name in base_recipes]:
                 log.debug("Keeping {} from {} over {}".format(name, base_recipes[name]['source_file'], other_recipes[name]['source_file']))
                 del other_recipes[name]
             base_recipes.update(other_recipes)
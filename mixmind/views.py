@@ -4,6 +4,7 @@ Application main for the mixmind app
 import os
 import random
 import datetime
+import hashlib
 import tempfile
 import urllib.request, urllib.parse, urllib.error
 import codecs
@@ -11,20 +12,27 @@ import codecs
 import pendulum
 from functools import wraps
 
-from flask import g, render_template, flash, request, send_file, jsonify, redirect, url_for, after_this_request
+from flask import g, render_template, flash, request, session, send_file, jsonify, redirect, url_for, after_this_request, make_response
 from flask_security import login_required, roles_required, roles_accepted
 from flask_security.decorators import _get_unauthorized_view
 from flask_login import current_user
+from sqlalchemy import func, or_, case
+from sqlalchemy.orm import selectinload
 
 from .notifier import send_mail
 from .forms import DrinksForm, OrderForm, OrderFormAnon, RecipeForm, RecipeListSelector, BarstockForm, UploadBarstockForm, LoginForm, CreateBarForm, EditBarForm, EditUserForm, SetBarOwnerForm
 from .authorization import user_datastore
-from .barstock import Barstock_SQL, Ingredient, _update_computed_fields
-from .formatted_menu import filename_from_options, generate_recipes_pdf
-from .compose_html import recipe_as_html, users_as_table, orders_as_table, bars_as_table
+from .ingredient import Categories
+from .barstock import Barstock_SQL, Ingredient, StockRow, DataError, _update_computed_fields, get_stock_index,\
+        bump_stored_stock_version, stored_stock_version
+from .formatted_menu import pdf_queue
+from .compose_html import recipe_as_html, orders_as_table, yes_no
 from .util import filter_recipes, DisplayOptions, FilterOptions, PdfOptions, load_recipe_json, report_stats, convert_units
 from .database import db
 from .models import User, Order, Bar
+from .configuration_management import invalidate_bar_config
+from .analytics import record_order, record_confirmation, recent_order_stats, GROUPINGS
+from .profiling import profiler
 from . import app, mms, current_bar
 from .logger import get_logger
 log = get_logger(__name__)
@@ -66,27 +74,41 @@ def recipes_from_options(form, display_opts=None, filter_opts=None, to_html=Fals
     """
     display_options = bundle_options(DisplayOptions, form) if not display_opts else display_opts
     filter_options = bundle_options(FilterOptions, form) if not filter_opts else filter_opts
-    recipes, excluded = filter_recipes(mms.processed_recipes(current_bar), filter_options, union_results=bool(filter_options.search))
+    with profiler.stage('recipes'):
+        library = mms.processed_recipes(current_bar)
+    with profiler.stage('filter'):
+        recipes, excluded = filter_recipes(library, filter_options, union_results=bool(filter_options.search))
     if form.sorting.data and form.sorting.data != 'None': # TODO this is weird
         reverse = 'X' in form.sorting.data
         attr = 'avg_{}'.format(form.sorting.data.rstrip('X'))
-        recipes = sorted(recipes, key=lambda r: getattr(r.stats, attr), reverse=reverse)
+        with profiler.stage('sort'):
+            recipes = sorted(recipes, key=lambda r: getattr(r.stats, attr), reverse=reverse)
     if convert_to:
-        [r.convert(convert_to) for r in recipes]
+        with profiler.stage('convert'):
+            recipes = [r.converted(convert_to) for r in recipes]
     if display_options.stats and recipes:
-        stats = report_stats(recipes, as_html=True)
+        with profiler.stage('stats'):
+            stats = report_stats(recipes, as_html=True)
     else:
         stats = None
-    # TODO this can certainly be cached
     if to_html:
-        if order_link:
-            recipes = [recipe_as_html(recipe, display_options,
-                order_link="/order/{}".format(urllib.parse.quote_plus(recipe.name)),
-                **kwargs_for_html) for recipe in recipes]
-        else:
-            recipes = [recipe_as_html(recipe, display_options, **kwargs_for_html) for recipe in recipes]
+        with profiler.stage('html'):
+            if order_link:
+                recipes = [recipe_card(library, recipe, display_options,
+                    order_link="/order/{}".format(urllib.parse.quote_plus(recipe.name)),
+                    **kwargs_for_html) for recipe in recipes]
+            else:
+                recipes = [recipe_card(library, recipe, display_options, **kwargs_for_html) for recipe in recipes]
     return recipes, excluded, stats
 
+def recipe_card(library, recipe, display_options, **kwargs_for_html):
+    """ recipe_as_html for a recipe from the current bar's library, cached until
+    a new library is published for the bar
+    """
+    key = (current_bar.id, library.version, recipe.name, recipe.unit, display_options,
+            tuple(sorted(kwargs_for_html.items())))
+    return mms.card_cache.get_or_create(key, lambda: recipe_as_html(recipe, display_options, **kwargs_for_html))
+
 def get_tmp_file():
     """ Get a temporary file that will be removed by a callback after
     the current request
@@ -103,12 +125,67 @@ def get_tmp_file():
         return response
     return tmp_filename
 
+def conditional(etag_parts):
+    """ Conditional GET for a view, the ETag is a hash of etag_parts(*args, **kwargs)
+    along with the url and user, so etag_parts must return everything else the
+    response is built from. A request with a matching If-None-Match gets a 304
+    without running the view. Put it below any access checks
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # pending flashes are shown once, so that page is not the cached one
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return f(*args, **kwargs)
+            user = (current_user.id, current_user.get_name(short=True), current_user.get_role_names()) \
+                    if current_user.is_authenticated else None
+            etag = hashlib.sha1(repr((request.endpoint, request.url, user, etag_parts(*args, **kwargs)))
+                    .encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            set_cache_control(response)
+            return response
+        return decorated_function
+    return decorator
+
+def set_cache_control(response):
+    """ Clients always revalidate with the ETag, shared caches may keep anonymous
+    responses for MIXMIND_PUBLIC_MAX_AGE seconds
+    """
+    response.vary.add('Cookie')
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        max_age = app.config.get('MIXMIND_PUBLIC_MAX_AGE', 0)
+        if max_age:
+            response.cache_control.max_age = max_age
+        else:
+            response.cache_control.no_cache = True
+
+def browse_etag_parts():
+    # the page shows the library, which catches up with stock changes in the background,
+    # so the tag follows the library's versions rather than the stored stock version
+    library = mms.processed_recipes(current_bar)
+    return (mms.instance_id, library.version, library.stock_version, repr(current_bar), repr(g.bar_list))
+
+def ingredients_etag_parts():
+    # read from the database, so the tag holds across processes
+    return (current_bar.id, stored_stock_version(current_bar.id))
+
 ################################################################################
 # Customer routes
 ################################################################################
 
 
 @app.route("/", methods=['GET', 'POST'])
+@conditional(browse_etag_parts)
 def browse():
     form = get_form(DrinksForm)
     filter_options = None
@@ -158,11 +235,11 @@ def order(recipe_name):
     heading = "Order:"
 
     recipe = mms.find_recipe(current_bar, recipe_name)
-    recipe.convert('oz')
     if not recipe:
         flash('Error: unknown recipe "{}"'.format(recipe_name), 'danger')
         return render_template('result.html', heading=heading)
     else:
+        recipe = recipe.converted('oz')
         recipe_html = recipe_as_html(recipe, DisplayOptions(
                             prices=current_bar.prices,
                             stats=False,
@@ -218,6 +295,7 @@ def order(recipe_name):
                 if current_user.is_authenticated:
                     order.user_id = current_user.id
                 db.session.add(order)
+                record_order(order)
                 db.session.commit()
 
                 subject = "{} for {} at {}".format(recipe.name, user_name, current_bar.name)
@@ -264,8 +342,6 @@ def confirm_order():
     else:
         venmo_link = None
 
-    order.confirmed = datetime.datetime.utcnow()
-
     # update users db
     user = User.query.filter_by(email=order.user_email).one_or_none()
     if user:
@@ -275,10 +351,19 @@ def confirm_order():
             return render_template('result.html', heading="Invalid request")
         user.orders.append(order)
         user_datastore.put(user)
-        user_datastore.commit()
     else:
         greeting = "You"
 
+    # only one request gets to confirm the order and count it in the rollups
+    confirmed = datetime.datetime.utcnow()
+    if not Order.query.filter_by(id=order.id, confirmed=None).update({'confirmed': confirmed}, synchronize_session=False):
+        db.session.rollback()
+        flash("Error: Order has already been confirmed", 'danger')
+        return render_template("result.html", heading="Invalid confirmation link")
+    order.confirmed = confirmed
+    record_confirmation(order)
+    db.session.commit()
+
     bar = Bar.query.filter_by(id=order.bar_id).one_or_none()
     if bar is None:
         flash("Invalid bar id with order", 'danger')
@@ -330,13 +415,14 @@ def user_profile():
             this_user.nickname = form.nickname.data
             this_user.venmo_id = form.venmo_id.data
             user_datastore.commit()
+            invalidate_bar_config() # may be a bar's owner or bartender
             flash("Profile updated", 'success')
             return redirect(request.url)
         else:
             flash("Error in form validation", 'danger')
             return render_template('user_profile.html', this_user=this_user, edit_user=form,
-                    human_timestamp=mms.time_human_formatter, human_timediff=mms.time_diff_formatter,
-                    timestamp=mms.timestamp_formatter)
+                    bar_names=_bar_names(), human_timestamp=mms.time_human_formatter,
+                    human_timediff=mms.time_diff_formatter, timestamp=mms.timestamp_formatter)
 
 
 
@@ -346,8 +432,12 @@ def user_profile():
         setattr(getattr(form, attr), 'data', getattr(this_user, attr))
 
     return render_template('user_profile.html', this_user=this_user, edit_user=form,
-                human_timestamp=mms.time_human_formatter, human_timediff=mms.time_diff_formatter,
-                timestamp=mms.timestamp_formatter)
+                bar_names=_bar_names(), human_timestamp=mms.time_human_formatter,
+                human_timediff=mms.time_diff_formatter, timestamp=mms.timestamp_formatter)
+
+def _bar_names():
+    """ Names of the bars by id, so order listings don't look up each order's bar """
+    return dict(db.session.query(Bar.id, Bar.name))
 
 
 @app.route("/user_post_login", methods=['GET'])
@@ -427,6 +517,9 @@ def bar_settings():
             for attr in BAR_BULK_ATTRS:
                 setattr(bar, attr, getattr(edit_bar_form, attr).data)
             db.session.commit()
+            # recipe cards are keyed on the display options and pages on repr(current_bar),
+            # so the new settings show without a new library
+            invalidate_bar_config()
             flash("Successfully updated config for {}".format(bar.cname))
             return redirect(request.url)
         else:
@@ -464,12 +557,19 @@ def ingredient_stock():
                 row['ABV'] = float(form.abv.data)
                 row['Size (mL)'] = convert_units(float(form.size.data), form.unit.data, 'mL')
                 row['Price Paid'] = float(form.price.data)
+                # an existing row is updated, recipes using its old values are affected too
+                previous = Ingredient.query.filter_by(bar_id=current_bar.id, Type=row['Type'], Kind=row['Kind']).one_or_none()
+                previous = StockRow.from_model(previous) if previous else None
                 try:
                     ingredient = Barstock_SQL(current_bar.id).add_row(row, current_bar.id)
                 except NameError as e:
                     flash('Error: {}'.format(e), 'danger')
                 else:
-                    mms.regenerate_recipes(current_bar, ingredient=ingredient.type_)
+                    if ingredient is None:
+                        flash("Skipped ingredient {} ({}), check its fields".format(row['Kind'], row['Type']), 'warning')
+                    else:
+                        changed = [previous, ingredient] if previous else [ingredient]
+                        mms.schedule_regeneration(current_bar._get_current_object(), ingredients=changed)
                 return redirect(request.url)
             else:
                 form_open = True
@@ -484,16 +584,25 @@ def ingredient_stock():
 
             tmp_filename = get_tmp_file()
             csv_file.save(tmp_filename)
-            Barstock_SQL(current_bar.id).load_from_csv([tmp_filename], current_bar.id,
-                    replace_existing=upload_form.replace_existing.data)
-            mms.generate_recipes(current_bar)
-            msg = "Ingredients database {} {} for {}".format(
+            try:
+                report = Barstock_SQL(current_bar.id).load_from_csv([tmp_filename], current_bar.id,
+                        replace_existing=upload_form.replace_existing.data)
+            except DataError as e:
+                flash('Error: {}'.format(e), 'danger')
+                return redirect(request.url)
+            mms.schedule_regeneration(current_bar._get_current_object())
+            msg = "Ingredients database {} {} for {}: {} inserted, {} updated, {} skipped".format(
                     "replaced by" if upload_form.replace_existing.data else "added to from",
-                    csv_file.filename, current_bar.cname)
+                    csv_file.filename, current_bar.cname,
+                    report.inserted, report.updated, report.skipped)
             log.info(msg)
             flash(msg, 'success')
 
-    return render_template('ingredients.html', form=form, upload_form=upload_form, form_open=form_open)
+    # big bars page, sort and search the table on the server
+    rows = Ingredient.query.filter_by(bar_id=current_bar.id).count()
+    server_side = rows > app.config.get('MIXMIND_INGREDIENT_SERVER_SIDE_ROWS', 1000)
+    return render_template('ingredients.html', form=form, upload_form=upload_form, form_open=form_open,
+            server_side=server_side)
 
 
 ################################################################################
@@ -536,6 +645,7 @@ def set_bar_owner():
                     heading="{}, you no longer own {}".format(old_owner.get_name(), bar.name),
                     message="You have been unassigned as the owner of {}.".format(bar.name))
         user_datastore.commit()
+        invalidate_bar_config()
     else:
         flash("Error in form validation", 'warning')
 
@@ -563,6 +673,7 @@ def admin_dashboard():
                 new_bar = Bar(**bar_args)
                 db.session.add(new_bar)
                 db.session.commit()
+                invalidate_bar_config()
                 flash("Created a new bar", 'success')
             else:
                 flash("Error in form validation", 'warning')
@@ -580,19 +691,37 @@ def admin_dashboard():
             for bar in bars:
                 bar.is_default = (bar.id == bar_id)
             db.session.commit()
+            invalidate_bar_config()
             flash("Bar ID: {} is now the default".format(bar_id), 'success')
             return redirect(request.url)
 
     set_owner_form.owner.data = '' if not current_bar.owner else current_bar.owner.email
-    bars = Bar.query.all()
-    users = User.query.all()
-    orders = Order.query.all()
-    #bar_table = bars_as_table(bars)
-    user_table = users_as_table(users)
-    order_table = orders_as_table(orders)
-    return render_template('dashboard.html', new_bar_form=new_bar_form,
-            set_owner_form=set_owner_form, users=users, orders=orders,
-            bars=bars, user_table=user_table, order_table=order_table)
+    # the tables are filled a page at a time from the /api/admin/ routes
+    return render_template('dashboard.html', new_bar_form=new_bar_form, set_owner_form=set_owner_form)
+
+def _order_stats_args():
+    hours = min(max(request.args.get('hours', 24, int), 1), 24*90)
+    return hours, request.args.get('bar_id', None, int), request.args.get('bartender_id', None, int)
+
+def _bartender_names(stats):
+    ids = {row['bartender_id'] for row in stats if row.get('bartender_id')}
+    if not ids:
+        return {}
+    return {user.id: user.get_name_with_email() for user in User.query.filter(User.id.in_(ids))}
+
+@app.route("/admin/order_stats", methods=['GET'])
+@login_required
+@roles_required('admin')
+def admin_order_stats():
+    """ Throughput and time to confirm, read only from the order rollups """
+    hours, bar_id, bartender_id = _order_stats_args()
+    filters = {'hours': hours, 'bar_id': bar_id, 'bartender_id': bartender_id}
+    by_bar = recent_order_stats(group_by='bar', **filters)
+    by_bartender = recent_order_stats(group_by='bartender', **filters)
+    by_hour = recent_order_stats(group_by='hour', **filters)
+    bars = {bar.id: bar.cname for bar in Bar.query.filter(Bar.id.in_({row['bar_id'] for row in by_bar}))} if by_bar else {}
+    return render_template('order_stats.html', hours=hours, by_bar=by_bar, by_bartender=by_bartender,
+            by_hour=by_hour, bars=bars, bartenders=_bartender_names(by_bartender))
 
 @app.route("/admin/menu_generator", methods=['GET', 'POST'])
 @login_required
@@ -620,24 +749,44 @@ def menu_generator():
 @login_required
 @roles_required('admin')
 def menu_download():
+    """ Queue the pdf of the menu, poll the status_url until it's done
+    A menu that was built before is done right away
+    """
     form = get_form(DrinksForm)
-    raise NotImplementedError
 
     if form.validate():
         log.info(request)
         recipes, _, _ = recipes_from_options(form)
 
         display_options = bundle_options(DisplayOptions, form)
-        form.pdf_filename.data = 'menus/{}'.format(filename_from_options(bundle_options(PdfOptions, form), display_options))
         pdf_options = bundle_options(PdfOptions, form)
-        pdf_file = '{}.pdf'.format(pdf_options.pdf_filename)
-
-        generate_recipes_pdf(recipes, pdf_options, display_options, mms.barstock.df)
-        return send_file(os.path.abspath(pdf_file), 'application/pdf', as_attachment=True, attachment_filename=pdf_file.lstrip('menus/'))
+        job = pdf_queue.submit(recipes, pdf_options, display_options, get_stock_index(current_bar.id).rows)
+        return api_success(job.as_dict(), status_url=url_for('menu_pdf_status', job_id=job.id),
+                download_url=url_for('menu_pdf_download', job_id=job.id))
 
     else:
-        flash("Error in form validation", 'danger')
-        return render_template('application_main.html', form=form, recipes=[], excluded=None)
+        return api_error("Error in form validation", errors=form.errors)
+
+@app.route("/admin/menu_generator/pdf/<job_id>", methods=['GET'])
+@login_required
+@roles_required('admin')
+def menu_pdf_status(job_id):
+    job = pdf_queue.get(job_id)
+    if not job:
+        return api_error("No such pdf job")
+    return api_success(job.as_dict())
+
+@app.route("/admin/menu_generator/pdf/<job_id>/download", methods=['GET'])
+@login_required
+@roles_required('admin')
+def menu_pdf_download(job_id):
+    job = pdf_queue.get(job_id)
+    if not job:
+        return api_error("No such pdf job")
+    if job.status != 'done':
+        return api_error("The pdf is {}".format(job.status), job=job.as_dict())
+    return send_file(os.path.abspath(job.pdf_file), 'application/pdf', as_attachment=True,
+            attachment_filename=os.path.basename(job.pdf_file))
 
 
 @app.route("/admin/recipes", methods=['GET','POST'])
@@ -675,14 +824,29 @@ def api_error(message, **kwargs):
 def api_success(data, message="", **kwargs):
     return jsonify(status="success", message=message, data=data, **kwargs)
 
+# categories sort in the order they are listed, like the ingredient table does client-side
+CATEGORY_ORDER = case({category: i for i, category in enumerate(Categories)}, value=Ingredient.Category,
+        else_=len(Categories))
+
 @app.route("/api/ingredients", methods=['GET'])
 @login_required
 @roles_accepted('admin', 'owner')
 @check_ownership
+@conditional(ingredients_etag_parts)
 def api_ingredients():
-    ingredients = Ingredient.query.filter_by(bar_id=current_bar.id).order_by(Ingredient.Category, Ingredient.Type).all()
-    ingredients = [i.as_dict() for i in ingredients]
-    return api_success(ingredients)
+    """ All the ingredients of the bar, or one page of them for a DataTables
+    server-side request (has a draw parameter)
+    """
+    query = Ingredient.query.filter_by(bar_id=current_bar.id)
+    if 'draw' not in request.args:
+        ingredients = query.order_by(Ingredient.Category, Ingredient.Type).all()
+        return api_success([i.as_dict() for i in ingredients])
+    columns = {name: getattr(Ingredient, name) for name in ['In_Stock', 'Kind', 'Type', 'ABV', 'Size_mL', 'Size_oz',
+        'Price_Paid', 'Cost_per_oz']}
+    columns['Category'] = CATEGORY_ORDER
+    ingredients, page = paged_query(query, columns, searchable=[Ingredient.Kind, Ingredient.Type, Ingredient.Category],
+            default_order=CATEGORY_ORDER, tiebreak=[Ingredient.Type, Ingredient.Kind])
+    return api_success([i.as_dict() for i in ingredients], **page)
 
 @app.route("/api/ingredient", methods=['POST', 'GET', 'PUT', 'DELETE'])
 @login_required
@@ -754,6 +918,7 @@ def api_ingredient():
         except ValueError as e:
             return api_error(str(e))
 
+        previous = StockRow.from_model(ingredient)
         # special handling
         if field == 'Size_oz':
             # convert to mL because that's how everything works
@@ -763,23 +928,167 @@ def api_ingredient():
         if field in ['Size_mL', 'Size_oz', 'Price_Paid', 'Type']:
             _update_computed_fields(ingredient)
         try:
+            bump_stored_stock_version(current_bar.id)
             db.session.commit()
         except Exception as e:
             return api_error("{}: {}".format(e.__class__.__name__, e))
 
         data = ingredient.as_dict()
-        mms.regenerate_recipes(current_bar, ingredient=ingredient.type_)
-        return api_success(data, message='Successfully updated "{}" for "{}"'.format(field, ingredient.iid()))
+        version = mms.schedule_regeneration(current_bar._get_current_object(), ingredients=[previous, ingredient])
+        return api_success(data, message='Successfully updated "{}" for "{}"'.format(field, ingredient.iid()),
+                stock_version=version)
 
     # delete
     elif request.method == 'DELETE':
+        previous = StockRow.from_model(ingredient)
+        iid = ingredient.iid()
         db.session.delete(ingredient)
+        bump_stored_stock_version(current_bar.id)
         db.session.commit()
-        mms.regenerate_recipes(current_bar, ingredient=ingredient.type_)
-        return api_success({'iid': ingredient.iid()}, message='Successfully deleted "{}"'.format(ingredient.iid()))
+        version = mms.schedule_regeneration(current_bar._get_current_object(), ingredients=[previous])
+        return api_success({'iid': iid}, message='Successfully deleted "{}"'.format(iid),
+                stock_version=version)
 
     return api_error("Unknwon method")
 
+@app.route("/api/stock_version", methods=['GET'])
+@login_required
+@roles_accepted('admin', 'owner')
+@check_ownership
+def api_stock_version():
+    """Poll after an ingredient change until the recipes reflect it
+    stock_version is bumped by each change, recipes are up to date once
+    live_version has caught up to the stock_version returned by the change
+    """
+    return api_success({'stock_version': stored_stock_version(current_bar.id),
+        'live_version': mms.live_stock_version(current_bar),
+        'pending': mms.regeneration_queue.is_pending(current_bar.id)})
+
+@app.route("/api/cache_stats", methods=['GET'])
+@login_required
+@roles_required('admin')
+def api_cache_stats():
+    return api_success({'recipe_cards': mms.card_cache.stats()})
+
+def like_escape(value):
+    """ Make the LIKE wildcards in value match themselves, with \\ as the escape character """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def paged_query(query, columns, searchable=(), default_order=None, tiebreak=()):
+    """ Apply the paging, ordering and search of a DataTables server-side request
+    (draw, start, length, order[0][column], columns[i][data], search[value]) to query
+    columns maps the names the client may order by to model columns
+    searchable are model columns matched against the search value
+    tiebreak columns follow the order so rows with equal values don't move between pages
+    :returns: the rows of the page and the fields to send with them
+    """
+    total = query.order_by(None).count()
+    search = request.args.get('search[value]', '').strip()
+    if search and searchable:
+        # a substring match so "gin" finds "Dry Gin", no index serves that, so it scans the rows
+        # left by the query's own filters: one bar's stock through its index, or the admin tables
+        pattern = '%{}%'.format(like_escape(search))
+        query = query.filter(or_(*[column.ilike(pattern, escape='\\') for column in searchable]))
+        filtered = query.order_by(None).count()
+    else:
+        filtered = total
+    order_index = request.args.get('order[0][column]', None, int)
+    order_column = columns.get(request.args.get('columns[{}][data]'.format(order_index))) if order_index is not None else None
+    if order_column is not None:
+        query = query.order_by(order_column.desc() if request.args.get('order[0][dir]') == 'desc' else order_column.asc())
+    elif default_order is not None:
+        query = query.order_by(default_order)
+    if tiebreak:
+        query = query.order_by(*tiebreak)
+    max_length = app.config.get('MIXMIND_PAGE_MAX_LENGTH', 500)
+    start = max(request.args.get('start', 0, int), 0)
+    length = min(request.args.get('length', app.config.get('MIXMIND_PAGE_LENGTH', 50), int), max_length)
+    if length < 0: # DataTables' "All"
+        length = max_length
+    rows = query.offset(start).limit(length).all()
+    return rows, {'draw': request.args.get('draw', 0, int), 'recordsTotal': total, 'recordsFiltered': filtered,
+            'start': start, 'length': length}
+
+def _str_or_none(value):
+    return None if value is None else str(value)
+
+@app.route("/api/admin/users", methods=['GET'])
+@login_required
+@roles_required('admin')
+def api_admin_users():
+    columns = {name: getattr(User, name) for name in ['id', 'email', 'first_name', 'last_name', 'nickname',
+        'login_count', 'last_login_at', 'confirmed_at']}
+    query = User.query.options(selectinload(User.roles))
+    users, page = paged_query(query, columns, searchable=[User.email, User.first_name, User.last_name, User.nickname],
+            default_order=User.id)
+    order_counts = dict(db.session.query(Order.user_id, func.count(Order.id))\
+            .filter(Order.user_id.in_([user.id for user in users])).group_by(Order.user_id))
+    data = [{'id': user.id, 'email': user.email, 'first_name': user.first_name, 'last_name': user.last_name,
+        'nickname': user.nickname, 'login_count': user.login_count, 'last_login_at': _str_or_none(user.last_login_at),
+        'confirmed_at': _str_or_none(user.confirmed_at), 'roles': user.get_role_names(),
+        'orders': order_counts.get(user.id, 0)} for user in users]
+    return api_success(data, **page)
+
+@app.route("/api/admin/orders", methods=['GET'])
+@login_required
+@roles_required('admin')
+def api_admin_orders():
+    columns = {name: getattr(Order, name) for name in ['id', 'timestamp', 'confirmed', 'user_id', 'bar_id', 'recipe_name']}
+    query = db.session.query(*columns.values())
+    orders, page = paged_query(query, columns, searchable=[Order.recipe_name, Order.user_email], default_order=Order.id.desc())
+    data = [{'id': order.id, 'timestamp': _str_or_none(order.timestamp), 'confirmed': yes_no(order.confirmed),
+        'user_id': order.user_id, 'bar_id': order.bar_id, 'recipe_name': order.recipe_name} for order in orders]
+    return api_success(data, **page)
+
+@app.route("/api/admin/bars", methods=['GET'])
+@login_required
+@roles_required('admin')
+def api_admin_bars():
+    columns = {name: getattr(Bar, name) for name in ['id', 'name', 'cname', 'is_default', 'is_public']}
+    bars, page = paged_query(Bar.query, columns, searchable=[Bar.name, Bar.cname], default_order=Bar.id)
+    bar_ids = [bar.id for bar in bars]
+    order_counts = dict(db.session.query(Order.bar_id, func.count(Order.id))\
+            .filter(Order.bar_id.in_(bar_ids)).group_by(Order.bar_id))
+    bartender_ids = [bar.bartender_on_duty for bar in bars if bar.bartender_on_duty]
+    bartenders = {user.id: user.get_name_with_email() for user in User.query.filter(User.id.in_(bartender_ids))} if bartender_ids else {}
+    data = [{'id': bar.id, 'name': bar.name, 'cname': bar.cname, 'tagline': bar.tagline,
+        'is_default': bool(bar.is_default), 'is_public': bool(bar.is_public), 'orders': order_counts.get(bar.id, 0),
+        'bartender': bartenders.get(bar.bartender_on_duty)} for bar in bars]
+    return api_success(data, **page)
+
+@app.route("/api/admin/order_stats", methods=['GET'])
+@login_required
+@roles_required('admin')
+def api_admin_order_stats():
+    """ Query the order rollups
+    group_by: bar, bartender, hour or bartender_hour
+    hours: how far back to look, bar_id and bartender_id: optional filters
+    """
+    group_by = request.args.get('group_by', 'bartender')
+    if group_by not in GROUPINGS:
+        return api_error("group_by must be one of {}".format(', '.join(GROUPINGS)))
+    hours, bar_id, bartender_id = _order_stats_args()
+    stats = recent_order_stats(hours=hours, group_by=group_by, bar_id=bar_id, bartender_id=bartender_id)
+    for row in stats:
+        if 'hour' in row:
+            row['hour'] = row['hour'].isoformat()
+    return api_success(stats, hours=hours, group_by=group_by)
+
+@app.route("/api/admin/profile", methods=['GET', 'DELETE'])
+@login_required
+@roles_required('admin')
+def api_admin_profile():
+    """ Percentiles in ms of recent request timings per route, see MIXMIND_PROFILE
+    route: optional "METHOD rule" to limit to, e.g. "GET /"
+    DELETE clears the collected requests
+    """
+    if not profiler.enabled:
+        return api_error("Request profiling is off, set MIXMIND_PROFILE to turn it on")
+    if request.method == 'DELETE':
+        profiler.reset()
+        return api_success({}, message="Cleared request profiles")
+    return api_success(profiler.route_stats(request.args.get('route')), samples=profiler.max_samples)
+
 @app.route("/api/ingredients/download", methods=['GET'])
 @login_required
 @roles_accepted('admin', 'owner')
@@ -865,6 +1174,7 @@ def dev_debug_error_handler_page():
 ################################################################################
 
 @app.route('/api/json/<recipe_name>')
+@conditional(lambda recipe_name: (mms.library_hash, recipe_name))
 def recipe_json(recipe_name):
     recipe_name = urllib.parse.unquote_plus(recipe_name)
     try:
@@ -875,6 +1185,8 @@ def recipe_json(recipe_name):
 
 @app.errorhandler(500)
 def handle_internal_server_error(e):
+    # drop what the failed view left in the session, so nothing commits it after the response
+    db.session.rollback()
     flash(e, 'danger')
     return render_template('error.html')#, 500
 
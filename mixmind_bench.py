@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the mixmind recipe pipeline
+
+Runs against the app configured by config.py and instance/config.py.
+pipeline and mail write synthetic rows, so they run on a temporary sqlite
+database unless MIXMIND_CONFIG already names a config to use.
+"""
+
+import argparse
+import atexit
+import csv
+import os
+import pickle
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import json
+import sys
+from collections import OrderedDict
+
+import jsonschema
+
+from sqlalchemy import event
+
+from flask_mail import Message
+
+# benchmarks that write synthetic rows, and the settings they get on top of the scratch database
+SCRATCH_COMMANDS = {
+    'pipeline': 'MIXMIND_MAIL_OUTBOX = False\n',
+    'mail': 'MIXMIND_MAIL_OUTBOX = True\n', # MAIL_SERVER still has to be a local sink, see bench_mail
+}
+SCRATCH_CONFIG = """
+SQLALCHEMY_DATABASE_URI = "sqlite:///{database}"
+MIXMIND_REGENERATION_DELAY = 0
+"""
+
+def use_scratch_database(settings=''):
+    """ Point the app at a temporary sqlite database, removed on exit,
+    must run before mixmind is imported
+    """
+    directory = tempfile.mkdtemp(prefix='mixmind-bench-db-')
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    config_file = os.path.join(directory, 'config.py')
+    with open(config_file, 'w') as fp:
+        fp.write(SCRATCH_CONFIG.format(database=os.path.join(directory, 'bench.db')) + settings)
+    os.environ['MIXMIND_CONFIG'] = config_file
+
+scratch_command = next((arg for arg in sys.argv[1:] if arg in SCRATCH_COMMANDS), None)
+if __name__ == "__main__" and scratch_command and 'MIXMIND_CONFIG' not in os.environ:
+    use_scratch_database(SCRATCH_COMMANDS[scratch_command])
+
+from mixmind import app, mms
+from mixmind.database import db
+from mixmind.models import Bar, OutgoingMail
+from mixmind.barstock import Ingredient, Barstock_SQL
+from mixmind.barstock import invalidate_stock_index
+from mixmind.notifier import outbox, Notifier
+from mixmind.configuration_management import compile_recipes, RecipeLibrary
+from mixmind.compose_html import recipe_as_html
+from mixmind.util import load_recipe_json, filter_recipes, report_stats, DisplayOptions, FilterOptions
+
+
+class QueryCounter(object):
+    """ Counts the SQL statements executed on the engine while active
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def get_parser():
+    p = argparse.ArgumentParser(description="MixMind benchmarks")
+    subparsers = p.add_subparsers(help='benchmarks', dest='command')
+
+    queries_parser = subparsers.add_parser('queries', help='Count SQL queries issued while generating the recipe library of a bar')
+    queries_parser.add_argument('--bar', default=None, help="cname of the bar to use, default bar if not given")
+    queries_parser.add_argument('-n', '--repeat', default=3, type=int, help="Number of warm regenerations to time")
+
+    mail_parser = subparsers.add_parser('mail', help='Queue a burst of emails in the outbox and time their delivery, '
+            'on a temporary sqlite database, point MAIL_SERVER/MAIL_PORT at a local SMTP sink (e.g. aiosmtpd) '
+            'or set MAIL_SUPPRESS_SEND first')
+    mail_parser.add_argument('-n', '--count', default=500, type=int, help="Number of emails")
+    mail_parser.add_argument('--to', default='bench@example.com', help="Recipient address")
+    mail_parser.add_argument('--timeout', default=120, type=float, help="Seconds to wait for delivery")
+
+    notifier_parser = subparsers.add_parser('notifier', help='Compare Notifier sending with a connection per message, '
+            'a persistent connection and send_many, set smtp_server/smtp_port in the secrets to a local SMTP sink '
+            'along with "smtp_starttls": false')
+    notifier_parser.add_argument('secrets', help="Notifier secrets json")
+    notifier_parser.add_argument('template', help="Notifier html message template")
+    notifier_parser.add_argument('-n', '--count', default=200, type=int, help="Number of emails per mode")
+
+    generate_parser = subparsers.add_parser('generate', help='Write a synthetic barstock csv and recipe json')
+    add_synthetic_arguments(generate_parser)
+    generate_parser.add_argument('-o', '--dir', default='.', help="Directory to write the files to")
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Time each stage of the recipe pipeline and a full "/" request on '
+            'synthetic data, in a temporary sqlite database')
+    add_synthetic_arguments(pipeline_parser)
+    pipeline_parser.add_argument('-n', '--repeat', default=3, type=int, help="Runs of each stage, the median is reported")
+    pipeline_parser.add_argument('--dir', default=None, help="Keep the synthetic files in this directory, temporary if not given")
+    pipeline_parser.add_argument('--output', default=None, help="Write the results json to this file, e.g. to use as a baseline")
+    pipeline_parser.add_argument('--baseline', default=None, help="Results json of an earlier run to compare against, "
+            "exits 1 if any stage regressed")
+    pipeline_parser.add_argument('--threshold', default=0.2, type=float, help="Slowdown over the baseline counted as a regression")
+    pipeline_parser.add_argument('--min-delta', default=0.002, type=float, help="Seconds, smaller slowdowns are never regressions")
+
+    p.add_argument('--json', action='store_true', help="Print results as json")
+    return p
+
+def add_synthetic_arguments(parser):
+    parser.add_argument('--bottles', default=5000, type=int, help="Number of bottles in the barstock")
+    parser.add_argument('--recipes', default=10000, type=int, help="Number of recipes")
+    parser.add_argument('--seed', default=1, type=int, help="Random seed, the same seed gives the same files")
+
+def get_bar(cname):
+    if cname:
+        return Bar.query.filter_by(cname=cname).one()
+    return Bar.query.filter_by(is_default=True).first()
+
+def bench_queries(args):
+    bar = get_bar(args.bar)
+    results = {'bar': bar.cname, 'recipes': len(mms.base_recipes)}
+    with QueryCounter(db.engine) as counter:
+        invalidate_stock_index(bar.id)
+        start = time.perf_counter()
+        mms.generate_recipes(bar)
+        results['cold_seconds'] = time.perf_counter() - start
+    results['cold_queries'] = counter.count
+    with QueryCounter(db.engine) as counter:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            mms.generate_recipes(bar)
+        results['warm_seconds'] = (time.perf_counter() - start) / max(args.repeat, 1)
+    results['warm_queries'] = counter.count / float(max(args.repeat, 1))
+    return results
+
+# mail servers the mail benchmark may deliver to
+LOCAL_MAIL_SERVERS = ['localhost', '127.0.0.1', '::1']
+
+def bench_mail(args):
+    if app.config.get('MAIL_SERVER') not in LOCAL_MAIL_SERVERS and not app.config.get('MAIL_SUPPRESS_SEND'):
+        sys.exit("mail: MAIL_SERVER is {}, point it at a local SMTP sink or set MAIL_SUPPRESS_SEND".format(
+            app.config.get('MAIL_SERVER')))
+    results = {'count': args.count, 'mail_server': '{}:{}'.format(app.config.get('MAIL_SERVER'), app.config.get('MAIL_PORT')),
+            'suppress_send': bool(app.config.get('MAIL_SUPPRESS_SEND'))}
+    start = time.perf_counter()
+    first_id = None
+    for i in range(args.count):
+        msg = Message("Benchmark order {}".format(i), sender=app.config.get('MAIL_USERNAME') or 'bench@example.com',
+                recipients=[args.to], html="<p>Martini for bench {}</p>".format(i))
+        outgoing = outbox.enqueue(msg, 'benchmark')
+        first_id = first_id or outgoing.id
+    results['enqueue_ms_per_email'] = (time.perf_counter() - start) * 1000 / max(args.count, 1)
+    queued = OutgoingMail.query.filter(OutgoingMail.id >= first_id)
+    while time.perf_counter() - start < args.timeout:
+        db.session.rollback() # see the workers' commits
+        if queued.filter(OutgoingMail.status.in_(['pending', 'sending'])).count() == 0:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    results['sent'] = queued.filter_by(status='sent').count()
+    results['failed_or_waiting'] = args.count - results['sent']
+    results['seconds_to_deliver'] = elapsed
+    results['emails_per_second'] = results['sent'] / elapsed
+    return results
+
+def bench_notifier(args):
+    results = {'count': args.count}
+    fills = [("Benchmark order {}".format(i), {'_GREETING_': 'Hi', '_SUMMARY_': "Bench {} has ordered a Martini".format(i),
+        '_RECIPE_': "Martini Recipe", '_EXTRA_': ''}) for i in range(args.count)]
+
+    notifier = Notifier(args.secrets, args.template)
+    start = time.perf_counter()
+    for subject, fill in fills:
+        notifier.send(subject, fill)
+    results['per_message_connection_ms'] = (time.perf_counter() - start) * 1000 / max(args.count, 1)
+
+    with Notifier(args.secrets, args.template, persistent=True) as notifier:
+        start = time.perf_counter()
+        for subject, fill in fills:
+            notifier.send(subject, fill)
+        results['persistent_ms'] = (time.perf_counter() - start) * 1000 / max(args.count, 1)
+
+    notifier = Notifier(args.secrets, args.template)
+    start = time.perf_counter()
+    notifier.send_many(fills)
+    results['send_many_ms'] = (time.perf_counter() - start) * 1000 / max(args.count, 1)
+
+    start = time.perf_counter()
+    for _, fill in fills:
+        notifier.fill_template(fill)
+    results['fill_template_us'] = (time.perf_counter() - start) * 1e6 / max(args.count, 1)
+    return results
+
+# share of the bottles at a bar in each category
+CATEGORY_WEIGHTS = OrderedDict([('Spirit', 55), ('Liqueur', 20), ('Vermouth', 6), ('Bitters', 6), ('Wine', 5),
+    ('Syrup', 3), ('Juice', 2), ('Mixer', 2), ('Beer', 1)])
+# types in each category, weighted by how common they are in a stock and in recipes
+TYPE_WEIGHTS = {
+    'Spirit': [('dry gin', 8), ('vodka', 8), ('white rum', 5), ('amber rum', 4), ('dark rum', 3), ('rye whiskey', 5),
+        ('bourbon whiskey', 6), ('scotch whisky', 5), ('cognac', 3), ('brandy', 3), ('silver tequila', 4),
+        ('reposado tequila', 2), ('mezcal', 2), ('genever', 1), ('aquavit', 1), ('old tom gin', 1), ('calvados', 1), ('pisco', 1)],
+    'Liqueur': [('orange liqueur', 4), ('maraschino liqueur', 2), ('coffee liqueur', 2), ('amaretto', 2), ('campari', 1),
+        ('green chartreuse', 1), ('crème de cassis', 1), ('apricot brandy', 1), ('cherry liqueur', 1),
+        ('elderflower liqueur', 1), ('absinthe', 1), ('amaro', 3), ('fernet', 1)],
+    'Vermouth': [('dry vermouth', 3), ('sweet vermouth', 3), ('blanc vermouth', 1)],
+    'Bitters': [('aromatic bitters', 2), ('orange bitters', 2), ('peach bitters', 1), ('chocolate bitters', 1)],
+    'Wine': [('champagne', 2), ('prosecco', 2), ('red wine', 1), ('white wine', 1)],
+    'Syrup': [('simple syrup', 3), ('rich simple syrup', 1), ('honey syrup', 1), ('grenadine', 1), ('orgeat', 1), ('maple syrup', 1)],
+    'Juice': [('lemon juice', 3), ('lime juice', 3), ('orange juice', 1), ('grapefruit juice', 1), ('pineapple juice', 1), ('cranberry juice', 1)],
+    'Mixer': [('soda water', 3), ('tonic water', 2), ('ginger beer', 2), ('cola', 1)],
+    'Beer': [('lager', 1)],
+}
+# (abv range, bottle sizes in mL, price range in $/mL)
+CATEGORY_BOTTLES = {
+    'Spirit': ((37.5, 57.0), [700, 750, 750, 750, 1000, 1750], (0.02, 0.12)),
+    'Liqueur': ((15.0, 40.0), [375, 700, 750], (0.02, 0.06)),
+    'Vermouth': ((15.0, 18.0), [375, 750, 1000], (0.01, 0.04)),
+    'Bitters': ((35.0, 48.0), [118, 148, 200], (0.05, 0.15)),
+    'Wine': ((11.0, 14.0), [750], (0.01, 0.06)),
+    'Syrup': ((0.0, 0.0), [355, 750, 1000], (0.002, 0.01)),
+    'Juice': ((0.0, 0.0), [30, 45, 1000], (0.002, 0.01)),
+    'Mixer': ((0.0, 0.0), [178, 355, 1000], (0.002, 0.01)),
+    'Beer': ((4.0, 6.0), [355], (0.004, 0.01)),
+}
+BRAND_SYLLABLES = 'ar bel cor dan el fen gal har ive jor kel lan mor nor ol pen quin ros sel tor ul ven wil yar zen'.split()
+EXPRESSIONS = ['', '', '', 'Reserve', 'Special', 'Small Batch', 'Navy Strength', 'Aged', 'Single Barrel', 'Export', 'Classic']
+NAME_WORDS = ('Velvet Golden Smoky Bitter Midnight Copper Southern Royal Crimson Silent Last Old Paper Jungle Emerald '
+        'Hanky Salty Winter Summer Electric').split(), ('Sour Fizz Flip Smash Cobbler Daisy Sling Punch Collins '
+        'Highball Rickey Julep Cocktail Special Bird Word Plane Kiss Garden Harbor').split()
+GARNISHES = ['Lemon twist', 'Orange twist', 'Lime wheel', 'Cherry', 'Mint sprig', 'Grated nutmeg', 'Olive', 'Orange slice']
+AMOUNTS = {'oz': [0.25, 0.5, 0.75, 1.0, 1.5, 2.0], 'cL': [1.0, 1.5, 2.0, 3.0, 4.5, 6.0], 'mL': [7.5, 15.0, 22.5, 30.0, 45.0, 60.0]}
+
+def _schema_enum(schema, field):
+    return schema['additionalProperties']['properties'][field]['enum']
+
+def _weighted(rng, weighted):
+    items, weights = zip(*weighted)
+    return rng.choices(items, weights)[0]
+
+def synthetic_barstock(bottles, seed=1):
+    """ Rows for a barstock csv of the given number of bottles,
+    spread over categories and types by CATEGORY_WEIGHTS and TYPE_WEIGHTS
+    """
+    rng = random.Random(seed)
+    rows = []
+    kinds = set()
+    for _ in range(bottles):
+        category = _weighted(rng, CATEGORY_WEIGHTS.items())
+        type_ = _weighted(rng, TYPE_WEIGHTS[category])
+        (abv_low, abv_high), sizes, (price_low, price_high) = CATEGORY_BOTTLES[category]
+        brand = ''.join(rng.choice(BRAND_SYLLABLES) for _ in range(rng.randint(2, 3))).title()
+        kind = ' '.join(word for word in [brand, rng.choice(EXPRESSIONS)] if word)
+        while (type_, kind) in kinds:
+            kind = '{} {}'.format(kind, rng.randint(2, 99))
+        kinds.add((type_, kind))
+        size = rng.choice(sizes)
+        rows.append(OrderedDict([('Category', category), ('Ingredient', type_.title()), ('Kind', kind),
+            ('In Stock', 1 if rng.random() < 0.9 else 0), ('ABV', round(rng.uniform(abv_low, abv_high), 1)),
+            ('Size (mL)', float(size)), ('Price Paid', round(size * rng.uniform(price_low, price_high), 2))]))
+    return rows
+
+def synthetic_recipes(count, schema, barstock=(), seed=1):
+    """ Recipe dict in the format of the recipe json files, valid against schema
+    :param list barstock: rows from synthetic_barstock, a few recipes ask for a kind from these
+    """
+    rng = random.Random(seed)
+    types = {category: [type_ for type_, _ in weights] for category, weights in TYPE_WEIGHTS.items()}
+    kinds = {}
+    for row in barstock:
+        kinds.setdefault(row['Ingredient'].lower(), []).append(row['Kind'])
+    recipes = OrderedDict()
+    for i in range(count):
+        name = '{} {}'.format(rng.choice(NAME_WORDS[0]), rng.choice(NAME_WORDS[1]))
+        if name in recipes:
+            name = '{} No. {}'.format(name, i)
+        unit = rng.choice(_schema_enum(schema, 'unit'))
+        amount = lambda: rng.choice(AMOUNTS[unit])
+        ingredients = OrderedDict()
+        for _ in range(rng.choice([1, 1, 1, 2])):
+            roll = rng.random()
+            if roll < 0.05:
+                type_ = rng.choice(['rum', 'whiskey', 'tequila', 'any spirit'])
+            else:
+                type_ = _weighted(rng, TYPE_WEIGHTS['Spirit'])
+                if roll > 0.97 and kinds.get(type_):
+                    type_ = '{}:{}'.format(type_, rng.choice(kinds[type_]))
+            ingredients[type_] = amount()
+        for _ in range(rng.choice([0, 1, 1, 2])):
+            ingredients[_weighted(rng, TYPE_WEIGHTS[rng.choice(['Liqueur', 'Vermouth'])])] = amount()
+        if rng.random() < 0.6:
+            ingredients[_weighted(rng, TYPE_WEIGHTS['Juice'])] = amount()
+            if rng.random() < 0.7:
+                ingredients[_weighted(rng, TYPE_WEIGHTS['Syrup'])] = rng.choice([amount(), '1 tsp'])
+        if rng.random() < 0.3:
+            ingredients[rng.choice(types['Bitters'] + ['bitters'])] = rng.choice(['dash', '2 dashes', '1 to 2 dashes'])
+        if rng.random() < 0.2:
+            ingredients[rng.choice(types['Mixer'] + types['Wine'])] = 'Top with'
+        recipe = OrderedDict([('style', rng.choice(_schema_enum(schema, 'style'))), ('unit', unit),
+            ('ingredients', ingredients), ('prep', rng.choice(_schema_enum(schema, 'prep'))),
+            ('ice', rng.choice(_schema_enum(schema, 'ice'))), ('glass', rng.choice(_schema_enum(schema, 'glass')))])
+        if rng.random() < 0.5:
+            recipe['tag'] = 'core'
+        if rng.random() < 0.1:
+            recipe['optional'] = {_weighted(rng, TYPE_WEIGHTS['Juice']): amount()}
+        if rng.random() < 0.4:
+            recipe['garnish'] = rng.choice(GARNISHES)
+        if rng.random() < 0.3:
+            recipe['info'] = "A {} with a {} backbone".format(recipe['style'].lower(), next(iter(ingredients)).split(':')[0])
+        if rng.random() < 0.1:
+            recipe['origin'] = "Synthetic bar no. {}".format(rng.randint(1, 100))
+        if rng.random() < 0.2:
+            recipe['profile'] = rng.sample(schema['additionalProperties']['properties']['profile']['items']['enum'], 2)
+        if rng.random() < 0.05:
+            recipe['variants'] = ["Substitute {} for the base".format(_weighted(rng, TYPE_WEIGHTS['Spirit']))]
+        recipes[name] = recipe
+    return recipes
+
+def load_schema():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recipe_schema.json')) as fp:
+        return json.load(fp)
+
+def write_synthetic_files(directory, bottles, recipes, seed=1):
+    """ Write barstock csv and recipe json files, returns their paths
+    """
+    schema = load_schema()
+    barstock = synthetic_barstock(bottles, seed)
+    recipe_dict = synthetic_recipes(recipes, schema, barstock, seed)
+    jsonschema.validate(recipe_dict, schema)
+    barstock_file = os.path.join(directory, 'barstock-{}-{}.csv'.format(bottles, seed))
+    with open(barstock_file, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=list(barstock[0].keys()) if barstock else [])
+        writer.writeheader()
+        writer.writerows(barstock)
+    recipe_file = os.path.join(directory, 'recipes-{}-{}.json'.format(recipes, seed))
+    with open(recipe_file, 'w') as fp:
+        json.dump(recipe_dict, fp, indent=4)
+    return barstock_file, recipe_file
+
+def bench_generate(args):
+    os.makedirs(args.dir, exist_ok=True)
+    barstock_file, recipe_file = write_synthetic_files(args.dir, args.bottles, args.recipes, args.seed)
+    return {'barstock': barstock_file, 'recipes': recipe_file}
+
+def timed(run, repeat, setup=None):
+    """ Median seconds of repeat calls to run(setup()), and the last result
+    """
+    times = []
+    result = None
+    for _ in range(max(repeat, 1)):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = run(arg) if setup else run()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+# filters applied in the filter_recipes stage, the first is what "/" uses
+BENCH_FILTERS = [
+    FilterOptions(search="", all_=False, include="", exclude="", include_use_or=False, exclude_use_or=False,
+        style="", glass="", prep="", ice="", tag="core"),
+    FilterOptions(search="gin", all_=False, include="", exclude="", include_use_or=False, exclude_use_or=False,
+        style="", glass="", prep="", ice="", tag=""),
+    FilterOptions(search="", all_=True, include="lemon juice,simple syrup", exclude="vodka", include_use_or=False,
+        exclude_use_or=False, style="", glass="coupe", prep="", ice="", tag=""),
+    FilterOptions(search="", all_=False, include="rum,whiskey", exclude="", include_use_or=True, exclude_use_or=False,
+        style="All Day Cocktail", glass="", prep="shake", ice="", tag=""),
+]
+BENCH_DISPLAY = DisplayOptions(prices=True, stats=True, examples=True, all_ingredients=False, markup=1.1,
+        prep_line=True, origin=True, info=True, variants=True)
+
+def bench_pipeline(args):
+    directory = args.dir or tempfile.mkdtemp(prefix='mixmind-bench-')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        results = run_pipeline(args, *write_synthetic_files(directory, args.bottles, args.recipes, args.seed))
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            results.update(compare_to_baseline(results, json.load(fp), args.threshold, args.min_delta))
+    return results
+
+def run_pipeline(args, barstock_file, recipe_file):
+    bar = get_bar(None)
+    timings = {}
+    counts = {}
+
+    timings['load_recipe_json'], base_recipes = timed(lambda: load_recipe_json([recipe_file]), args.repeat)
+    timings['drink_recipe_init'], recipes = timed(lambda: compile_recipes(base_recipes), args.repeat)
+    library = pickle.dumps(recipes, pickle.HIGHEST_PROTOCOL)
+    counts['recipes'] = len(recipes)
+
+    timings['load_barstock_csv'], report = timed(lambda: Barstock_SQL(bar.id).load_from_csv([barstock_file], bar.id), args.repeat)
+    counts['bottles'] = report.inserted
+    barstock = Barstock_SQL(bar.id)
+    counts['in_stock'] = len(barstock.index)
+
+    timings['generate_examples'], recipes = timed(lambda recipes: [recipe.generate_examples(barstock) for recipe in recipes],
+            args.repeat, setup=lambda: pickle.loads(library))
+    timings['calculate_stats'], _ = timed(lambda recipes: [recipe.calculate_stats() for recipe in recipes],
+            args.repeat, setup=lambda: [recipe.generate_examples(barstock) for recipe in pickle.loads(library)])
+    timings['generate_examples_with_stats'], recipes = timed(lambda recipes: [recipe.generate_examples(barstock, stats=True)
+        for recipe in recipes], args.repeat, setup=lambda: pickle.loads(library))
+    counts['can_make'] = sum(1 for recipe in recipes if recipe.can_make)
+
+    processed = RecipeLibrary(recipes)
+    timings['search_index'], _ = timed(lambda: RecipeLibrary(recipes).search_index, args.repeat)
+    processed.search_index
+    timings['filter_recipes'], _ = timed(lambda: [filter_recipes(processed, options, union_results=bool(options.search))
+        for options in BENCH_FILTERS], args.repeat)
+    made = [recipe for recipe in processed if recipe.can_make]
+    timings['report_stats'], _ = timed(lambda: report_stats(made, as_html=True), args.repeat)
+    timings['recipe_as_html'], _ = timed(lambda: [recipe_as_html(recipe, BENCH_DISPLAY, order_link='/order/bench')
+        for recipe in processed], args.repeat)
+
+    # serve the synthetic library from the default bar
+    mms.load_library([recipe_file], use_snapshot=False)
+    timings['generate_recipes'], _ = timed(lambda: mms.generate_recipes(bar), args.repeat)
+    client = app.test_client()
+    mms.generate_recipes(bar)
+    start = time.perf_counter()
+    response = client.get('/')
+    timings['request_index_cold'] = time.perf_counter() - start
+    if response.status_code != 200:
+        raise SystemExit("GET / returned {}".format(response.status_code))
+    counts['index_bytes'] = len(response.data)
+    timings['request_index'], _ = timed(lambda: client.get('/'), args.repeat)
+
+    params = {'bottles': args.bottles, 'recipes': args.recipes, 'seed': args.seed, 'repeat': args.repeat}
+    return {'params': params, 'counts': counts, 'timings': {stage: round(seconds, 6) for stage, seconds in timings.items()}}
+
+def compare_to_baseline(results, baseline, threshold=0.2, min_delta=0.002):
+    """ Ratio of each stage's time to the baseline's, a stage regressed if it is
+    both threshold slower and min_delta seconds slower
+    """
+    comparison = {'ratios': {}, 'failed': []}
+    if baseline.get('params') != results['params']:
+        comparison['baseline_params'] = baseline.get('params')
+    for stage, seconds in results['timings'].items():
+        before = baseline.get('timings', {}).get(stage)
+        if not before:
+            continue
+        comparison['ratios'][stage] = round(seconds / before, 3)
+        if seconds > before * (1 + threshold) and seconds - before > min_delta:
+            comparison['failed'].append(stage)
+    return comparison
+
+def main():
+    args = get_parser().parse_args()
+    benchmarks = {
+        'queries': bench_queries,
+        'mail': bench_mail,
+        'notifier': bench_notifier,
+        'generate': bench_generate,
+        'pipeline': bench_pipeline,
+    }
+    if args.command not in benchmarks:
+        get_parser().print_help()
+        return
+    with app.app_context():
+        results = benchmarks[args.command](args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print("{:>16}: {}".format(key, value))
+    if results.get('failed'):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import argparse
 import pickle as pickle
 from collections import Counter, defaultdict
 import json
+import shutil
 import jsonschema
 
 import pandas as pd
@@ -205,7 +206,14 @@ def main():
         else:
             barstock_df = barstock.df
         pdf_options = bundle_options(util.PdfOptions, args)
-        formatted_menu.generate_recipes_pdf(recipes, pdf_options, display_options, barstock_df)
+        # built once per content in the menus cache, then copied to the requested name
+        job = formatted_menu.pdf_queue.submit(recipes, pdf_options, display_options, barstock_df)
+        if not job.wait():
+            print("Failed to build the pdf: {}".format(job.error))
+            return
+        for ext in ('tex', 'pdf'):
+            shutil.copyfile('{}.{}'.format(job.filename, ext), '{}.{}'.format(pdf_options.pdf_filename, ext))
+        print("Wrote {}.pdf".format(pdf_options.pdf_filename))
         return
 
     if args.command == 'txt':
@@ -0,0 +1,59 @@
+""" Test setup, the app is pointed at a scratch sqlite database
+and pdf cache before mixmind is first imported
+"""
+import datetime
+import os
+import shutil
+import tempfile
+
+import pytest
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix='mixmind-tests-')
+
+TEST_CONFIG = """
+SQLALCHEMY_DATABASE_URI = "sqlite:///{database}"
+SECRET_KEY = "test-secret-key"
+SECURITY_PASSWORD_SALT = "test-salt"
+SECURITY_PASSWORD_HASH = "plaintext"
+WTF_CSRF_ENABLED = False
+DEBUG = False
+MAIL_SUPPRESS_SEND = True
+MAIL_DEFAULT_SENDER = "bar@example.com"
+MIXMIND_MAIL_OUTBOX = False
+MIXMIND_RECIPE_SNAPSHOT = False
+MIXMIND_REGENERATION_DELAY = 0
+MIXMIND_PDF_CACHE_DIR = "{pdfs}"
+"""
+
+config_file = os.path.join(SCRATCH_DIR, 'config.py')
+with open(config_file, 'w') as fp:
+    fp.write(TEST_CONFIG.format(database=os.path.join(SCRATCH_DIR, 'test.db'), pdfs=os.path.join(SCRATCH_DIR, 'menus')))
+os.environ['MIXMIND_CONFIG'] = config_file
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+@pytest.fixture(scope='session')
+def app():
+    from mixmind import app
+    return app
+
+@pytest.fixture(scope='session')
+def admin_id(app):
+    from mixmind.database import db
+    from mixmind.authorization import user_datastore
+    with app.app_context():
+        admin = user_datastore.create_user(email='admin@example.com', first_name='Admin', active=True,
+                confirmed_at=datetime.datetime.utcnow())
+        user_datastore.add_role_to_user(admin, user_datastore.find_or_create_role('admin'))
+        db.session.commit()
+        return admin.id
+
+@pytest.fixture
+def client(app, admin_id):
+    """ Test client logged in as an admin of the default bar """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+    return client
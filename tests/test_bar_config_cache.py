@@ -0,0 +1,40 @@
+""" Concurrent requests that find the bar configs stale reload them once
+"""
+import threading
+import time
+
+from mixmind.configuration_management import BarConfigCache
+
+THREADS = 8
+
+def test_stale_snapshot_reloaded_once(app, monkeypatch):
+    cache = BarConfigCache(max_age=10)
+    loads = []
+    load = cache.load
+    def slow_load():
+        loads.append(threading.current_thread().name)
+        time.sleep(0.2) # the others arrive while this one is querying
+        return load()
+    monkeypatch.setattr(cache, 'load', slow_load)
+
+    start = threading.Barrier(THREADS)
+    snapshots = []
+    def request():
+        with app.app_context():
+            start.wait()
+            snapshots.append(cache.get())
+    threads = [threading.Thread(target=request) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert len(snapshots) == THREADS
+    assert all(snapshot is snapshots[0] for snapshot in snapshots)
+    assert snapshots[0].default_ids
+
+    cache.invalidate()
+    with app.app_context():
+        assert cache.get() is not snapshots[0]
+    assert len(loads) == 2
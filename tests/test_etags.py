@@ -0,0 +1,39 @@
+""" ETags of the stock views follow the stock in the database, so a change
+made by another process is not answered with 304
+"""
+import pytest
+
+from mixmind.database import db
+from mixmind.models import Bar
+from mixmind.barstock import Ingredient, bump_stored_stock_version
+
+@pytest.mark.parametrize('url', ['/', '/api/ingredients?draw=1&start=0&length=50'])
+def test_etag_changes_with_stock_of_other_process(app, client, url):
+    first = client.get(url)
+    etag = first.headers.get('ETag')
+    assert first.status_code == 200 and etag
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    with app.app_context():
+        bar_id = Bar.query.filter_by(is_default=True).one().id
+        # as another process would, this one's stock index is left alone
+        ingredient = Ingredient.query.filter_by(bar_id=bar_id).first()
+        ingredient.In_Stock = not ingredient.In_Stock
+        bump_stored_stock_version(bar_id)
+        db.session.commit()
+
+    second = client.get(url, headers={'If-None-Match': etag})
+    assert second.status_code == 200
+    assert second.headers.get('ETag') != etag
+
+def test_stock_version_api_catches_up_with_other_process(app, client):
+    with app.app_context():
+        bar_id = Bar.query.filter_by(is_default=True).one().id
+        ingredient = Ingredient.query.filter_by(bar_id=bar_id).first()
+        ingredient.In_Stock = not ingredient.In_Stock
+        bump_stored_stock_version(bar_id)
+        db.session.commit()
+
+    data = client.get('/api/stock_version').get_json()['data']
+    assert data['live_version'] == data['stock_version']
+    assert not data['pending']
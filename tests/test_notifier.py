@@ -0,0 +1,70 @@
+""" Notifier's persistent SMTP connection is quit once idle, without waiting
+for another send
+"""
+import json
+import time
+
+import pytest
+
+from mixmind import notifier
+
+class FakeSMTP(object):
+    opened = []
+
+    def __init__(self, host, port):
+        self.sent = 0
+        self.quit_called = False
+        FakeSMTP.opened.append(self)
+
+    def ehlo(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+    def sendmail(self, sender, recipients, message):
+        self.sent += 1
+
+    def quit(self):
+        self.quit_called = True
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def persistent_notifier(tmp_path, monkeypatch):
+    FakeSMTP.opened = []
+    monkeypatch.setattr(notifier.smtplib, 'SMTP', FakeSMTP)
+    secrets = tmp_path / 'secrets.json'
+    secrets.write_text(json.dumps({'sender_email': 'bar@example.com', 'sender_pass': 'x', 'sender_name': 'Bar',
+        'target_email': 'guest@example.com', 'smtp_server': 'localhost', 'smtp_starttls': False}))
+    template = tmp_path / 'template.html'
+    template.write_text('<p>_SUMMARY_</p>')
+    n = notifier.Notifier(str(secrets), str(template), persistent=True, idle_timeout=0.2)
+    yield n
+    n.close()
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+def test_idle_connection_is_quit(persistent_notifier):
+    persistent_notifier.send("Order", {'_SUMMARY_': 'Martini'})
+    persistent_notifier.send("Order", {'_SUMMARY_': 'Negroni'})
+    assert len(FakeSMTP.opened) == 1
+    server = FakeSMTP.opened[0]
+    assert server.sent == 2 and not server.quit_called
+
+    assert wait_for(lambda: server.quit_called)
+    assert persistent_notifier._server is None
+
+def test_connection_in_use_stays_open(persistent_notifier):
+    # sends closer together than idle_timeout keep re-arming the timer
+    for _ in range(6):
+        persistent_notifier.send("Order", {'_SUMMARY_': 'Martini'})
+        time.sleep(0.1)
+    assert len(FakeSMTP.opened) == 1
+    assert not FakeSMTP.opened[0].quit_called
+    assert wait_for(lambda: FakeSMTP.opened[0].quit_called)
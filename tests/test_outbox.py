@@ -0,0 +1,34 @@
+""" Mail queued during a request is saved on its own, without committing
+the request's other pending changes
+"""
+import pytest
+from flask_mail import Message
+
+from mixmind.database import db
+from mixmind.models import OutgoingMail, User
+from mixmind.notifier import outbox
+
+@pytest.fixture
+def no_workers(monkeypatch):
+    monkeypatch.setattr(outbox, 'wake', lambda: None)
+
+def finish_request(app, status):
+    return app.process_response(app.response_class('', status=status))
+
+def queue(subject):
+    outbox.enqueue(Message(subject, sender='bar@example.com', recipients=['guest@example.com'], html='<p>Martini</p>'), 'test')
+
+def test_queued_mail_saved_without_request_changes(app, admin_id, no_workers):
+    with app.test_request_context():
+        User.query.get(admin_id).first_name = 'Uncommitted'
+        queue('Saved on success')
+        finish_request(app, 200)
+        db.session.rollback()
+        assert User.query.get(admin_id).first_name == 'Admin'
+        assert OutgoingMail.query.filter_by(subject='Saved on success').count() == 1
+
+def test_queued_mail_dropped_on_error(app, admin_id, no_workers):
+    with app.test_request_context():
+        queue('Dropped on error')
+        finish_request(app, 500)
+        assert OutgoingMail.query.filter_by(subject='Dropped on error').count() == 0
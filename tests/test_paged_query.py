@@ -0,0 +1,44 @@
+""" Search of the DataTables server-side endpoints matches the value literally,
+LIKE wildcards in it don't match everything
+"""
+import pytest
+
+from mixmind.database import db
+from mixmind.models import Bar
+from mixmind.barstock import Ingredient, _computed_fields, bump_stored_stock_version
+
+KIND = 'Overproof 100% Rye'
+
+@pytest.fixture
+def percent_row(app):
+    with app.app_context():
+        bar_id = Bar.query.filter_by(is_default=True).one().id
+        fields = {'bar_id': bar_id, 'Category': 'Spirit', 'Type': 'Rye Whiskey', 'Kind': KIND, 'ABV': 50.0,
+                'Size_mL': 750.0, 'Price_Paid': 30.0, 'In_Stock': True}
+        fields.update(_computed_fields(fields))
+        db.session.add(Ingredient(**fields))
+        bump_stored_stock_version(bar_id)
+        db.session.commit()
+    yield
+    with app.app_context():
+        Ingredient.query.filter_by(Kind=KIND).delete()
+        bump_stored_stock_version(bar_id)
+        db.session.commit()
+
+def search(client, value):
+    response = client.get('/api/ingredients', query_string={'draw': 1, 'start': 0, 'length': 500, 'search[value]': value})
+    data = response.get_json()
+    return data['recordsFiltered'], [row['Kind'] for row in data['data']]
+
+@pytest.mark.parametrize('value', ['100%', '0%', '% R', '%'])
+def test_percent_matches_literally(client, percent_row, value):
+    assert search(client, value) == (1, [KIND])
+
+@pytest.mark.parametrize('value', ['_', '\\', '1_0'])
+def test_wildcard_alone_matches_nothing(client, percent_row, value):
+    assert search(client, value) == (0, [])
+
+def test_substring_search(client, percent_row):
+    count, kinds = search(client, 'rye')
+    assert KIND in kinds
+    assert count == len(kinds) > 1
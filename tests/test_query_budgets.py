@@ -0,0 +1,28 @@
+""" Most SQL statements each view may run, as an admin of the default bar,
+going over usually means a lazy load in a loop
+"""
+import pytest
+
+from mixmind.database import db
+from mixmind.profiling import query_budget
+
+# the first request also loads the bar configs and the stock index,
+# views with an ETag read the bar's stock version for it
+ROUTE_BUDGETS = [
+    ('/', 5),
+    ('/order/Martini', 3),
+    ('/manage/ingredients', 3),
+    ('/api/ingredients?draw=1&start=0&length=50', 5),
+    ('/admin/dashboard', 3),
+    ('/user?user_id={user_id}', 5),
+]
+
+@pytest.mark.parametrize('route, budget', ROUTE_BUDGETS)
+def test_view_within_query_budget(client, admin_id, route, budget):
+    url = route.format(user_id=admin_id)
+    for _ in range(2):
+        # start each request with an empty session like a real one
+        db.session.remove()
+        with query_budget(budget, url):
+            response = client.get(url)
+        assert response.status_code == 200, url
@@ -0,0 +1,60 @@
+""" The queries run per request or per stock lookup should each read through
+an index, checked with EXPLAIN QUERY PLAN on the scratch sqlite database
+"""
+import datetime
+import re
+import uuid
+
+import pytest
+from sqlalchemy import func
+
+from mixmind.database import db
+from mixmind.models import Order, OrderRollup, OrderLatencyRollup
+from mixmind.barstock import Ingredient
+from mixmind.views import CATEGORY_ORDER
+
+SINCE = datetime.datetime(2020, 1, 1)
+
+HOT_QUERIES = {
+    'orders of a bar (bar_settings)': lambda: Order.query.filter_by(bar_id=1),
+    'orders by email (post_login_redirect)': lambda: Order.query.filter_by(user_email='guest@example.com'),
+    'order counts per user (admin users)': lambda: db.session.query(Order.user_id, func.count(Order.id))\
+            .filter(Order.user_id.in_([1, 2, 3])).group_by(Order.user_id),
+    'in stock ingredients (StockIndex.load)': lambda: Ingredient.query.filter_by(bar_id=1, In_Stock=True)\
+            .order_by(Ingredient.Type, Ingredient.Kind),
+    'ingredient by iid (query_by_iid)': lambda: Ingredient.query.filter_by(uuid=uuid.uuid4()),
+    'ingredient by kind (add_row)': lambda: Ingredient.query.filter_by(bar_id=1, Kind='Beefeater', Type='dry gin'),
+    'ingredients by category (api_ingredients)': lambda: Ingredient.query.filter_by(bar_id=1)\
+            .order_by(Ingredient.Category, Ingredient.Type),
+    'ingredient page (api_ingredients server-side)': lambda: Ingredient.query.filter_by(bar_id=1)\
+            .order_by(CATEGORY_ORDER, Ingredient.Type, Ingredient.Kind).offset(100).limit(50),
+    'recent order rollups (order_stats)': lambda: OrderRollup.query.filter(OrderRollup.hour >= SINCE),
+    'recent latency rollups (order_stats)': lambda: OrderLatencyRollup.query.filter(OrderLatencyRollup.hour >= SINCE),
+}
+
+# a plan step reading a whole table, not through an index
+TABLE_SCAN = re.compile(r'^SCAN (TABLE )?\S+$')
+
+@pytest.fixture(scope='module')
+def cursor(app):
+    with app.app_context():
+        assert db.engine.dialect.name == 'sqlite'
+        db.create_all()
+        connection = db.engine.raw_connection()
+        try:
+            yield connection.cursor()
+        finally:
+            connection.close()
+
+def query_plan(cursor, query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[key] for key in compiled.positiontup]
+    params = [str(value) if isinstance(value, uuid.UUID) else value for value in params]
+    cursor.execute('EXPLAIN QUERY PLAN {}'.format(compiled), params)
+    return [row[-1] for row in cursor.fetchall()]
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_an_index(app, cursor, name):
+    with app.app_context():
+        plan = query_plan(cursor, HOT_QUERIES[name]())
+    assert not any(TABLE_SCAN.match(step) for step in plan), '; '.join(plan)
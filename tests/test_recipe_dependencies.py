@@ -0,0 +1,106 @@
+""" RecipeDependencies against a brute-force reference: the recipes whose
+quantized ingredients pick a stock row up from a StockIndex holding only that row
+"""
+import csv
+import os
+
+import pytest
+
+EXTRA_RECIPES = {
+    'Test Rum': {'ingredients': {'rum': 2, 'lime juice': 0.75}},
+    'Test Whisky': {'ingredients': {'whisky': 2}},
+    'Test Whiskey': {'ingredients': {'whiskey': 2}},
+    'Test Any Spirit': {'ingredients': {'any spirit': 2}},
+    'Test Bitters': {'ingredients': {'rye whiskey': 2, 'bitters': 'dash'}},
+    'Test Type Kind': {'ingredients': {'aromatic bitters:Angostura': 'dash', 'dry gin': 2}},
+    'Test Generic Kind': {'ingredients': {'rum:Smith & Cross': 2}},
+}
+
+# (Category, Type, Kind), on top of the example barstock
+EXTRA_ROWS = [
+    ('Spirit', 'Jamaican Rum', 'Smith & Cross'),
+    ('Spirit', 'Jamaican Rum', 'Appleton 12'),
+    ('Spirit', 'Scotch Whisky', 'Laphroaig 10'),
+    ('Spirit', 'Irish Whiskey', 'Jameson'),
+    ('Spirit', 'Rye Whiskey', 'Rittenhouse'),
+    ('Spirit', 'Genever', 'Bols'),
+    ('Bitters', 'Aromatic Bitters', 'Angostura'),
+    ('Bitters', 'Aromatic Bitters', 'Fee Brothers'),
+    ('Bitters', 'Celery Tincture', 'Scrappy\'s'),
+    ('Liqueur', 'Rum Liqueur', 'Koloa'),
+]
+
+def stock_row(**fields):
+    from mixmind.barstock import StockRow, _computed_fields
+    fields = dict({'Size_mL': 750.0, 'Price_Paid': 30.0, 'ABV': 40.0, 'In_Stock': True, 'bar_id': 1}, **fields)
+    fields.update(_computed_fields(fields))
+    return StockRow(**{field: fields.get(field) for field in StockRow._fields})
+
+@pytest.fixture(scope='module')
+def recipes(app):
+    from mixmind.util import load_recipe_json
+    from mixmind.configuration_management import compile_recipes
+    recipe_files = [os.path.join(app.config['MIXMIND_RECIPES_DIR'], f) for f in app.config['MIXMIND_DEFAULT_RECIPES']]
+    base_recipes = load_recipe_json(recipe_files)
+    base_recipes.update(EXTRA_RECIPES)
+    return compile_recipes(base_recipes)
+
+@pytest.fixture(scope='module')
+def dependencies(recipes):
+    from mixmind.configuration_management import RecipeDependencies
+    return RecipeDependencies(recipes)
+
+@pytest.fixture(scope='module')
+def stock_rows(app):
+    from mixmind.barstock import _clean_csv_row
+    rows = []
+    for filename in app.config['MIXMIND_DEFAULT_INGREDIENTS']:
+        with open(os.path.join(app.config['MIXMIND_INGREDIENTS_DIR'], filename), encoding='utf-8-sig') as fp:
+            for row in csv.DictReader(fp):
+                clean_row = _clean_csv_row(row)
+                if clean_row is not None:
+                    rows.append(stock_row(**clean_row))
+    rows.extend(stock_row(Category=category, Type=type_, Kind=kind) for category, type_, kind in EXTRA_ROWS)
+    return rows
+
+def picked_up_by(recipes, row):
+    """ Names of the recipes that find row in a stock of just that row """
+    from mixmind.barstock import StockIndex
+    index = StockIndex(row.bar_id, [row])
+    return [recipe.name for recipe in recipes
+            if any(index.lookup(ingredient.specifier.ingredient.lower(), ingredient.specifier.kind)
+                for ingredient in recipe._get_quantized_ingredients())]
+
+def test_affected_matches_reference(recipes, dependencies, stock_rows):
+    assert len(stock_rows) > len(EXTRA_ROWS)
+    for row in stock_rows:
+        assert dependencies.affected_by_rows([row]) == picked_up_by(recipes, row), row
+
+def test_affected_by_several_rows(recipes, dependencies, stock_rows):
+    rows = stock_rows[::7]
+    expected = set()
+    for row in rows:
+        expected.update(picked_up_by(recipes, row))
+    assert dependencies.affected_by_rows(rows) == [recipe.name for recipe in recipes if recipe.name in expected]
+
+@pytest.mark.parametrize('row, used_by, not_used_by', [
+    (('Spirit', 'Jamaican Rum', 'Appleton 12'), ['Test Rum'], ['Test Generic Kind', 'Test Whisky']),
+    (('Spirit', 'Jamaican Rum', 'Smith & Cross'), ['Test Rum', 'Test Generic Kind'], []),
+    (('Liqueur', 'Rum Liqueur', 'Koloa'), ['Test Rum'], ['Test Any Spirit']),
+    (('Spirit', 'Scotch Whisky', 'Laphroaig 10'), ['Test Whisky'], ['Test Whiskey', 'Test Any Spirit']),
+    (('Spirit', 'Irish Whiskey', 'Jameson'), ['Test Whisky', 'Test Whiskey'], ['Test Any Spirit']),
+    (('Spirit', 'Rye Whiskey', 'Rittenhouse'), ['Test Whisky', 'Test Whiskey', 'Test Any Spirit', 'Test Bitters'], []),
+    (('Spirit', 'Genever', 'Bols'), ['Test Any Spirit'], ['Test Rum']),
+    (('Bitters', 'Celery Tincture', 'Scrappy\'s'), ['Test Bitters'], ['Test Type Kind']),
+    (('Bitters', 'Aromatic Bitters', 'Angostura'), ['Test Bitters', 'Test Type Kind'], []),
+    (('Bitters', 'Aromatic Bitters', 'Fee Brothers'), ['Test Bitters'], ['Test Type Kind']),
+])
+def test_special_specifiers(recipes, dependencies, row, used_by, not_used_by):
+    category, type_, kind = row
+    row = stock_row(Category=category, Type=type_, Kind=kind)
+    affected = dependencies.affected_by_rows([row])
+    reference = picked_up_by(recipes, row)
+    for name in used_by:
+        assert name in affected and name in reference
+    for name in not_used_by:
+        assert name not in affected and name not in reference
@@ -0,0 +1,51 @@
+""" The recipe snapshot is validated on file (path, mtime, size), the json
+files are only read and hashed again when those change
+"""
+import json
+import os
+
+import pytest
+
+RECIPES = {'Test Sour': {'ingredients': {'rye whiskey': 2, 'lemon juice': 0.75, 'simple syrup': 0.75}}}
+
+@pytest.fixture
+def hashed(app, monkeypatch):
+    """ Paths passed to _file_sha1, cleared after each check """
+    from mixmind import configuration_management
+    calls = []
+    file_sha1 = configuration_management._file_sha1
+    def counting(filename):
+        calls.append(filename)
+        return file_sha1(filename)
+    monkeypatch.setattr(configuration_management, '_file_sha1', counting)
+    return calls
+
+def test_snapshot_hashes_only_changed_files(tmp_path, hashed):
+    from mixmind.configuration_management import load_recipe_library, snapshot_filename
+    recipe_file = str(tmp_path / 'recipes.json')
+    with open(recipe_file, 'w') as fp:
+        json.dump(RECIPES, fp)
+
+    _, _, first_hash = load_recipe_library([recipe_file])
+    assert os.path.isfile(snapshot_filename([recipe_file]))
+    assert len(hashed) == 1
+    del hashed[:]
+
+    _, _, cached_hash = load_recipe_library([recipe_file])
+    assert cached_hash == first_hash
+    assert hashed == []
+
+    # touched, same content: hashed once, then recorded
+    stat = os.stat(recipe_file)
+    os.utime(recipe_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert load_recipe_library([recipe_file])[2] == first_hash
+    assert len(hashed) == 1
+    del hashed[:]
+    assert load_recipe_library([recipe_file])[2] == first_hash
+    assert hashed == []
+
+    with open(recipe_file, 'w') as fp:
+        json.dump(dict(RECIPES, **{'Test Fizz': {'ingredients': {'dry gin': 2, 'soda water': 2}}}), fp)
+    base_recipes, _, changed_hash = load_recipe_library([recipe_file])
+    assert changed_hash != first_hash
+    assert 'Test Fizz' in base_recipes
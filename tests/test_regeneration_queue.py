@@ -0,0 +1,56 @@
+""" Stock edits within the debounce window of the RegenerationQueue are
+coalesced into one regeneration, which publishes the last state of the stock
+"""
+import pytest
+
+from mixmind.database import db
+from mixmind.models import Bar
+from mixmind.barstock import Barstock_SQL, Ingredient, stored_stock_version
+from mixmind.configuration_management import RegenerationQueue
+
+RECIPE = 'Martini'
+PRICES = ['10', '20', '30']
+
+@pytest.fixture
+def regenerations(app, monkeypatch):
+    """ Swap in a debounced queue on the server, and count its regenerations """
+    from mixmind import mms
+    monkeypatch.setattr(mms, 'regeneration_queue', RegenerationQueue(app, mms, delay=0.5, max_delay=10.0))
+    calls = []
+    regenerate = mms.regenerate_recipes
+    def counting(bar, ingredients=None, recipe_name=None):
+        calls.append(ingredients)
+        return regenerate(bar, ingredients=ingredients, recipe_name=recipe_name)
+    monkeypatch.setattr(mms, 'regenerate_recipes', counting)
+    return mms, calls
+
+def example_costs(recipe):
+    return [(example.kinds, round(example.cost, 6)) for example in recipe.examples]
+
+def test_edits_in_window_regenerate_once(app, client, regenerations):
+    mms, calls = regenerations
+    with app.app_context():
+        bar = Bar.query.filter_by(is_default=True).one()
+        before = example_costs(mms.processed_recipes(bar).get(RECIPE))
+        ingredient = Ingredient.query.filter_by(bar_id=bar.id, type_='dry gin', In_Stock=True).first()
+        uuid, iid = ingredient.uuid, ingredient.iid()
+
+    for price in PRICES:
+        response = client.put('/api/ingredient', data={'iid': iid, 'field': 'Price_Paid', 'value': price})
+        assert response.get_json()['status'] == 'success'
+    assert mms.regeneration_queue.is_pending(bar.id)
+    assert mms.regeneration_queue.wait(timeout=30)
+
+    assert len(calls) == 1
+    # each edit queued the row before and after it
+    assert len(calls[0]) == 2 * len(PRICES)
+    with app.app_context():
+        library = mms.processed_recipes(bar)
+        assert library.stock_version == stored_stock_version(bar.id)
+        assert Ingredient.query.filter_by(uuid=uuid).one().Price_Paid == float(PRICES[-1])
+        fresh = next(recipe for recipe in mms.new_recipes() if recipe.name == RECIPE)
+        fresh.generate_examples(Barstock_SQL(bar.id), stats=True)
+        assert example_costs(library.get(RECIPE)) == example_costs(fresh)
+        assert example_costs(library.get(RECIPE)) != before
+        db.session.remove()
+    assert len(calls) == 1
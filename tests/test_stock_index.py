@@ -0,0 +1,31 @@
+""" The shared StockIndex follows the stock version stored in the database,
+so it also picks up changes made by other processes
+"""
+from mixmind.database import db
+from mixmind.models import Bar
+from mixmind.barstock import Ingredient, get_stock_index, bump_stored_stock_version, stored_stock_version
+
+def set_in_stock(bar_id, iid, in_stock):
+    """ Change a row the way another process would, without touching this one's index """
+    Ingredient.query.filter_by(uuid=iid).update({Ingredient.In_Stock: in_stock})
+    bump_stored_stock_version(bar_id)
+    db.session.commit()
+
+def test_index_reloads_when_stored_version_moves(app):
+    with app.app_context():
+        bar_id = Bar.query.filter_by(is_default=True).one().id
+        index = get_stock_index(bar_id)
+        assert get_stock_index(bar_id) is index
+        assert index.version == stored_stock_version(bar_id)
+
+        iid = Ingredient.query.filter_by(bar_id=bar_id, In_Stock=True).first().uuid
+        set_in_stock(bar_id, iid, False)
+        try:
+            reloaded = get_stock_index(bar_id)
+            assert reloaded is not index
+            assert reloaded.version == stored_stock_version(bar_id)
+            assert len(reloaded) == len(index) - 1
+            assert get_stock_index(bar_id) is reloaded
+        finally:
+            set_in_stock(bar_id, iid, True)
+        assert len(get_stock_index(bar_id)) == len(index)